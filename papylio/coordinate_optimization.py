@@ -2,6 +2,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 def coordinates_within_margin_selection(coordinates,  image = None, bounds = None, margin=10):
     if coordinates.size == 0:
@@ -96,34 +98,176 @@ def fit_twoD_gaussian(Z):
     # The offset can potentially be used for background subtraction
     return popt
 
-def coordinates_after_gaussian_fit(coordinates, image, gaussian_width = 9, return_fit_parameters=False):
-    # TODO: fix standard deviation to the psf size, this may improve correct peak localization when two peaks are close.
-    new_coordinates = []
-    fit_parameters = []
+def crop_patches(image, centers, width):
+    # Stack of patches of size 2 * (width // 2) + 1 around the centers, which should lie within the image.
+    offsets = np.arange(-(width // 2), width // 2 + 1)
+    return image[centers[:, 1, None, None] + offsets[None, :, None], centers[:, 0, None, None] + offsets[None, None, :]]
+
+
+def fit_twoD_gaussians(patches, sigma=None, sigma_bounds=(0.5, None), maximum_iterations=1000, tolerance=1e-6):
+    """Fit a symmetric 2D Gaussian to each patch in a stack, using a vectorized Levenberg-Marquardt algorithm.
+
+    The Gaussian is described by `twoD_gaussian`, with the position relative to the center pixel of the patch.
+
+    Parameters
+    ----------
+    patches : numpy.ndarray
+        Stack of patches with shape (number of patches, height, width)
+    sigma : float, optional
+        If given, the standard deviation of the Gaussian is fixed to this value, e.g. the measured PSF size.
+        Otherwise, the standard deviation is fitted as well.
+    sigma_bounds : tuple
+        Range of plausible fitted standard deviations, by default from 0.5 pixel to the patch size. Fits with a
+        standard deviation outside this range, e.g. on single hot pixels or on noise, have not converged.
+    maximum_iterations : int
+        Maximum number of iterations, fits that did not converge within this number are indicated by `converged`.
+    tolerance : float
+        A fit has converged when a step decreases the sum of squared residuals by a relative amount smaller than the
+        tolerance. Fits that stop improving before, or run out of iterations, have not converged.
+
+    Returns
+    -------
+    parameters : numpy.ndarray
+        Fitted offset, amplitude, x0, y0 and sigma for each patch, with shape (number of patches, 5)
+    uncertainties : numpy.ndarray
+        Standard errors of the parameters, estimated from the residuals in the same way as `scipy.optimize.curve_fit`.
+        The uncertainty of a fixed sigma is zero.
+    converged : numpy.ndarray
+        Boolean array indicating whether the fit converged to a Gaussian with positive amplitude and a plausible
+        standard deviation.
+    """
+    patches = np.asarray(patches, dtype=float)
+    number_of_patches, height, width = patches.shape
+    x, y = np.arange(width) - width // 2, np.arange(height) - height // 2
+    X, Y = [grid.ravel() for grid in np.meshgrid(x, y)]
+    Z = patches.reshape(number_of_patches, -1)
+
+    parameters = np.zeros((number_of_patches, 5))
+    parameters[:, 0] = Z.min(axis=1)
+    parameters[:, 1] = Z.max(axis=1) - Z.min(axis=1)
+    parameters[:, 4] = 1 if sigma is None else sigma
+    fitted = slice(None) if sigma is None else slice(0, 4)
+    number_of_fitted_parameters = 5 if sigma is None else 4
+
+    def residuals_and_jacobian(parameters, Z):
+        offset, amplitude, x0, y0, sigma = [parameter[:, None] for parameter in parameters.T]
+        dx, dy = X - x0, Y - y0
+        r2 = dx ** 2 + dy ** 2
+        gaussian = np.exp(-r2 / (2 * sigma ** 2))
+        residuals = Z - (offset + amplitude * gaussian)
+        jacobian = np.stack([np.ones_like(gaussian), gaussian, amplitude * gaussian * dx / sigma ** 2,
+                             amplitude * gaussian * dy / sigma ** 2, amplitude * gaussian * r2 / sigma ** 3], axis=-1)
+        return residuals, jacobian[..., fitted]
+
+    residuals, jacobian = residuals_and_jacobian(parameters, Z)
+    cost = np.sum(residuals ** 2, axis=1)
+    damping = np.full(number_of_patches, 1e-3)
+    converged = np.zeros(number_of_patches, dtype=bool)
+    # Fits that stall at maximum damping are stopped and count as failed
+    stalled = np.zeros(number_of_patches, dtype=bool)
+    identity = np.eye(number_of_fitted_parameters)
+    for i in range(maximum_iterations):
+        # Only patches that did not converge or stall yet are updated, diverging fits are stopped
+        stalled |= ~np.isfinite(jacobian).all(axis=(1, 2))
+        active = np.flatnonzero(~converged & ~stalled)
+        if len(active) == 0:
+            break
+        J, r = jacobian[active], residuals[active]
+        JTJ = np.einsum('nmp,nmq->npq', J, J)
+        JTr = np.einsum('nmp,nm->np', J, r)
+        # The identity term keeps the matrix invertible when a parameter has no effect, e.g. for zero amplitude.
+        damped_JTJ = JTJ + damping[active, None, None] * (JTJ * identity + 1e-9 * identity)
+        try:
+            step = np.linalg.solve(damped_JTJ, JTr[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum('npq,nq->np', np.linalg.pinv(damped_JTJ), JTr)
+
+        new_parameters = parameters[active]
+        new_parameters[:, fitted] += step
+        new_residuals, new_jacobian = residuals_and_jacobian(new_parameters, Z[active])
+        new_cost = np.sum(new_residuals ** 2, axis=1)
+
+        # Steps that decrease the cost are accepted and the damping is decreased, otherwise the damping is increased.
+        improved = new_cost <= cost[active]
+        small_step = (np.abs(step) <= tolerance * (np.abs(parameters[active][:, fitted]) + tolerance)).all(axis=1)
+        converged[active] = improved & ((cost[active] - new_cost) <= tolerance * cost[active]) & small_step
+        stalled[active] = ~improved & (damping[active] > 1e10)
+        updated = active[improved]
+        parameters[updated] = new_parameters[improved]
+        residuals[updated], jacobian[updated] = new_residuals[improved], new_jacobian[improved]
+        cost[updated] = new_cost[improved]
+        damping[active] = np.where(improved, damping[active] / 10, damping[active] * 10)
+
+    converged &= np.isfinite(parameters).all(axis=1) & (parameters[:, 1] > 0)
+    if sigma is None:
+        minimum_sigma, maximum_sigma = sigma_bounds
+        if maximum_sigma is None:
+            maximum_sigma = max(height, width)
+        converged &= (parameters[:, 4] >= minimum_sigma) & (parameters[:, 4] <= maximum_sigma)
+
+    JTJ = np.einsum('nmp,nmq->npq', jacobian, jacobian)
+    degrees_of_freedom = max(height * width - number_of_fitted_parameters, 1)
+    covariance = np.linalg.pinv(JTJ) * (cost / degrees_of_freedom)[:, None, None]
+    uncertainties = np.zeros_like(parameters)
+    uncertainties[:, fitted] = np.sqrt(np.abs(np.einsum('npp->np', covariance)))
+
+    return parameters, uncertainties, converged
+
+
+def coordinates_after_gaussian_fit(coordinates, image, gaussian_width=9, sigma=None, return_fit_parameters=False,
+                                   return_uncertainties=False):
+    """Refine coordinates by fitting a 2D Gaussian around each coordinate
+
+    All patches are fitted at once using `fit_twoD_gaussians`. Coordinates too close to the image edge, fits that did
+    not converge, fits with non-positive amplitude or implausible width and fits with a center far outside the patch
+    are removed.
+
+    Parameters
+    ----------
+    coordinates : numpy.ndarray
+        Array with each row the x and y coordinate of a peak
+    image : numpy.ndarray
+        Image containing the peaks
+    gaussian_width : int
+        Width of the patch around each coordinate used for fitting
+    sigma : float, optional
+        If given, the standard deviation of the Gaussian is fixed to this value, e.g. the PSF size determined with
+        `File.determine_psf_size`. This can improve the localization of peaks that are close together.
+    return_fit_parameters : bool
+        If True, the fit parameters (offset, amplitude, x0, y0, sigma) are returned as well.
+    return_uncertainties : bool
+        If True, the standard errors of the fit parameters are returned as well.
+
+    Returns
+    -------
+    new_coordinates : numpy.ndarray
+        Fitted coordinates
+    fit_parameters : numpy.ndarray, optional
+        Fit parameters for each fitted coordinate
+    uncertainties : numpy.ndarray, optional
+        Standard errors of the fit parameters for each fitted coordinate
+    """
     if len(coordinates) == 0:  # This statement may not be necessary. However, check the code thoroughly before you remove this.
-        new_coordinates = coordinates
+        new_coordinates, fit_parameters, uncertainties = coordinates, np.zeros((0, 5)), np.zeros((0, 5))
     else:
         coordinates = coordinates_within_margin(coordinates, image=image, margin=gaussian_width//2+1)
-
-        for i, coordinate in enumerate(coordinates):
-            # Could use the coordinates_within_margin for this [IS 01-11-2019]
-            #if np.all(coordinate > gaussian_width//2+1) and \
-            #        np.all(coordinate < np.array(image.shape)-gaussian_width//2-1):
-            cropped_peak = crop(image, coordinate, gaussian_width)
-            try:
-                coefficients = fit_twoD_gaussian(cropped_peak)
-                #new_coordinates.append(coordinate + coefficients[2:4])
-                new_coordinate = coordinate + coefficients[2:4]
-                if np.sum(np.abs(coefficients[2:4]))<gaussian_width*2:
-                    new_coordinates.append(new_coordinate)
-                    fit_parameters.append(coefficients)
-                # else: #MD do nothing, you don't want to include fits with a center far outside the cropped image
-            except RuntimeError:
-                pass
+        centers = np.round(coordinates).astype(int).reshape(-1, 2)
+        # Fits with non-positive amplitude or a standard deviation outside 0.5 to gaussian_width have not converged
+        fit_parameters, uncertainties, converged = \
+            fit_twoD_gaussians(crop_patches(image, centers, gaussian_width), sigma=sigma,
+                               sigma_bounds=(0.5, gaussian_width))
+
+        # Exclude fits with a center far outside the cropped image
+        selection = converged & (np.sum(np.abs(fit_parameters[:, 2:4]), axis=1) < gaussian_width * 2)
+        new_coordinates = centers[selection] + fit_parameters[selection, 2:4]
+        fit_parameters, uncertainties = fit_parameters[selection], uncertainties[selection]
+
+    output = (np.array(new_coordinates),)
     if return_fit_parameters:
-        return np.array(new_coordinates), np.array(fit_parameters)
-    else:
-        return np.array(new_coordinates)
+        output += (fit_parameters,)
+    if return_uncertainties:
+        output += (uncertainties,)
+    return output if len(output) > 1 else output[0]
 
 
 def merge_nearby_coordinates(coordinates, distance_threshold=2, plot=False):
@@ -131,10 +275,11 @@ def merge_nearby_coordinates(coordinates, distance_threshold=2, plot=False):
 
     Coordinates are stored in a KD-tree.
     Each pair of points with a distance smaller than the distance threshold is obtained
-    Pairs are chained to obtain groups of points
+    The pairs form a sparse neighbour graph, of which the connected components are the groups of points
     For each group find the center coordinate and use that as a new coordinate
     (do this only if each member of the group is within the distance threshold from the center coordinate).
-    Add individual points to the new coordinate list, i.e. points that do not have other points within the distance threshold.
+    Individual points, i.e. points that do not have other points within the distance threshold, form a group by
+    themselves and are therefore kept as they are.
 
     Parameters
     ----------
@@ -154,40 +299,31 @@ def merge_nearby_coordinates(coordinates, distance_threshold=2, plot=False):
 
     # Convert to numpy array in case the coordinates are given as a set of tuples
     coordinates = array_from_set_of_tuples(coordinates)
+    if len(coordinates) == 0:
+        return coordinates.astype(float)
 
     # Put coordinates in KD-tree for fast nearest-neighbour finding
     coordinates_KDTree = cKDTree(coordinates)
 
     # Determine pairs of points closer than the distance_threshold
-    close_pairs = coordinates_KDTree.query_pairs(r=distance_threshold)
-    close_pairs = [set(pair) for pair in close_pairs] # Convert to list of sets
+    close_pairs = coordinates_KDTree.query_pairs(r=distance_threshold, output_type='ndarray')
 
-    # Chain the pairs to obtain groups (or clusters) of points
-    groups_of_points = combine_overlapping_sets(close_pairs)
+    # Groups (or clusters) of points are the connected components of the graph with the pairs as edges
+    number_of_points = len(coordinates)
+    graph = coo_matrix((np.ones(len(close_pairs), dtype=bool), (close_pairs[:, 0], close_pairs[:, 1])),
+                       shape=(number_of_points, number_of_points))
+    number_of_groups, group_per_point = connected_components(graph, directed=False)
 
     # Calculate the new coordinates by taking the center of all the neighbouring points.
     # A threshold for the total group is applied, i.e. all points must lie within the distance_threshold
     # from the center coordinate.
-    new_coordinates = []
-    for group in groups_of_points:
-        group_coordinates = coordinates[list(group)]
-        center_coordinate = np.mean(group_coordinates, axis=0)
-        distances_to_center = np.sqrt(np.sum((group_coordinates-center_coordinate)**2, axis=1))
-        if not (np.max(distances_to_center) > distance_threshold): # This could be another threshold
-            new_coordinates.append(center_coordinate)
-
-    # Obtain individual points, i.e. those that do not have another point within the distance_threshold.
-    # This is done by taking the difference from all points and the ones that are present in any of the groups.
-    all_points_in_groups = set(point for group in groups_of_points for point in group)
-    all_points = set(range(len(coordinates)))
-    individual_points = all_points.difference(all_points_in_groups)
-
-    # Add individual points to new_coordinates list
-    for point in individual_points:
-        new_coordinates.append(coordinates[point])
-
-    # Convert to numpy array
-    new_coordinates = np.array(new_coordinates)
+    points_per_group = np.bincount(group_per_point, minlength=number_of_groups)
+    center_coordinates = np.stack([np.bincount(group_per_point, weights=dimension, minlength=number_of_groups)
+                                   for dimension in coordinates.T.astype(float)], axis=1) / points_per_group[:, None]
+    distances_to_center = np.sqrt(np.sum((coordinates - center_coordinates[group_per_point])**2, axis=1))
+    maximum_distance_to_center = np.zeros(number_of_groups)
+    np.maximum.at(maximum_distance_to_center, group_per_point, distances_to_center)
+    new_coordinates = center_coordinates[~(maximum_distance_to_center > distance_threshold)] # This could be another threshold
 
     if plot:
         axis = plt.figure().gca()
@@ -197,6 +333,60 @@ def merge_nearby_coordinates(coordinates, distance_threshold=2, plot=False):
     return new_coordinates
 
 
+def combine_coordinate_sets(coordinate_sets, method='and', distance_threshold=2):
+    """Combine coordinate sets found in different channels, mapped to the same channel
+
+    Coordinates in different sets closer than the distance threshold are considered to belong to the same molecule.
+    For each coordinate in the combined set the nearest coordinate in the next set is found using a KD-tree.
+
+    Parameters
+    ----------
+    coordinate_sets : list of numpy.ndarray
+        Coordinate arrays, with each row a set of coordinates, e.g. one array for each channel
+    method : str or int
+        'and' to keep the molecules present in all sets, the new coordinate is the mean of the matching coordinates.
+        'or' to keep the molecules present in any of the sets, a molecule present in multiple sets is included once,
+        at its coordinate in the first of these sets.
+        An integer to keep the molecules of the set with this index, e.g. to use only the coordinates of a single
+        channel.
+    distance_threshold : int or float
+        Coordinates in different sets closer than this distance are considered belonging to the same molecule.
+
+    Returns
+    -------
+    coordinates : numpy.ndarray of floats
+        Combined coordinates
+    """
+    coordinate_sets = [np.asarray(coordinates, dtype=float).reshape(-1, 2) for coordinates in coordinate_sets]
+
+    if not isinstance(method, str):
+        return coordinate_sets[method]
+
+    coordinates_sum = coordinate_sets[0]
+    number_of_sets = 1
+    for coordinates in coordinate_sets[1:]:
+        combined_coordinates = coordinates_sum / number_of_sets
+        if method == 'and':
+            if len(coordinates) == 0 or len(combined_coordinates) == 0:
+                return np.zeros((0, 2))
+            distances, nearest = cKDTree(coordinates).query(combined_coordinates, distance_upper_bound=distance_threshold)
+            # Each coordinate is matched at most once, to the closest coordinate in the combined set
+            matched = np.flatnonzero(np.isfinite(distances))
+            matched = matched[np.argsort(distances[matched], kind='stable')]
+            matched = np.sort(matched[np.unique(nearest[matched], return_index=True)[1]])
+            coordinates_sum = coordinates_sum[matched] + coordinates[nearest[matched]]
+            number_of_sets += 1
+        elif method == 'or':
+            if len(combined_coordinates) > 0 and len(coordinates) > 0:
+                distances, _ = cKDTree(combined_coordinates).query(coordinates, distance_upper_bound=distance_threshold)
+                coordinates = coordinates[~np.isfinite(distances)]
+            coordinates_sum = np.vstack([coordinates_sum, coordinates])
+        else:
+            raise ValueError(f'Unknown method {method}, choose and, or or a set index')
+
+    return coordinates_sum / number_of_sets
+
+
 def combine_overlapping_sets(old_list_of_sets):
     """ Combine sets that have overlap
 
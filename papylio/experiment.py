@@ -37,6 +37,8 @@ import tifffile
 from papylio.file import File
 # from papylio.molecule import Molecules
 from papylio.file_collection import FileCollection
+from papylio.molecule_index import MoleculeIndex
+from papylio.file_discovery import FileManifest
 from papylio.plotting import histogram
 from papylio.movie.movie import Movie
 # from papylio.plugin_manager import PluginManager
@@ -44,8 +46,12 @@ from papylio.movie.movie import Movie
 from papylio.plugin_manager import plugins
 
 import re  # Regular expressions
+import time
+import copy
 import warnings
 from nd2reader import ND2Reader
+import joblib
+from objectlist.base import tqdm_joblib
 
 
 # import matplotlib.pyplot as plt #Provides a MATLAB-like plotting framework
@@ -185,6 +191,7 @@ class Experiment:
         self.name = os.path.basename(main_path)
         self.main_path = Path(main_path).absolute()
         self.files = FileCollection()
+        self._molecule_index = None
         self.import_all = import_all
 
         self._channels = np.atleast_1d(np.array(channels))
@@ -218,13 +225,14 @@ class Experiment:
         d = self.__dict__.copy()
         # d.pop('files')
         d['files'] = []
-        excluded_keys = ['files', 'sequencing_data', '_tile_mappings'] #TODO: Move sequencing related terms to sequencing.py
+        excluded_keys = ['files', 'sequencing_data', '_tile_mappings', '_molecule_index'] #TODO: Move sequencing related terms to sequencing.py
         d = {key: value for key, value in self.__dict__.items() if key not in excluded_keys}
         d['_do_not_update'] = None # This is for parallelization in Collection
         return d
 
     def __setstate__(self, dict):
         self.__dict__.update(dict)
+        self._molecule_index = None
 
     def __repr__(self):
         return (f'{self.__class__.__name__}({self.name})')
@@ -289,9 +297,24 @@ class Experiment:
     def file_paths(self):
         return [file.relativeFilePath for file in self.files]
 
+    @property
+    def molecule_index(self):
+        """MoleculeIndex : Table with a row for each molecule in the experiment, updated for files that changed.
+
+        Examples
+        --------
+        >>> exp.molecule_index.query('selected and FRET_mean > 0.6')
+        """
+        if self._molecule_index is None:
+            self._molecule_index = MoleculeIndex(self)
+        return self._molecule_index.update()
+
     @property
     def nc_file_paths(self):
-        return [file.relativeFilePath.with_suffix('.nc') for file in self.files if '.nc' in file.extensions]
+        """list of pathlib.Path : Paths of the existing dataset files relative to the main path, with the extension of
+        the storage backend of each file, i.e. .nc or .zarr"""
+        return [file.dataset_filepath.relative_to(self.main_path) for file in self.files
+                if file.storage.extension in file.extensions]
 
     def find_file_paths_and_extensions(self, paths):
         """Find unique files in all subfolders and add them to the experiment
@@ -309,14 +332,23 @@ class Experiment:
 
         """
 
-        if isinstance(paths, str) or isinstance(paths, Path):
+        manifest = None
+        if (isinstance(paths, str) or isinstance(paths, Path)) and \
+                Path(paths).absolute() == self.main_path and self.configuration['files'].get('use_manifest', True):
+            # Only folders that changed since the experiment was last opened are listed
+            manifest = FileManifest(self.main_path)
+            paths = manifest.paths()
+        elif isinstance(paths, str) or isinstance(paths, Path):
             #paths = paths.glob('**/*')
                 #'**/?*.*')  # At least one character in front of the extension to prevent using hidden folders
 
             # The following approach is faster than checking each file separately using is_file() for network drives. (not tested for regular drives)
             files_and_folders = set(paths.glob('**/*'))
             folders = set(paths.glob('**'))
-            paths = files_and_folders - folders
+            # Zarr stores are directories, the files inside them are not included
+            zarr_stores = {folder for folder in folders if folder.suffix == '.zarr'}
+            paths = {path for path in files_and_folders - folders
+                     if not any(parent in zarr_stores for parent in path.parents)} | zarr_stores
 
         file_paths_and_extensions = \
             [[p.relative_to(self.main_path).with_suffix(''), p.suffix]
@@ -327,6 +359,8 @@ class Experiment:
                      # Exclude stings in filename
                      all(name not in p.with_suffix('').name for name in
                          self.configuration['files']['excluded_names']) &
+                     # Exclude annotation files belonging to the .nc files (also when missing in older configurations)
+                     (not p.with_suffix('').name.endswith('_annotations')) &
                      # Exclude strings in path
                      all(path not in str(p.relative_to(self.main_path).parent) for path in
                          self.configuration['files']['excluded_paths']) &
@@ -344,10 +378,13 @@ class Experiment:
                 new_file_paths_and_extensions.append([file_path.parent, extensions])
                 # file_paths_and_extensions[i, 0] = file_paths_and_extensions[i, 0].parent
             elif '.nd2' in extensions and not 'fov' in str(file_path):
-                from papylio.movie.movie import Movie
-                nd2_movie = Movie(file_path.with_suffix('.nd2'))
-                if nd2_movie.number_of_fov > 1:  # if the file is nd2 with multiple field of views
-                    for fov_id in range(nd2_movie.number_of_fov):
+                if manifest is not None:
+                    number_of_fov = manifest.number_of_fov(file_path.with_suffix('.nd2'))
+                else:
+                    from papylio.movie.movie import Movie
+                    number_of_fov = Movie(file_path.with_suffix('.nd2')).number_of_fov
+                if number_of_fov > 1:  # if the file is nd2 with multiple field of views
+                    for fov_id in range(number_of_fov):
                         new_path = Path(str(file_path) + f'_fov{fov_id:03d}')
                         new_file_paths_and_extensions.append([new_path, extensions])
                         # fov_info['fov_chosen'] = fov_id
@@ -360,6 +397,9 @@ class Experiment:
                 new_file_paths_and_extensions.append([file_path, extensions])
         file_paths_and_extensions = new_file_paths_and_extensions
 
+        if manifest is not None and manifest.is_changed:
+            manifest.save()
+
         file_paths_and_extensions = np.array(file_paths_and_extensions)
 
         file_paths_and_extensions = file_paths_and_extensions[file_paths_and_extensions[:, 0].argsort()]
@@ -535,6 +575,91 @@ class Experiment:
     def add_common_image_corrections_to_movies(self):
         self.files.movie._common_corrections = self.common_image_corrections
 
+    def extract_traces_parallel(self, files=None, workers=None, **kwargs):
+        """Extract traces for multiple files in parallel using a pool of processes
+
+        Each file is processed by a separate worker that writes the traces to the netcdf file belonging to that file,
+        so no locking between workers is needed.
+
+        Parameters
+        ----------
+        files : FileCollection, optional
+            Files to extract traces from, by default all files in the experiment.
+        workers : int, optional
+            Number of worker processes, by default the number of cores.
+        kwargs
+            Keyword arguments passed to `File.extract_traces`.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Duration of the trace extraction and the error message (if any) for each file.
+        """
+        if files is None:
+            files = self.files
+        if workers is None:
+            workers = os.cpu_count()
+
+        # Open datasets in this process would block the workers from writing to the files
+        files.close_dataset()
+
+        with tqdm_joblib(tqdm.tqdm(total=len(files), desc='Extract traces', position=0, leave=True)):
+            results = joblib.Parallel(workers)(joblib.delayed(_extract_traces_for_file)(file, **kwargs)
+                                               for file in files)
+
+        timings = pd.DataFrame(results, columns=['file', 'duration', 'error']).set_index('file')
+        for file_path, error in timings.error.dropna().items():
+            warnings.warn(f'Trace extraction failed for {file_path}: {error}')
+        return timings
+
+    def find_coordinates_parallel(self, files=None, workers=None, **configuration):
+        """Find the coordinates of the molecules for multiple files in parallel using a pool of processes
+
+        The find_coordinates configuration is determined once and passed to the workers, each file uses its own
+        mapping. Each worker determines the coordinates of a file, i.e. makes the projection images, finds and fits the
+        peaks and applies the margins. The coordinates are written to the files afterwards by this process.
+
+        Parameters
+        ----------
+        files : FileCollection, optional
+            Files to find coordinates for, by default all files in the experiment.
+        workers : int, optional
+            Number of worker processes, by default the number of cores.
+        configuration
+            Settings overriding the find_coordinates section of the configuration, as for `File.find_coordinates`.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Duration of the coordinate finding and the error message (if any) for each file.
+        """
+        if files is None:
+            files = self.files
+        if workers is None:
+            workers = os.cpu_count()
+
+        find_coordinates_configuration = copy.deepcopy(self.configuration['find_coordinates'])
+        find_coordinates_configuration.update(configuration)
+
+        # Open datasets in this process would block the workers from reading the files
+        files.close_dataset()
+
+        with tqdm_joblib(tqdm.tqdm(total=len(files), desc='Find coordinates', position=0, leave=True)):
+            results = joblib.Parallel(workers)(
+                joblib.delayed(_find_coordinates_for_file)(file, find_coordinates_configuration)
+                for file in files)
+
+        for file, (_, coordinates, _, _) in zip(files, results):
+            if coordinates is not None:
+                with file.batch_write():
+                    file.coordinates = coordinates
+
+        timings = pd.DataFrame([(file_path, duration, error) for file_path, _, duration, error in results],
+                               columns=['file', 'duration', 'error']).set_index('file')
+        for file_path, error in timings.error.dropna().items():
+            warnings.warn(f'Finding coordinates failed for {file_path}: {error}')
+        return timings
+
     # def show_flatfield_and_darkfield_corrections(self, name='', save=True):
     #     pass
 
@@ -628,9 +753,10 @@ class Experiment:
         if files is None:
             files = self.files
 
-        file_paths = [file.relativeFilePath.with_suffix('.nc') for file in files if '.nc' in file.extensions]
+        # The datasets opened by the files include the annotations, such as selections and classifications
+        datasets = [file.open_dataset() for file in files if file.storage.exists(file.dataset_filepath)]
 
-        with xr.open_mfdataset(file_paths, concat_dim='molecule', combine='nested') as ds:
+        with xr.combine_nested(datasets, concat_dim='molecule') as ds:
             ds_sel = ds.query(query)  # HJ1_WT, HJ7_G116T
             # if not 'app' in globals().keys():
             #     global app
@@ -655,3 +781,24 @@ class Experiment:
                 nms = -1
             df.loc[n] = nms
         df.to_excel(self.main_path.joinpath('number_of_molecules'))
+
+
+def _find_coordinates_for_file(file, configuration):
+    start_time = time.time()
+    try:
+        coordinates = file.determine_coordinates(configuration)
+        error = None
+    except Exception as exception:
+        coordinates = None
+        error = repr(exception)
+    return str(file.relativeFilePath), coordinates, time.time() - start_time, error
+
+
+def _extract_traces_for_file(file, **kwargs):
+    start_time = time.time()
+    try:
+        file.extract_traces(**kwargs)
+        error = None
+    except Exception as exception:
+        error = repr(exception)
+    return str(file.relativeFilePath), time.time() - start_time, error
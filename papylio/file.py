@@ -14,6 +14,7 @@ import skimage as ski
 import warnings
 import sys
 import re
+import contextlib
 import tifffile
 import netCDF4
 # from papylio.molecule import Molecule
@@ -25,7 +26,7 @@ from papylio.peak_finding import find_peaks
 from papylio.coordinate_optimization import  coordinates_within_margin, \
                                                     coordinates_after_gaussian_fit, \
                                                     coordinates_without_intensity_at_radius, \
-                                                    merge_nearby_coordinates, \
+                                                    merge_nearby_coordinates, combine_coordinate_sets, \
                                                     set_of_tuples_from_array, array_from_set_of_tuples, \
                                                     coordinates_within_margin_selection
 from papylio.trace_extraction import extract_traces
@@ -39,6 +40,7 @@ from papylio.plugin_manager import plugins
 # from papylio.trace_plot import TraceAnalysisFrame
 from papylio.analysis.dwelltime_analysis import dwell_times_from_classification, analyze_dwells
 from papylio.decorators import return_none_when_executed_by_pycharm
+from papylio.storage import get_storage
 
 @plugins
 class File:
@@ -77,6 +79,13 @@ class File:
         self.movie = None
         self.mapping = None
 
+        self._dataset_handle = None
+        self._dataset_sources = []
+        self._dataset_modification_time = None
+        self._variable_cache = {}
+        self._write_batch = None
+        self._storage = None
+
 
         self.dataset_variables = ['molecule', 'frame', 'time', 'coordinates', 'background', 'intensity', 'FRET', 'selected',
                                   'molecule_in_file', 'illumination_correction', 'number_of_states', 'transition_rate', 'state_mean', 'classification']
@@ -102,7 +111,8 @@ class File:
                                 '.pks': self.import_pks_file,
                                 '.traces': self.import_traces_file,
                                 '_steps_data.xlsx': self.import_excel_file,
-                                '.nc': self.noneFunction
+                                '.nc': self.noneFunction,
+                                '.zarr': self.noneFunction
                                 }
 
         # print(self)
@@ -132,8 +142,7 @@ class File:
         try:
             # with xr.open_dataset(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4') as dataset:
             #     return len(dataset.molecule)
-            with netCDF4.Dataset(self.absoluteFilePath.with_suffix('.nc')) as dataset:
-                return dataset.dimensions['molecule'].size
+            return self.current_dataset().sizes['molecule']
         except FileNotFoundError:
             return 0
 
@@ -228,6 +237,27 @@ class File:
         coordinates_stage = self.movie.pixel_to_stage_coordinates_transformation(coordinates)
         return xr.DataArray(coordinates_stage, coords=coordinates.coords)
 
+    def transform_coordinates_to_main_channel(self, coordinates, channel_index):
+        """Transform coordinates in channel 0 or 1 to channel 0, using the mapping of the file"""
+        self._check_mapped_channel(channel_index)
+        if channel_index == 0:
+            return coordinates
+        return self.mapping.transform_coordinates(coordinates, direction='Acceptor2Donor')
+
+    def transform_coordinates_from_main_channel(self, coordinates, channel_index):
+        """Transform coordinates in channel 0 to channel 0 or 1, using the mapping of the file"""
+        self._check_mapped_channel(channel_index)
+        if channel_index == 0:
+            return coordinates
+        return self.mapping.transform_coordinates(coordinates, direction='Donor2Acceptor')
+
+    @staticmethod
+    def _check_mapped_channel(channel_index):
+        # A file has a single mapping, between the donor and acceptor channel
+        if channel_index not in (0, 1):
+            raise ValueError(f'Coordinates cannot be mapped to channel {channel_index}, the mapping of a file only '
+                             f'relates channel 0 and 1')
+
     def set_coordinates_of_channel(self, coordinates, channel):
         # TODO: make this usable for more than two channels
         # TODO: Make this work for xarray DataArrays
@@ -261,7 +291,10 @@ class File:
         return self.coordinates.sel(channel=channel)
 
     def __getstate__(self):
-        return self.__dict__.copy()
+        d = self.__dict__.copy()
+        d.update(_dataset_handle=None, _dataset_sources=[], _dataset_modification_time=None, _variable_cache={},
+                 _write_batch=None)
+        return d
 
     def __setstate__(self, dict):
         self.__dict__.update(dict)
@@ -270,27 +303,265 @@ class File:
         if item == 'dataset_variables':
             return
         if item in self.dataset_variables or item.startswith('selection') or item.startswith('classification') or item.startswith('intensity'):
-            with xr.open_dataset(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4') as dataset:
-                try:
-                    return dataset[item].load()
-                except KeyError:
-                    # It is desirable to raise an AttributeError instead of a KeyError,
-                    # as this is used by hasattr for example. Hence the try except.
-                    pass
+            try:
+                return self.load_variable(item)
+            except KeyError:
+                # It is desirable to raise an AttributeError instead of a KeyError,
+                # as this is used by hasattr for example. Hence the try except.
+                pass
         # else:
         #     super().__getattribute__(item)
         raise AttributeError(f'Attribute {item} not found')
 
+    # Variables up to this size (in bytes) are kept in memory after loading
+    maximum_cached_variable_size = 2**26
+
+    @property
+    def storage(self):
+        """Storage backend of the dataset, set by `backend` in the trace_storage configuration."""
+        # The backend is only resolved again when the configured backend changes
+        backend = (self.configuration.get('trace_storage') or {}).get('backend') or 'netcdf'
+        if self._storage is None or self._storage.name != backend:
+            self._storage = get_storage(backend)
+        return self._storage
+
+    @property
+    def dataset_filepath(self):
+        return self.absoluteFilePath.with_suffix(self.storage.extension)
+
+    @property
+    def annotations_filepath(self):
+        """Path of the file storing the annotations, i.e. the selections, classifications and HMM results.
+
+        Annotations are stored separate from the traces in the dataset file, so that they can be changed and removed
+        without rewriting the traces.
+        """
+        return self.absoluteFilePath.with_name(self.name + '_annotations' + self.storage.extension)
+
+    def open_dataset(self):
+        """Lazily opened dataset of the dataset file, merged with the annotations file
+
+        The dataset is kept open and shared by the accessors of File, it is reopened when one of the files is modified.
+        Writes to the dataset should go through `_write_dataset`, which closes the dataset first.
+        """
+        storage = self.storage
+        annotations_exist = storage.exists(self.annotations_filepath)
+        modification_time = (storage.modification_time(self.dataset_filepath),
+                             storage.modification_time(self.annotations_filepath) if annotations_exist else None)
+        if self._dataset_handle is None or modification_time != self._dataset_modification_time:
+            self.close_dataset()
+            self._dataset_sources = [storage.open(self.dataset_filepath)]
+            if annotations_exist:
+                self._dataset_sources.append(storage.open(self.annotations_filepath))
+            self._dataset_handle = merge_annotations(*self._dataset_sources)
+            self._dataset_modification_time = modification_time
+        return self._dataset_handle
+
+    def close_dataset(self):
+        for dataset in self._dataset_sources:
+            dataset.close()
+        self._dataset_sources = []
+        self._dataset_handle = None
+        self._dataset_modification_time = None
+        self._variable_cache = {}
+
+    def current_dataset(self):
+        """Lazily opened dataset including the variables staged in a running `batch_write`"""
+        if self._write_batch is None:
+            return self.open_dataset()
+        staged = self._write_batch['dataset']
+        if self._write_batch['replace']:
+            return staged
+        dataset = self.open_dataset()
+        dataset = dataset.drop_vars([name for name in dataset.variables
+                                     if name in staged.variables or name in self._write_batch['dropped']])
+        return dataset.merge(staged, compat='override', combine_attrs='override')
+
+    def load_variable(self, name):
+        if self._write_batch is not None:
+            if name in self._write_batch['dataset'].variables:
+                return self._write_batch['dataset'][name].copy()
+            elif self._write_batch['replace'] or name in self._write_batch['dropped']:
+                raise KeyError(name)
+
+        dataset = self.open_dataset()
+        if name in self._variable_cache:
+            return self._variable_cache[name].copy()
+
+        data_array = dataset[name].copy().load()
+        if data_array.nbytes <= self.maximum_cached_variable_size:
+            self._variable_cache[name] = data_array
+            return data_array.copy()
+        else:
+            return data_array
+
+    @property
+    def storage_configuration(self):
+        configuration = self.configuration.get('trace_storage') or {}
+        return {key: configuration.get(key, value) for key, value in default_trace_storage_configuration.items()}
+
+    def _write_dataset(self, data, mode='a', engine=None, **kwargs):
+        # engine can be used to select the netcdf engine when the netcdf storage backend is used
+        if self._write_batch is not None and engine is None:
+            self._stage_write(data, mode=mode, encoding=kwargs.get('encoding', {}))
+            return
+
+        storage = self.storage
+        if engine is not None and storage.name == 'netcdf':
+            storage = get_storage('netcdf', engine=engine)
+
+        if isinstance(data, xr.DataArray):
+            data = data.to_dataset()
+        annotations, data = split_annotations(data)
+
+        encoding = {**trace_storage_encoding(data, **self.storage_configuration), **kwargs.get('encoding', {})}
+        encoding = {name: value for name, value in encoding.items() if name in data.variables}
+        self.close_dataset()
+        if data.data_vars or mode == 'w':
+            storage.write(data, self.dataset_filepath, mode=mode, encoding=encoding)
+        if annotations.data_vars or mode == 'w':
+            self._write_annotations(annotations, replace=(mode == 'w'))
+
+    def _write_annotations(self, annotations, dropped=(), replace=False):
+        # The annotations are small, so the annotations file is always rewritten as a whole.
+        storage = self.storage
+        if storage.exists(self.annotations_filepath) and not replace:
+            dataset = storage.load(self.annotations_filepath)
+            dataset = dataset.drop_vars([name for name in dataset.data_vars
+                                         if name in annotations.data_vars or name in dropped])
+            dataset = dataset.merge(annotations, compat='override', combine_attrs='override')
+        else:
+            dataset = annotations
+
+        self.close_dataset()
+        if not dataset.data_vars:
+            storage.remove(self.annotations_filepath)
+            return
+
+        encoding = trace_storage_encoding(dataset, **self.storage_configuration)
+        temporary_filepath = self.annotations_filepath.with_name(self.annotations_filepath.name + '.tmp')
+        try:
+            storage.write(dataset, temporary_filepath, mode='w', encoding=encoding)
+            storage.replace(temporary_filepath, self.annotations_filepath)
+        finally:
+            storage.remove(temporary_filepath)
+
+    def delete_variables(self, names):
+        """Remove variables from the dataset.
+
+        Annotations (selections, classifications and HMM results) are removed from the annotations file only. Removing
+        other variables requires rewriting the complete .nc file.
+
+        Parameters
+        ----------
+        names : list of str
+            Names of the variables to remove.
+        """
+        names = list(names)
+        if not names:
+            return
+
+        if self._write_batch is not None and self._write_batch['replace']:
+            self._write_batch['dataset'] = self._write_batch['dataset'].drop_vars(names, errors='ignore')
+            return
+
+        self.open_dataset()
+        names_in_nc_file = [name for name in names if name in self._dataset_sources[0].variables]
+        if all(is_annotation(name) for name in names) and not names_in_nc_file:
+            if self._write_batch is not None:
+                self._write_batch['dataset'] = self._write_batch['dataset'].drop_vars(names, errors='ignore')
+                self._write_batch['dropped'].update(names)
+            else:
+                self._write_annotations(xr.Dataset(), dropped=names)
+        else:
+            dataset = self.dataset.drop_vars(names, errors='ignore')
+            self._write_dataset(dataset, mode='w')
+
+    @contextlib.contextmanager
+    def batch_write(self, atomic=False):
+        """Context manager that collects all writes to the .nc file and writes them at once when the context exits.
+
+        Within the context, variables written to the file are staged in memory and are returned when read back.
+        All staged variables are written in a single open and flush of the file. If an exception occurs within the
+        context, the staged variables are discarded and the file is left untouched. Nested batches are joined with the
+        outermost batch.
+
+        Parameters
+        ----------
+        atomic : bool, optional
+            If True, variables appended to an existing file are written to a temporary copy of the file, which replaces
+            the original file only after all variables are written. This way the file is never left half-written, at
+            the cost of copying the file. A batch that rewrites the file is always written to a temporary file first,
+            and a batch that only contains annotations never touches the .nc file. By default False.
+
+        Examples
+        --------
+        >>> with file.batch_write():
+        ...     file.extract_traces()
+        ...     file.apply_selections()
+        """
+        if self._write_batch is not None:
+            yield self
+            return
+
+        self._write_batch = {'dataset': xr.Dataset(), 'encoding': {}, 'replace': False, 'dropped': set()}
+        try:
+            yield self
+            write_batch = self._write_batch
+        finally:
+            self._write_batch = None
+        self._commit_write_batch(write_batch, atomic)
+
+    def _stage_write(self, data, mode='a', encoding=None):
+        if isinstance(data, xr.DataArray):
+            data = data.to_dataset()
+
+        if mode == 'w':
+            self._write_batch.update(dataset=data, encoding={}, replace=True, dropped=set())
+        else:
+            staged = self._write_batch['dataset']
+            staged = staged.drop_vars([name for name in data.variables if name in staged.variables])
+            self._write_batch['dataset'] = staged.merge(data, compat='override', combine_attrs='override')
+            self._write_batch['dropped'].difference_update(data.data_vars)
+        self._write_batch['encoding'].update(encoding or {})
+
+    def _commit_write_batch(self, write_batch, atomic=False):
+        annotations, staged = split_annotations(write_batch['dataset'])
+        replace = write_batch['replace']
+
+        if annotations.data_vars or write_batch['dropped'] or replace:
+            self._write_annotations(annotations, dropped=write_batch['dropped'], replace=replace)
+
+        if not staged.data_vars and not replace:
+            return
+
+        storage = self.storage
+        filepath = self.dataset_filepath
+        encoding = {**trace_storage_encoding(staged, **self.storage_configuration), **write_batch['encoding']}
+        encoding = {name: value for name, value in encoding.items() if name in staged.variables}
+        mode = 'a' if storage.exists(filepath) and not replace else 'w'
+
+        self.close_dataset()
+        if atomic or mode == 'w':
+            temporary_filepath = filepath.with_name(filepath.name + '.tmp')
+            try:
+                if mode == 'a':
+                    storage.copy(filepath, temporary_filepath)
+                storage.write(staged, temporary_filepath, mode=mode, encoding=encoding)
+                storage.replace(temporary_filepath, filepath)
+            finally:
+                storage.remove(temporary_filepath)
+        else:
+            storage.write(staged, filepath, mode=mode, encoding=encoding)
+
     def get_data(self, key):
-        with xr.open_dataset(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4') as dataset:
-            return dataset[key].load()
+        return self.load_variable(key)
 
     @property
     @return_none_when_executed_by_pycharm
     def dataset(self):
-        if self.absoluteFilePath.with_suffix('.nc').exists():
-            with xr.open_dataset(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4') as dataset:
-                return dataset.load()
+        if self.storage.exists(self.dataset_filepath) or self._write_batch is not None:
+            return self.current_dataset().copy().load()
         else:
             return None
 
@@ -303,8 +574,7 @@ class File:
     @property
     @return_none_when_executed_by_pycharm
     def data_vars(self):
-        with xr.open_dataset(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4') as dataset:
-            return dataset.data_vars
+        return self.current_dataset().data_vars
     # def get_coordinates(self, selected=False):
     #     if selected:
     #         molecules = self.selectedMolecules
@@ -337,8 +607,8 @@ class File:
         dataset = dataset.reset_index('molecule', drop=True)
         dataset = dataset.assign_coords({'file': ('molecule', [str(self.relativeFilePath).encode()] * number_of_molecules)})
         encoding = {'file': {'dtype': '|S'}, 'selected': {'dtype': bool}}
-        dataset.to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='w', encoding=encoding)
-        self.extensions.add('.nc')
+        self._write_dataset(dataset, mode='w', encoding=encoding)
+        self.extensions.add(self.storage.extension)
 
         # # pd.MultiIndex.from_tuples([], names=['molecule_in_file', 'file'])),
 
@@ -386,6 +656,9 @@ class File:
 
         rot90 = self.configuration['movie']['rot90']
         self.movie = Movie(filepath, rot90)
+        self.movie.use_dask = self.configuration['movie'].get('use_dask', False)
+        if self.storage.name != 'netcdf':
+            self.movie.storage = self.storage
 
         # self.number_of_frames = self.movie.number_of_frames
 
@@ -520,6 +793,10 @@ class File:
 
         use_sliding_window: type 'True' or 'False' to activate sliding window
 
+        channel_combination: for multiple channels with method 'by_channel', choose 'and' to keep molecules found in
+                             all channels, 'or' to keep molecules found in any channel, or the index of the channel
+                             of which the molecules are kept
+
 
         Additional configurations to be set
         (within 'peak_finding' section of configuration file)
@@ -537,6 +814,24 @@ class File:
         configuration_from_config_file.update(configuration)
         configuration = configuration_from_config_file
 
+        self.coordinates = self.determine_coordinates(configuration)
+
+    def determine_coordinates(self, configuration):
+        """Find the coordinates of the molecules without writing them to the file.
+
+        This performs all steps of `find_coordinates`, so that the coordinates can be determined in a separate process,
+        e.g. by `Experiment.find_coordinates_parallel`.
+
+        Parameters
+        ----------
+        configuration : dict
+            Complete find_coordinates configuration, as in the configuration file.
+
+        Returns
+        -------
+        xarray.DataArray
+            Coordinates with dimensions molecule, channel and dimension.
+        """
         # --- Get settings from configuration file ----
         channels = configuration['channels']
         method = configuration['method']
@@ -549,6 +844,15 @@ class File:
         use_sliding_window = configuration['sliding_window']['use_sliding_window']
         minimal_point_separation = sliding_window['minimal_point_separation']
 
+        channel_combination = configuration.get('channel_combination', 'and')
+        channel_combination_distance_threshold = configuration.get('channel_combination_distance_threshold', 2)
+
+        # The coordinates are mapped between the channels using the single mapping of the file
+        if self.movie.number_of_channels > 2:
+            raise ValueError(f'Finding coordinates is only possible for movies with one or two channels, as the '
+                             f'mapping of a file relates two channels; {self} has {self.movie.number_of_channels} '
+                             f'channels')
+
         # --- set illumination configuration
         #  An integer number for choosing one of the laser lines (the order of it first appeared)
         #  ex. Two laser lines (532 and 640) in Alex mode starting with 532 excitation: 0 for green and 1 for red
@@ -556,11 +860,17 @@ class File:
 
         # --- make the windows
         # (if no sliding windows, just a single window is made to make it compatible with next bit of code) ----
-        frame_ranges = [frame_range]
         if use_sliding_window:
-            start_frames = (frame_ranges[0][0], self.movie.number_of_frames, sliding_window['frame_increment'])
-            window_size = frame_ranges[0][1] - frame_ranges[0][0]
-            frame_ranges = frame_ranges + [window_size, window_size, 0] * np.arange(start_frames)[:, None]
+            # The movie is read once for all windows
+            window_size = (frame_range[1] or self.movie.number_of_frames) - frame_range[0]
+            start_frames = np.arange(frame_range[0], self.movie.number_of_frames, sliding_window['frame_increment'])
+            frame_ranges = [(start_frame, start_frame + window_size) for start_frame in start_frames]
+            projection_images = self.movie.iter_projection_images(frame_ranges, projection_type=projection_type,
+                                                                  illumination=illumination)
+        else:
+            projection_images = [(frame_range, self.get_projection_image(projection_type=projection_type,
+                                                                         frame_range=frame_range,
+                                                                         illumination=illumination))]
 
         # coordinates = set()
         if method == 'by_channel':
@@ -576,11 +886,8 @@ class File:
         # coordinate_sets = [set() for channel in channels]
 
         # --- Loop over all frames and find unique set of molecules ----
-        for frame_range in frame_ranges:
-
+        for frame_range, image in projection_images:
             # --- allowed to apply sliding window to either the max projection OR the averages ----
-            image = self.get_projection_image(projection_type=projection_type, frame_range=frame_range,
-                                              illumination=illumination)
 
             # image = self.average_image()
             self.movie.read_header()
@@ -635,24 +942,16 @@ class File:
 
                 coordinate_sets[i].update(channel_coordinates)
 
-        # Check whether points are found
-        for coordinate_set in coordinate_sets:
-            if len(coordinate_set) == 0:
-                # Reset current .nc file
-                self._init_dataset(0) # SHK: Creating a dummy dataset tp avoid errors in the downstream analysis
-                # This actually creates an empty dataset.
-                coordinates = xr.DataArray(np.empty((0, 2, 2)), dims=('molecule', 'channel', 'dimension'),
-                                    coords={'channel': [0, 1], 'dimension': [b'x', b'y']}, name='coordinates')
-                coordinates.to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
-                print('no peaks found')
-                return
-
         # --- correct for photon shot noise / stage drift ---
         # Not sure whether to put this in front of combine_coordinate_sets/detect_FRET_pairs or behind [IS: 12-08-2020]
         # I think before, as you would do it either for each window, or for the combined windows.
         # Transforming the coordinate sets for each window will be time consuming and changes the distance_threshold.
         # And you would like to combine the channel sets on the merged coordinates.
         for i in range(len(coordinate_sets)):
+            if len(coordinate_sets[i]) == 0:
+                coordinate_sets[i] = np.zeros((0, 2))
+                continue
+
             # --- turn into array ---
             coordinate_sets[i] = array_from_set_of_tuples(coordinate_sets[i])
 
@@ -661,34 +960,31 @@ class File:
                 coordinate_sets[i] = merge_nearby_coordinates(coordinate_sets[i], distance_threshold=minimal_point_separation)
 
             # Map coordinates to main channel in movie
-            # TODO: make this usable for any number of channels
-
-            coordinate_sets[i] = coordinate_sets[i]+self.movie.get_channel_from_name(channels[i]).boundaries[0]
-            if channels[i] in ['a', 'acceptor']:
-            # if i > 0: #i.e. if channel is not main channel # this didn't work when selecting only the acceptor channel
-                # Maybe we can do this earlier, right after point detection, then we need only a single coordinate_set
-                coordinate_sets[i] = self.mapping.transform_coordinates(coordinate_sets[i],
-                                                                        direction='Acceptor2Donor')
+            # Maybe we can do this earlier, right after point detection, then we need only a single coordinate_set
+            channel = self.movie.get_channel_from_name(channels[i])
+            coordinate_sets[i] = coordinate_sets[i]+channel.boundaries[0]
+            coordinate_sets[i] = self.transform_coordinates_to_main_channel(coordinate_sets[i], channel.index)
 
-        # TODO: make this usable for any number of channels
+        # Combine the coordinates found in the different channels, e.g. keep only molecules present in all channels
         if len(coordinate_sets) == 1:
             coordinates = coordinate_sets[0]
-        elif len(coordinate_sets) > 1:
-            raise NotImplementedError('Assessing found coordinates in multiple channels does not work properly yet')
-            # TODO: Make this function.
-            #  This can easily be done by creating a cKDtree for each coordinate set and
-            #  by finding the points close to each other
-            coordinates = combine_coordinate_sets(coordinate_sets, method='and')  # the old detect_FRET_pairs
+        else:
+            coordinates = combine_coordinate_sets(coordinate_sets, method=channel_combination,
+                                                  distance_threshold=channel_combination_distance_threshold)
+
+        # Check whether points are found
+        if len(coordinates) == 0:
+            # SHK: Creating a dummy dataset tp avoid errors in the downstream analysis
+            # This actually creates an empty dataset.
+            print('no peaks found')
+            return xr.DataArray(np.empty((0, 2, 2)), dims=('molecule', 'channel', 'dimension'),
+                                coords={'channel': [0, 1], 'dimension': [b'x', b'y']}, name='coordinates')
 
-        # TODO: make this usable for more than two channels
         # TODO: Use set_coordinates_of_channel
         coordinates_in_main_channel = coordinates
         coordinates_list = [coordinates]
-        for i in range(self.movie.number_of_channels)[1:]: # This for loop will only be useful once we make this usable for more than two channels
-            if self.movie.number_of_channels > 2:
-                raise NotImplementedError()
-            coordinates_in_other_channel = self.mapping.transform_coordinates(coordinates_in_main_channel, direction='Donor2Acceptor')
-            coordinates_list.append(coordinates_in_other_channel)
+        for i in range(self.movie.number_of_channels)[1:]:
+            coordinates_list.append(self.transform_coordinates_from_main_channel(coordinates_in_main_channel, i))
 
         coordinates = np.hstack(coordinates_list)
 
@@ -723,10 +1019,10 @@ class File:
 
         # if len(coordinates) !=0:
 
-        self.coordinates = coordinates
-
         # self.molecules.export_pks_file(self.relativeFilePath.with_suffix('.pks'))
 
+        return coordinates
+
     def determine_psf_size(self, method='gaussian_fit', projection_type='average', frame_range=(0,20), channel_index=0, illumination_index=0,
                            peak_finding_kwargs={'minimum_intensity_difference': 150}, maximum_radius=5):
         image = self.get_projection_image(projection_type=projection_type, frame_range=frame_range,
@@ -790,12 +1086,11 @@ class File:
     @property
     @return_none_when_executed_by_pycharm
     def coordinates(self):
-        if self.absoluteFilePath.with_suffix('.nc').exists():
-            with xr.open_dataset(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4') as dataset:
-                if hasattr(dataset, 'coordinates'):
-                    return dataset['coordinates'].load()
-                else:
-                    return None
+        if self.storage.exists(self.dataset_filepath):
+            if 'coordinates' in self.current_dataset():
+                return self.load_variable('coordinates')
+            else:
+                return None
         else:
             return None
 
@@ -804,7 +1099,7 @@ class File:
         # Reset current .nc file
         self._init_dataset(len(coordinates.molecule))
 
-        coordinates.drop('file', errors='ignore').to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+        self._write_dataset(coordinates.drop('file', errors='ignore'), mode='a')
         # self.extract_background()
 
         # self.molecules.export_pks_file(self.absoluteFilePath.with_suffix('.pks'))
@@ -864,7 +1159,7 @@ class File:
         background = xr.DataArray(background_list, dims=['illumination', 'molecule', 'channel'], name='background')
         # END modified
 
-        background.to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+        self._write_dataset(background, mode='a')
         sys.stdout.write(f'\r   background calculated {self}\n')
 
     def import_excel_file(self, filename=None):
@@ -939,7 +1234,10 @@ class File:
         # coordinates = self.coordinates - channel_offsets
 
         intensity = extract_traces(self.movie, self.coordinates, background=None, mask_size=mask_size,
-                                   neighbourhood_size=neighbourhood_size, correct_illumination=False)
+                                   neighbourhood_size=neighbourhood_size, correct_illumination=False,
+                                   chunk_size=configuration.get('chunk_size'),
+                                   maximum_chunk_memory=configuration.get('maximum_chunk_memory'),
+                                   dtype=self.storage_configuration['dtype'])
 
         if self.movie.time is not None: # hasattr(self.movie, 'time')
             intensity = intensity.assign_coords(time=self.movie.time)
@@ -947,40 +1245,43 @@ class File:
         # if self.movie.illumination is not None:
         intensity = intensity.assign_coords(illumination=self.movie.illumination_index_per_frame)
 
-        intensity.to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+        # All resulting variables are written at once, so that the file is not left half-written
+        with self.batch_write():
+            self._write_dataset(intensity, mode='a')
 
-        if 'intensity_raw' in self.data_vars:
-            intensity_raw = self.intensity
-            intensity_raw.name = 'intensity_raw'
-            intensity_raw.to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+            if 'intensity_raw' in self.data_vars:
+                intensity_raw = self.intensity
+                intensity_raw.name = 'intensity_raw'
+                self._write_dataset(intensity_raw, mode='a')
 
-        if background_correction is not None or alpha_correction is not None or gamma_correction is not None:
-            self.apply_trace_corrections(background_correction, alpha_correction, gamma_correction)
+            if background_correction is not None or alpha_correction is not None or gamma_correction is not None:
+                self.apply_trace_corrections(background_correction, alpha_correction, gamma_correction)
 
-        if self.movie.number_of_channels > 1:
-            self.calculate_FRET()
+            if self.movie.number_of_channels > 1:
+                self.calculate_FRET()
 
     def apply_trace_corrections(self, background_correction=None, alpha_correction=None,
                        gamma_correction=None):
         from papylio.trace_correction import trace_correction
 
-        if 'intensity_raw' in self.data_vars:
-            intensity_raw = self.intensity_raw
-        else:
-            intensity_raw = self.intensity
-            intensity_raw.name = 'intensity_raw'
-            intensity_raw.to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+        with self.batch_write():
+            if 'intensity_raw' in self.data_vars:
+                intensity_raw = self.intensity_raw
+            else:
+                intensity_raw = self.intensity
+                intensity_raw.name = 'intensity_raw'
+                self._write_dataset(intensity_raw, mode='a')
 
-        intensity = trace_correction(intensity_raw, background_correction, alpha_correction, gamma_correction)
-        intensity.name = 'intensity'
-        intensity.to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+            intensity = trace_correction(intensity_raw, background_correction, alpha_correction, gamma_correction)
+            intensity.name = 'intensity'
+            self._write_dataset(intensity, mode='a')
 
-        if 'FRET' in self.data_vars:
-            self.calculate_FRET()
+            if 'FRET' in self.data_vars:
+                self.calculate_FRET()
 
     def calculate_FRET(self):
         FRET = calculate_FRET(self.intensity)
-        FRET.to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+        self._write_dataset(FRET, mode='a')
 
     def get_traces(self, selected=False):
         dataset = self.dataset
@@ -1007,7 +1308,7 @@ class File:
             variable = getattr(self, variable)
 
         ds = hidden_markov_modelling(variable, self.classification, self.selected, n_states=n_states, threshold_state_mean=threshold_state_mean, level=level)
-        ds.to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+        self._write_dataset(ds, mode='a')
 
     def plot_hmm_rates(self, name=None):
         if name is None:
@@ -1047,22 +1348,23 @@ class File:
         figure.savefig(file_path)
 
     def save_dataset_selected(self):
-        encoding = {'file': {'dtype': '|S'}, 'selected': {'dtype': bool}}
-        self.dataset_selected.to_netcdf(self.absoluteFilePath.parent / (self.name + '_selected.nc'), engine='netcdf4', mode='w', encoding=encoding)
+        dataset_selected = self.dataset_selected
+        encoding = {'file': {'dtype': '|S'}, 'selected': {'dtype': bool},
+                    **trace_storage_encoding(dataset_selected, **self.storage_configuration)}
+        dataset_selected.to_netcdf(self.absoluteFilePath.parent / (self.name + '_selected.nc'), engine='netcdf4', mode='w', encoding=encoding)
 
     def import_pks_file(self, extension):
         peaks = import_pks_file(self.absoluteFilePath.with_suffix('.pks'))
         peaks = split_dimension(peaks, 'peak', ('molecule', 'channel'), (-1, 2)).reset_index('molecule', drop=True)
         # peaks = split_dimension(peaks, 'molecule', ('molecule_in_file', 'file'), (-1, 1), (-1, [file]), to='multiindex')
 
-        if not self.absoluteFilePath.with_suffix('.nc').is_file():
+        if not self.storage.exists(self.dataset_filepath):
             self._init_dataset(len(peaks.molecule))
 
         coordinates = peaks.sel(parameter=['x', 'y']).rename(parameter='dimension')
         background = peaks.sel(parameter='background', drop=True)
 
-        xr.Dataset({'coordinates': coordinates, 'background': background})\
-            .to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+        self._write_dataset(xr.Dataset({'coordinates': coordinates, 'background': background}), mode='a')
 
     def export_pks_file(self):
         peaks = xr.merge([self.coordinates.to_dataset('dimension'), self.background.to_dataset()])\
@@ -1075,10 +1377,10 @@ class File:
         intensity = split_dimension(traces, 'trace', ('molecule', 'channel'), (-1, 2))\
             .reset_index(['molecule','frame'], drop=True)
 
-        if not self.absoluteFilePath.with_suffix('.nc').is_file():
+        if not self.storage.exists(self.dataset_filepath):
             self._init_dataset(len(intensity.molecule))
 
-        xr.Dataset({'intensity': intensity}).to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+        self._write_dataset(xr.Dataset({'intensity': intensity}), mode='a')
 
     def export_traces_file(self):
         traces = self.intensity.stack(trace=('molecule', 'channel')).T
@@ -1170,7 +1472,8 @@ class File:
 
         if 'coordinates_after_gaussian_fit' in configuration['coordinate_optimization']:
             gaussian_width = configuration['coordinate_optimization']['coordinates_after_gaussian_fit']['gaussian_width']
-            coordinates = coordinates_after_gaussian_fit(coordinates, image, gaussian_width)
+            sigma = configuration['coordinate_optimization']['coordinates_after_gaussian_fit'].get('sigma', None)
+            coordinates = coordinates_after_gaussian_fit(coordinates, image, gaussian_width, sigma=sigma)
 
         if 'coordinates_without_intensity_at_radius' in configuration['coordinate_optimization']:
             coordinates = coordinates_without_intensity_at_radius(coordinates, image,
@@ -1247,7 +1550,7 @@ class File:
         for file in self.experiment.selectedFiles:
             if file is not self:
                 file._init_dataset(len(self.molecule))
-                self.coordinates.to_netcdf(file.absoluteFilePath.with_suffix('.nc'), engine='netcdf4')
+                file._write_dataset(self.coordinates, mode='w')
 
     def use_mapping_for_all_files(self):
         print(f"\n{self} used as mapping")
@@ -1265,16 +1568,21 @@ class File:
     #         with xr.open_dataset(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4') as dataset:
     #             da = dataset[variable].load()
     #
-    def get_variable(self, variable, selected=False, frame_range=None, average=False, return_none_if_nonexistent=False):
-        # TODO: make it possible to also select the channel (or perform other selections), e.g. by passing 'intensity_c0'.
+    def get_variable(self, variable, selected=False, frame_range=None, channel=None, average=False,
+                     return_none_if_nonexistent=False):
         """
         Get a variable.
 
+        Selections are applied before the data is loaded, so that only the requested part of the variable is read from
+        the netCDF file.
+
         Parameters:
             variable (str): The name of the variable to retrieve.
             selected (bool, optional): Whether to return only selected molecules. Default is False.
             frame_range (tuple, optional): In case the returned variable has dimension 'frame', frame_range can be used
                 to select the desired frames. Default is None.
+            channel (int or list of int, optional): In case the returned variable has dimension 'channel', channel can be
+                used to select the desired channel(s). Default is None.
             average (bool or str, optional): Whether to calculate the average of the variable over a specific dimension.
                 If a string is provided, it represents the dimension to average over. Default is False.
             return_none_if_nonexistent (bool, optional): Whether to return None if the variable does not exist in the object.
@@ -1284,29 +1592,79 @@ class File:
             xarray.DataArray: The requested variable.
 
         """
-        if return_none_if_nonexistent and not hasattr(self, variable):
+        if variable == 'intensity_total':
+            intensity = self.get_variable('intensity', selected=selected, frame_range=frame_range, channel=channel,
+                                          return_none_if_nonexistent=return_none_if_nonexistent)
+            if intensity is None:
+                return None
+            da = calculate_intensity_total(intensity)
+            return self._average_variable(da, average)
+
+        if self.storage.exists(self.dataset_filepath) and variable in self.current_dataset().data_vars:
+            if selected is False and frame_range is None and channel is None:
+                # The whole variable is read, which is cached by load_variable
+                da = self.load_variable(variable)
+            else:
+                # Lazily indexed, the data is only read upon loading. The shallow copy makes sure that loading does not
+                # replace the data in the cached dataset.
+                da = self.current_dataset()[variable].copy(deep=False)
+        elif return_none_if_nonexistent and not hasattr(self, variable):
             return None
+        else:
+            da = getattr(self, variable)
 
-        da = getattr(self, variable)
-
-        if selected is not False:
+        if selected is not False and 'molecule' in da.dims:
             if selected is True:
                 selected = self.selected
-            da = da.sel(molecule=selected)
+            selected = np.asarray(selected)
+            if selected.dtype == bool:
+                da = da.isel(molecule=np.flatnonzero(selected))
+            else:
+                da = da.sel(molecule=selected)
 
-        if frame_range is not None:
+        if frame_range is not None and 'frame' in da.dims:
             da = da.sel(frame=slice(*frame_range))
 
-        if average:
-            da = da.mean(dim=average)
-            if average == 'molecule':
-                da = da.expand_dims({'name': [self.name]}, 0)
+        if channel is not None and 'channel' in da.dims:
+            da = da.sel(channel=channel)
+
+        return self._average_variable(da, average)
+
+    # Maximum number of bytes read at once when averaging a variable
+    maximum_read_chunk_size = 2**26
+
+    def _average_variable(self, da, average):
+        if not average:
+            return da.copy(deep=False).load()
+
+        if 'molecule' not in da.dims or da.sizes['molecule'] == 0:
+            da = da.copy(deep=False).load().mean(dim=average)
+        else:
+            bytes_per_molecule = da.dtype.itemsize * da.size // da.sizes['molecule']
+            chunk_size = max(1, self.maximum_read_chunk_size // max(bytes_per_molecule, 1))
+            chunk_slices = [slice(i, i + chunk_size) for i in range(0, da.sizes['molecule'], chunk_size)]
+
+            average_dims = [average] if isinstance(average, str) else list(average)
+            if 'molecule' in average_dims:
+                # Accumulate sum and count over the chunks to obtain the mean
+                total, count = 0, 0
+                for chunk_slice in chunk_slices:
+                    chunk = da.isel(molecule=chunk_slice).load()
+                    total = total + chunk.sum(dim=average)
+                    count = count + chunk.count(dim=average)
+                da = (total / count).rename(da.name)
+            else:
+                da = xr.concat([da.isel(molecule=chunk_slice).load().mean(dim=average)
+                                for chunk_slice in chunk_slices], dim='molecule')
+
+        if average == 'molecule':
+            da = da.expand_dims({'name': [self.name]}, 0)
 
         return da
 
     def set_variable(self, data, **kwargs):
         da = xr.DataArray(data, **kwargs)
-        da.to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+        self._write_dataset(da, mode='a')
 
     @property
     @return_none_when_executed_by_pycharm
@@ -1316,17 +1674,14 @@ class File:
     @property
     @return_none_when_executed_by_pycharm
     def selections(self):
-        with xr.open_dataset(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4') as dataset:
-            return xr.Dataset({value.name: value for key, value in dataset.data_vars.items()
-                               if key.startswith('selection')}).to_array(dim='selection')
+        return self.selections_dataset.to_array(dim='selection')
         # return xr.concat([value for key, value in self.dataset.data_vars.items() if key.startswith('filter')], dim='filter')
 
     @property
     @return_none_when_executed_by_pycharm
     def selections_dataset(self):
-        with xr.open_dataset(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4') as dataset:
-            return xr.Dataset({value.name: value for key, value in dataset.data_vars.items()
-                               if key.startswith('selection')})
+        return xr.Dataset({name: self.load_variable(name) for name in self.current_dataset().data_vars.keys()
+                           if name.startswith('selection')})
         # return xr.concat([value for key, value in self.dataset.data_vars.items() if key.startswith('filter')], dim='filter')
 
     def add_selection(self, variable, channel, aggregator, operator, threshold):
@@ -1362,18 +1717,17 @@ class File:
                                          self.selections_dataset.data_vars.items()]
         for file in self.experiment.selectedFiles:
             if file is not self:
-                for name, selection_parameters in name_and_selection_parameters:
-                    file.add_selection(**selection_parameters)
-                file.apply_selections(selection_names=self.selection_names)
+                with file.batch_write():
+                    for name, selection_parameters in name_and_selection_parameters:
+                        file.add_selection(**selection_parameters)
+                    file.apply_selections(selection_names=self.selection_names)
 
     @property
     def selection_names(self):
         return self.selected.attrs['selection_names']
 
     def clear_selections(self):
-        dataset = self.dataset
-        dataset = dataset.drop_vars([name for name in dataset.data_vars.keys() if name.startswith('selection_')])
-        dataset.to_netcdf(self.absoluteFilePath.with_suffix('.nc'))
+        self.delete_variables([name for name in self.data_vars.keys() if name.startswith('selection_')])
 
     def apply_selections(self, selection_names='all'):
         invert = np.zeros(len(selection_names), bool)
@@ -1639,9 +1993,11 @@ class File:
         - The function uses the `marginal_hist2d` function from the `papylio.plotting` module for visualization.
         """
 
-        intensity_x = self.get_variable('intensity', selected=selected, frame_range=frame_range, average=average).sel(channel=channel_x)
+        intensity_x = self.get_variable('intensity', selected=selected, frame_range=frame_range, channel=channel_x,
+                                        average=average)
         intensity_x.name = intensity_x.name + f'_c{channel_x}'
-        intensity_y = self.get_variable('intensity', selected=selected, frame_range=frame_range, average=average).sel(channel=channel_y)
+        intensity_y = self.get_variable('intensity', selected=selected, frame_range=frame_range, channel=channel_y,
+                                        average=average)
         intensity_y.name = intensity_y.name + f'_c{channel_y}'
 
         marginal_hist2d_kwargs_default = dict(range=(None, None))
@@ -1813,7 +2169,7 @@ class File:
             selected_original = dataset.selected
 
         # We could also save the whole dataset, but since currently only alterations are made to selected.
-        selected_original.to_netcdf(self.absoluteFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+        self._write_dataset(selected_original, mode='a')
 
 
 def calculate_intensity_total(intensity):
@@ -1840,6 +2196,96 @@ def calculate_stoichiometry(intensity):
     stoichiometry.name = 'stoichiometry'
     return stoichiometry
 
+# Variables resulting from hidden markov modelling, which are stored as annotations
+hmm_variable_names = ['number_of_states', 'state_mean', 'state_standard_deviation', 'transition_probability',
+                      'start_probability', 'end_probability', 'transition_rate']
+
+
+def is_annotation(name):
+    """Whether a variable is an annotation, i.e. a selection, classification or HMM result."""
+    return name.startswith('selection_') or name.startswith('classification') or name in hmm_variable_names
+
+
+def split_annotations(dataset):
+    """Split a dataset in the annotation variables and the remaining variables.
+
+    Coordinates along the molecule and frame dimensions, such as molecule_in_file and time, are kept with the
+    remaining variables only, as these are already present in the .nc file.
+    """
+    annotation_names = [name for name in dataset.data_vars if is_annotation(name)]
+    annotations = dataset[annotation_names]
+    annotations = annotations.drop_vars([name for name, coordinate in annotations.coords.items()
+                                         if name not in annotations.dims and {'molecule', 'frame'} & set(coordinate.dims)])
+    return annotations, dataset.drop_vars(annotation_names)
+
+
+def merge_annotations(dataset, annotations=None):
+    """Merge the annotations into a dataset, annotations replace variables with the same name in the dataset."""
+    if annotations is None:
+        return dataset
+    dataset = dataset.drop_vars([name for name in annotations.data_vars if name in dataset.variables])
+    return dataset.merge(annotations, compat='override', combine_attrs='override')
+
+
+default_trace_storage_configuration = dict(dtype='float32', chunk_molecules=64, chunk_frames=1024, shuffle=True,
+                                          compression='zlib', complevel=4)
+
+
+def trace_storage_encoding(data, dtype='float32', chunk_molecules=64, chunk_frames=1024, shuffle=True,
+                           compression='zlib', complevel=4):
+    """Netcdf encoding for the trace variables, i.e. variables with both a molecule and a frame dimension.
+
+    Chunks span a limited number of molecules and frames, so that reading the trace of a single molecule as well as
+    reading a single frame for all molecules only touches a small part of the variable.
+
+    Parameters
+    ----------
+    data : xarray.Dataset or xarray.DataArray
+        Data to be written.
+    dtype : str, optional
+        Data type of the stored traces, by default float32. Use None to keep the data type of the data.
+    chunk_molecules : int, optional
+        Number of molecules per chunk.
+    chunk_frames : int, optional
+        Number of frames per chunk.
+    shuffle : bool, optional
+        Whether to apply the HDF5 shuffle filter before compression.
+    compression : str, optional
+        Compression method, e.g. 'zlib' or one of the blosc methods such as 'blosc_lz4' (requires netCDF4 >= 1.6).
+        Use None for no compression.
+    complevel : int, optional
+        Compression level between 1 and 9.
+
+    Returns
+    -------
+    dict
+        Encoding per variable, to be passed to `to_netcdf`.
+    """
+    if isinstance(data, xr.DataArray):
+        data = data.to_dataset(name=data.name)
+
+    chunk_sizes = {'molecule': chunk_molecules, 'frame': chunk_frames}
+
+    encoding = {}
+    for name, data_array in data.data_vars.items():
+        if not ('molecule' in data_array.dims and 'frame' in data_array.dims):
+            continue
+        variable_encoding = {}
+        if dtype is not None and data_array.dtype.kind == 'f':
+            variable_encoding['dtype'] = dtype
+        if data_array.size > 0:
+            variable_encoding['chunksizes'] = tuple(min(chunk_sizes.get(dim, size), size)
+                                                    for dim, size in data_array.sizes.items())
+            if compression is not None:
+                variable_encoding['shuffle'] = shuffle
+                if compression == 'zlib':
+                    variable_encoding.update(zlib=True, complevel=complevel)
+                else:
+                    variable_encoding.update(compression=compression, complevel=complevel)
+        encoding[name] = variable_encoding
+    return encoding
+
+
 def import_pks_file(pks_filepath):
     pks_filepath = Path(pks_filepath)
     data = np.genfromtxt(pks_filepath)
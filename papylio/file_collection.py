@@ -1,7 +1,9 @@
 from objectlist import ObjectList
+from pathlib import Path
 
 from papylio.file import File
-from papylio.netcdf_operations import merge_datasets, reorder_datasets_using_sequence_subset
+from papylio.netcdf_operations import merge_datasets, reorder_datasets_using_sequence_subset, group_by_sequence_subset
+from papylio.storage import write_merged_dataset
 
 import numpy as np
 import xarray as xr
@@ -60,13 +62,44 @@ class FileCollection(ObjectList):
 
     def merge_datasets(self, filepath_out=None, init_file_index=0, with_selected_only=False, with_sequence_only=False):
         #TODO: remove sequencing part, or move to the sequencing plugin
+        storage = self[0].storage
         if filepath_out is None:
-            filepath_out = self[0].absoluteFilePath.parent / 'merged_dataset.nc'
-        filepaths_in = self.serial.absoluteFilePath.with_suffix('.nc')
-        merge_datasets(filepaths_in, filepath_out, concat_dim='molecule', init_file=filepaths_in[init_file_index],
-                       with_selected_only=with_selected_only, with_sequence_only=with_sequence_only)
+            filepath_out = self[0].absoluteFilePath.parent / ('merged_dataset' + storage.extension)
+
+        if storage.name == 'netcdf':
+            filepaths_in = self.serial.dataset_filepath
+            merge_datasets(filepaths_in, filepath_out, concat_dim='molecule', init_file=filepaths_in[init_file_index],
+                           with_selected_only=with_selected_only, with_sequence_only=with_sequence_only,
+                           annotation_files_in=self.serial.annotations_filepath)
+        else:
+            datasets = []
+            for file in self:
+                dataset = file.open_dataset()
+                if with_selected_only:
+                    dataset = dataset.isel(molecule=np.flatnonzero(dataset['selected'].values))
+                elif with_sequence_only:
+                    dataset = dataset.isel(molecule=np.flatnonzero(dataset['sequence_tile'].values > 0))
+                datasets.append(dataset)
+            write_merged_dataset(datasets, filepath_out, storage, concat_dim='molecule')
 
     def reorder_datasets_using_sequence_subset(self, folderpath_out):
         files = self[self.has_sequencing_match]
-        filepaths_in = files.serial.absoluteFilePath.with_suffix('.nc')
-        reorder_datasets_using_sequence_subset(filepaths_in, folderpath_out, concat_dim='molecule')
\ No newline at end of file
+        storage = files[0].storage
+        if storage.name == 'netcdf':
+            reorder_datasets_using_sequence_subset(files.serial.dataset_filepath, folderpath_out, concat_dim='molecule',
+                                                   annotation_files_in=files.serial.annotations_filepath)
+        else:
+            folderpath_out = Path(folderpath_out)
+            folderpath_out.mkdir(exist_ok=False)
+            datasets_per_sequence_subset = {}
+            for file in files:
+                dataset = file.open_dataset()
+                sequence_subsets = dataset['sequence_subset'].values
+                if sequence_subsets.ndim == 1:
+                    # Character arrays are decoded to strings, which are split into characters again
+                    sequence_subsets = sequence_subsets.astype('S')[:, None].view('S1')
+                for sequence_subset, indices in group_by_sequence_subset(sequence_subsets).items():
+                    datasets_per_sequence_subset.setdefault(sequence_subset, []).append(dataset.isel(molecule=indices))
+            for sequence_subset, datasets in datasets_per_sequence_subset.items():
+                write_merged_dataset(datasets, folderpath_out / (sequence_subset + storage.extension), storage,
+                                     concat_dim='molecule')
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""Cached discovery of the files in an experiment folder
+
+Finding the files in an experiment requires listing all folders below the main path, which can be slow on network
+drives for experiments with many files. The manifest stores the listing of each folder together with its modification
+time. The modification time of a folder changes when files or folders are added, removed or renamed in it, so upon
+opening the experiment only folders with a different modification time are listed again. A file added shortly after
+a folder was listed may not change the modification time of the folder, due to the limited time resolution of the file
+system. Therefore, folders modified shortly before they were listed are listed again as well. In addition, the number of
+fields of view of nd2 files is stored, which otherwise requires reading the nd2 metadata.
+
+Per file, no information is stored, as creating the files of an experiment does not access the files themselves; the
+movie headers are only read when needed.
+
+The manifest is stored as a hidden file in the experiment folder, and can be switched off in the configuration file:
+
+    files:
+        use_manifest: False
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+
+
+class FileManifest:
+    version = 2
+    # Time resolution of the folder modification times, e.g. 2 s for FAT file systems and some network drives
+    time_resolution = 2 * 10**9
+
+    def __init__(self, main_path, filepath=None):
+        self.main_path = Path(main_path)
+        if filepath is None:
+            # Hidden file, so that it is not imported as a file in the experiment
+            filepath = self.main_path / '.papylio_manifest.json'
+        self.filepath = Path(filepath)
+        self.directories = {}
+        self.fields_of_view = {}
+        self.is_changed = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filepath, 'r') as json_file:
+                manifest = json.load(json_file)
+        except (FileNotFoundError, ValueError):
+            return
+        if manifest.get('version') == self.version:
+            self.directories = manifest['directories']
+            self.fields_of_view = manifest['fields_of_view']
+
+    def save(self):
+        manifest = {'version': self.version, 'directories': self.directories, 'fields_of_view': self.fields_of_view}
+        # Written in place, as replacing the file would change the modification time of the main folder.
+        # An incompletely written manifest is discarded upon loading.
+        with open(self.filepath, 'w') as json_file:
+            json.dump(manifest, json_file)
+        self.is_changed = False
+
+    def paths(self):
+        """Absolute paths of all files and Zarr stores below the main path, excluding hidden folders.
+
+        Only folders of which the modification time changed since the last call, or which were modified shortly before
+        they were last listed, are listed again.
+
+        Returns
+        -------
+        list of pathlib.Path
+        """
+        directories = {}
+        paths = []
+        relative_folder_paths = [Path('.')]
+        while relative_folder_paths:
+            relative_folder_path = relative_folder_paths.pop()
+            folder_path = self.main_path / relative_folder_path
+            try:
+                modification_time = folder_path.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            directory = self.directories.get(relative_folder_path.as_posix())
+            if directory is None or directory['modification_time'] != modification_time or \
+                    modification_time >= directory['listing_time'] - self.time_resolution:
+                directory = {'modification_time': modification_time, 'listing_time': time.time_ns(),
+                             'files': [], 'folders': []}
+                with os.scandir(folder_path) as entries:
+                    for entry in entries:
+                        directory['folders' if entry.is_dir() else 'files'].append(entry.name)
+            directories[relative_folder_path.as_posix()] = directory
+
+            paths += [folder_path / name for name in directory['files']]
+            for name in directory['folders']:
+                if Path(name).suffix == '.zarr':
+                    # Zarr stores are directories, the files inside them are not included
+                    paths.append(folder_path / name)
+                elif not name.startswith('.'):
+                    relative_folder_paths.append(relative_folder_path / name)
+
+        if directories != self.directories:
+            self.directories = directories
+            self.is_changed = True
+
+        relative_filepaths = {path.relative_to(self.main_path).as_posix() for path in paths}
+        removed_filepaths = [filepath for filepath in self.fields_of_view if filepath not in relative_filepaths]
+        for filepath in removed_filepaths:
+            self.fields_of_view.pop(filepath)
+            self.is_changed = True
+
+        return paths
+
+    def number_of_fov(self, relative_filepath):
+        """Number of fields of view of an nd2 file, read from the file only if it changed since the last call."""
+        filepath = self.main_path / relative_filepath
+        stat = filepath.stat()
+        signature = [stat.st_size, stat.st_mtime_ns]
+        key = Path(relative_filepath).as_posix()
+
+        fields_of_view = self.fields_of_view.get(key)
+        if fields_of_view is None or fields_of_view['signature'] != signature:
+            from papylio.movie.movie import Movie
+            fields_of_view = {'signature': signature, 'number_of_fov': int(Movie(filepath).number_of_fov)}
+            self.fields_of_view[key] = fields_of_view
+            self.is_changed = True
+        return fields_of_view['number_of_fov']
@@ -0,0 +1,214 @@
+"""Experiment-wide table with a row for each molecule
+
+The molecule index contains, for each molecule in the experiment, the file and molecule_in_file, its coordinates,
+the trace averages, the selections and classifications, the HMM summary and other per-molecule variables such as the
+sequence. The index is stored in the experiment folder and is updated incrementally: only files of which the dataset
+changed since the last update are read again. This allows fast queries over all molecules in an experiment without
+opening each file.
+
+Examples
+--------
+>>> exp = Experiment(main_path)
+>>> exp.molecule_index.query('selected and FRET_mean > 0.6 and sequence == "HJ7"')
+"""
+
+import json
+import os
+import itertools
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+class MoleculeIndex:
+    # Variables with more values per molecule (apart from the frame dimension) are not included in the index
+    maximum_columns_per_variable = 16
+
+    def __init__(self, experiment, filepath=None):
+        self.experiment = experiment
+        if filepath is None:
+            # Hidden file, so that it is not imported as a file in the experiment
+            filepath = experiment.main_path / '.molecule_index.nc'
+        self.filepath = filepath
+        self.table = pd.DataFrame()
+        self.file_signatures = {}
+        self.load()
+
+    def __len__(self):
+        return len(self.table)
+
+    def load(self):
+        if self.filepath.is_file():
+            with xr.open_dataset(self.filepath, engine='netcdf4') as dataset:
+                self.table = dataset.to_dataframe().reset_index(drop=True)
+                self.file_signatures = json.loads(dataset.attrs.get('file_signatures', '{}'))
+
+    def save(self):
+        dataset = xr.Dataset.from_dataframe(self.table.reset_index(drop=True)).rename(index='molecule')
+        dataset.attrs['file_signatures'] = json.dumps(self.file_signatures)
+        temporary_filepath = self.filepath.with_name(self.filepath.name + '.tmp')
+        dataset.to_netcdf(temporary_filepath, engine='netcdf4', mode='w')
+        os.replace(temporary_filepath, self.filepath)
+
+    def update(self, files=None, save=True):
+        """Update the rows of the files of which the dataset changed since the last update.
+
+        Parameters
+        ----------
+        files : FileCollection, optional
+            Files to update, by default all files in the experiment. Rows of files that are no longer in the experiment
+            are removed when all files are updated.
+        save : bool, optional
+            Whether to store the updated index, by default True.
+
+        Returns
+        -------
+        MoleculeIndex
+        """
+        if files is None:
+            files = self.experiment.files
+            file_names = {str(file.relativeFilePath) for file in files}
+            removed_file_names = [file_name for file_name in self.file_signatures if file_name not in file_names]
+        else:
+            removed_file_names = []
+
+        tables = {}
+        for file in files:
+            file_name = str(file.relativeFilePath)
+            signature = dataset_signature(file)
+            if signature is None:
+                if file_name in self.file_signatures:
+                    removed_file_names.append(file_name)
+            elif signature != self.file_signatures.get(file_name):
+                tables[file_name] = molecule_table(file, self.maximum_columns_per_variable)
+                self.file_signatures[file_name] = signature
+
+        if not tables and not removed_file_names:
+            return self
+
+        for file_name in removed_file_names:
+            self.file_signatures.pop(file_name, None)
+
+        tables_unchanged = []
+        if len(self.table) > 0:
+            unchanged = ~self.table['file'].isin(list(tables.keys()) + removed_file_names)
+            if unchanged.any():
+                tables_unchanged.append(self.table[unchanged])
+        if tables_unchanged or tables:
+            self.table = pd.concat(tables_unchanged + list(tables.values()), ignore_index=True)
+        else:
+            self.table = pd.DataFrame()
+        self.table = fill_missing_values(self.table)
+
+        if save:
+            self.save()
+        return self
+
+    def query(self, expression=None, **kwargs):
+        """Select molecules using a pandas query expression on the columns of the index.
+
+        Parameters
+        ----------
+        expression : str, optional
+            Query expression, e.g. 'selected and FRET_mean > 0.6'. If None, the complete table is returned.
+        kwargs
+            Keyword arguments passed to `pandas.DataFrame.query`.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Selected rows of the index.
+        """
+        if expression is None:
+            return self.table.copy()
+        return self.table.query(expression, **kwargs)
+
+    def molecules_per_file(self, table=None):
+        """Molecule_in_file indices per file, e.g. for the result of a query."""
+        if table is None:
+            table = self.table
+        return {file_name: group['molecule_in_file'].values for file_name, group in table.groupby('file', sort=False)}
+
+
+def dataset_signature(file):
+    storage = file.storage
+    if not storage.exists(file.dataset_filepath):
+        return None
+    signature = [storage.modification_time(file.dataset_filepath)]
+    if storage.exists(file.annotations_filepath):
+        signature.append(storage.modification_time(file.annotations_filepath))
+    return signature
+
+
+def molecule_table(file, maximum_columns_per_variable=16):
+    """Table with a row for each molecule in a file, containing the per-molecule values of the file variables.
+
+    Variables with only a molecule dimension are included as they are, variables with a frame dimension are averaged
+    over the frames. Remaining dimensions, such as channel, are split over multiple columns, e.g. intensity_c0_mean.
+    """
+    dataset = file.open_dataset()
+    number_of_molecules = dataset.sizes.get('molecule', 0)
+
+    columns = {'file': np.full(number_of_molecules, str(file.relativeFilePath), dtype=object)}
+    if 'molecule_in_file' in dataset.coords:
+        columns['molecule_in_file'] = dataset['molecule_in_file'].values
+    else:
+        columns['molecule_in_file'] = np.arange(number_of_molecules)
+
+    for name, data_array in dataset.data_vars.items():
+        if 'molecule' not in data_array.dims:
+            continue
+        if 'frame' in data_array.dims:
+            if data_array.dtype.kind != 'f':
+                continue
+            columns.update(split_columns(file.get_variable(name, average='frame'), name, '_mean',
+                                         maximum_columns_per_variable))
+        else:
+            columns.update(split_columns(data_array, name, '', maximum_columns_per_variable))
+
+    if 'intensity_c0_mean' in columns:
+        columns['intensity_total_mean'] = np.sum([values for column_name, values in columns.items()
+                                                  if column_name.startswith('intensity_c')
+                                                  and column_name.endswith('_mean')], axis=0)
+
+    return pd.DataFrame(columns)
+
+
+def split_columns(data_array, name, suffix='', maximum_columns=16):
+    other_dims = [dim for dim in data_array.dims if dim != 'molecule']
+    if np.prod([data_array.sizes[dim] for dim in other_dims]) > maximum_columns:
+        return {}
+
+    columns = {}
+    for indices in itertools.product(*[range(data_array.sizes[dim]) for dim in other_dims]):
+        labels = []
+        for dim, index in zip(other_dims, indices):
+            label = data_array[dim].values[index] if dim in data_array.coords else index
+            label = label.decode() if isinstance(label, bytes) else label
+            labels.append(f'c{label}' if dim == 'channel' else str(label))
+        values = data_array[dict(zip(other_dims, indices))].values
+        columns['_'.join([name] + labels) + suffix] = decode_values(values)
+    return columns
+
+
+def decode_values(values):
+    if values.dtype.kind == 'S':
+        return values.astype('U').astype(object)
+    elif values.dtype.kind == 'U':
+        return values.astype(object)
+    return values
+
+
+def fill_missing_values(table):
+    # Files can have different variables, missing values are filled such that each column has a single data type.
+    for column_name in table.columns:
+        column = table[column_name]
+        if not column.isna().any():
+            continue
+        values = column.dropna()
+        if len(values) > 0 and values.map(lambda value: isinstance(value, (bool, np.bool_))).all():
+            table[column_name] = column.fillna(False).astype(bool)
+        elif len(values) > 0 and values.map(lambda value: isinstance(value, str)).all():
+            table[column_name] = column.fillna('')
+    return table
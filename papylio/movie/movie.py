@@ -1,5 +1,8 @@
 import re
 import sys
+import hashlib
+import queue
+import threading
 import itertools
 import warnings
 import tqdm
@@ -19,6 +22,7 @@ from skimage.transform import AffineTransform
 from papylio.movie.background_correction import determine_temporal_background_correction, \
     determine_spatial_background_correction, determine_single_value_background_correction # remove_background, get_threshold
 from papylio.timer import Timer
+from papylio.storage import get_storage
 
 class Illumination:
     def __init__(self, name, short_name='', other_names=[]):
@@ -201,10 +205,14 @@ class Movie:
     def __getstate__(self):
         d = self.__dict__.copy()
         d.pop('file', None)
+        d.pop('_read_lock', None)
+        d.update(_corrections=None, _corrections_modification_time=None, _corrections_hash=None,
+                 _correction_plan=None)
         return d
 
     def __setstate__(self, dict):
         self.__dict__.update(dict)
+        self._read_lock = threading.Lock()
 
     def __init__(self, filepath, rot90=0):  # , **kwargs):
         self.filepath = Path(filepath)
@@ -218,7 +226,10 @@ class Movie:
 
         self.chunk_size = 100
         self.use_dask = False
+        # Storage backend of the corrections
+        self.storage = get_storage('netcdf', engine='h5netcdf')
 
+        self._read_lock = threading.Lock()
         self._data_type = np.dtype(np.uint16)
         self.intensity_range = (np.iinfo(self.data_type).min, np.iinfo(self.data_type).max)
 
@@ -517,26 +528,34 @@ class Movie:
         self.header_is_read = True
 
     def read_frame(self, frame_index, **kwargs):
-        return self.read_frames([frame_index], **kwargs).squeeze(axis=0)
+        frame = self.read_frames([frame_index], **kwargs).squeeze(axis=0)
+        if self.use_dask:
+            frame = frame.compute()
+        return frame
 
-    def read_frames(self, frame_indices=None, apply_corrections=True, xarray=True, flatten_channels=False):
+    def read_frames(self, frame_indices=None, apply_corrections=True, xarray=True, flatten_channels=False, out=None):
+        """Read frames from the movie
+
+        If `use_dask` is set, a lazy dask array is returned, in which the frames are read, separated into channels and
+        corrected per block of `chunk_size` frames when computed. If `out` is given, the frames are computed and
+        written into `out` instead.
+        """
         if frame_indices is None:
             frame_indices = self.frame_indices.values
 
-        frames = self._read_frames(frame_indices)
-        # frames = xr.DataArray(frames, dims=('frame', 'y', 'x'))
-        frames = np.rot90(frames, self.rot90, axes=(1, 2))
-
         if len(self.channel_arrangement) > 1:
             raise NotImplementedError('Channel arrangement where frames indicated different channels not implemented')
             # Perhaps remove the outermost layer from channel_configuration
             # Or add this to separate and flatten channels
 
-        frames = self.separate_channels(frames)
-        # frames = np.stack([channel.crop_images(images) for channel in self.channels]
-
-        if apply_corrections:  # and self.correct_images
-            frames = self.apply_corrections(frames, frame_indices)
+        if self.use_dask:
+            frames = self._read_frames_lazy(frame_indices, apply_corrections=apply_corrections)
+            if out is not None:
+                np.copyto(out, frames.compute())
+                frames = out
+        else:
+            frames = self._read_frames(frame_indices)
+            frames = self._prepare_frames(frames, frame_indices, apply_corrections=apply_corrections, out=out)
 
         if xarray:
             frames = self.frames_to_xarray_dataarray(frames, frame_indices)
@@ -546,6 +565,121 @@ class Movie:
 
         return frames
 
+    def _prepare_frames(self, frames, frame_indices, apply_corrections=True, out=None):
+        # frames = xr.DataArray(frames, dims=('frame', 'y', 'x'))
+        frames = np.rot90(frames, self.rot90, axes=(1, 2))
+
+        frames = self.separate_channels(frames)
+        # frames = np.stack([channel.crop_images(images) for channel in self.channels]
+
+        if apply_corrections:  # and self.correct_images
+            frames = self.apply_corrections(frames, frame_indices, out=out)
+        elif out is not None:
+            np.copyto(out, frames)
+            frames = out
+
+        return frames
+
+    def _read_frames_lazy(self, frame_indices, apply_corrections=True):
+        import dask
+        import dask.array
+
+        frame_indices = np.asarray(frame_indices)
+        if apply_corrections:
+            self.correction_plan  # Load the corrections before the blocks are computed in parallel
+            dtype = np.dtype(np.float32)
+        else:
+            dtype = self.data_type
+
+        def read_block(frame_indices_block):
+            # Reading from the file is not thread-safe for all formats, the rest of the processing is.
+            with self._read_lock:
+                with self:
+                    frames = self._read_frames(frame_indices_block)
+            return self._prepare_frames(frames, frame_indices_block, apply_corrections=apply_corrections)
+
+        channel_shape = (self.number_of_channels, self.channels[0].height, self.channels[0].width)
+        number_of_blocks = max(int(np.ceil(len(frame_indices) / self.chunk_size)), 1)
+        blocks = [dask.array.from_delayed(dask.delayed(read_block)(frame_indices_block),
+                                          shape=(len(frame_indices_block),) + channel_shape, dtype=dtype)
+                  for frame_indices_block in np.array_split(frame_indices, number_of_blocks)]
+        return dask.array.concatenate(blocks, axis=0)
+
+    def iter_frame_blocks(self, frame_indices=None, block_size=None, prefetch=2, **kwargs):
+        """Iterate over blocks of frames, while the next blocks are read in a background thread
+
+        Parameters
+        ----------
+        frame_indices : numpy.ndarray, optional
+            Frames to read, by default all frames.
+        block_size : int, optional
+            Number of frames per block, by default `chunk_size`.
+        prefetch : int
+            Number of blocks that are read ahead. If 0, the blocks are read in the calling thread.
+        kwargs
+            Keyword arguments passed to `read_frames`.
+
+        Yields
+        ------
+        numpy.ndarray
+            Frame indices of the block
+        numpy.ndarray or xarray.DataArray
+            Frames of the block
+        """
+        if frame_indices is None:
+            frame_indices = self.frame_indices.values
+        if block_size is None:
+            block_size = self.chunk_size
+        frame_indices = np.asarray(frame_indices)
+        if len(frame_indices) == 0:
+            return
+        frame_indices_blocks = np.array_split(frame_indices, int(np.ceil(len(frame_indices) / block_size)))
+
+        with self:
+            if prefetch == 0:
+                for frame_indices_block in frame_indices_blocks:
+                    yield frame_indices_block, self._read_frames_in_memory(frame_indices_block, **kwargs)
+                return
+
+            blocks = queue.Queue(maxsize=prefetch)
+            stop = threading.Event()
+
+            def read_blocks():
+                try:
+                    for frame_indices_block in frame_indices_blocks:
+                        if stop.is_set():
+                            return
+                        blocks.put((frame_indices_block, self._read_frames_in_memory(frame_indices_block, **kwargs)))
+                except Exception as exception:
+                    blocks.put(exception)
+                blocks.put(None)
+
+            reader = threading.Thread(target=read_blocks, daemon=True)
+            reader.start()
+            try:
+                while True:
+                    block = blocks.get()
+                    if block is None:
+                        break
+                    elif isinstance(block, Exception):
+                        raise block
+                    yield block
+            finally:
+                # Unblock the reader when iteration is stopped early
+                stop.set()
+                while reader.is_alive():
+                    try:
+                        blocks.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                reader.join()
+
+    def _read_frames_in_memory(self, frame_indices, **kwargs):
+        frames = self.read_frames(frame_indices, **kwargs)
+        if self.use_dask:
+            frames = frames.compute()
+        return frames
+
     @property
     def channel_rows(self):
         return len(self.channel_arrangement[0])
@@ -561,7 +695,7 @@ class Movie:
         # return expand_axes(frames, (channel_rows, channel_columns), from_axes=(1, 2), to_axes=(0, 0))
         return xr.apply_ufunc(
             expand_axes, frames, input_core_dims=[['y', 'x']], output_core_dims=[['channel', 'y', 'x']],
-            exclude_dims=set(['y', 'x']),
+            exclude_dims=set(['y', 'x']), dask='allowed',
             kwargs={"expand_into": (self.channel_rows, self.channel_columns), "from_axes": (-2, -1),
                     "to_axes": (frames.ndim,) * 2, "new_axes_positions": [-3]}
         )
@@ -585,7 +719,7 @@ class Movie:
 
         return xr.apply_ufunc(
             expand_axes, frames, input_core_dims=[['channel', 'y', 'x']], output_core_dims=[['y', 'x']],
-            exclude_dims=set(['x', 'y']),
+            exclude_dims=set(['x', 'y']), dask='allowed',
             kwargs={"expand_into": (self.channel_rows, self.channel_columns), "from_axes": (-2, -1),
                     "to_axes": (-3, -3),
                     "inverse": True, "squeeze": True}
@@ -671,7 +805,7 @@ class Movie:
             #     tifffile.imwrite(self.writepath.joinPath(f'{self.name}_fr{frame_number}.tif'), image,  photometric='minisblack')
 
     def make_projection_image(self, projection_type='average', frame_range=(0,20), apply_corrections=True, illumination=None, write=False,
-                              return_image=True, flatten_channels=True, intensity_range=None, color_map='gray'):
+                              return_image=True, flatten_channels=True, intensity_range=None, color_map='gray', use_cache=True):
         """ Construct a projection image
         Determine a projection image for a number_of_frames starting at start_frame.
         i.e. [start_frame, start_frame + number_of_frames)
@@ -687,6 +821,9 @@ class Movie:
             Number of frames to average over
         write : bool
             If true, a tif file will be saved in writepath
+        use_cache : bool
+            If true, the projection image is stored in the projection cache and taken from the cache when it was
+            made before with the same settings, movie file and corrections.
 
         Returns
         -------
@@ -710,36 +847,167 @@ class Movie:
         # Select frame_indices with illumination
         frame_indices = frame_indices[self.illumination_index_per_frame.values[frame_indices] == illumination_index]
 
+        if use_cache:
+            cache_filepath = self.projection_cache_filepath(projection_type, frame_range, illumination_index,
+                                                            apply_corrections)
+            if cache_filepath.exists():
+                image = np.load(cache_filepath)
+                return self._write_and_return_projection_image(image, projection_type, frame_range, illumination_index,
+                                                               apply_corrections, write, return_image,
+                                                               flatten_channels, intensity_range, color_map)
+
         # Calculate sum of frames and find mean
         image = self.separate_channels(np.zeros((self.height, self.width)).astype('float32'))
 
-        frame_indices_subsets = np.array_split(frame_indices, len(frame_indices) // self.chunk_size + 1)
-
-        if projection_type == 'average':
+        if self.use_dask:
+            # The projection is calculated out of core by the dask scheduler
+            frames = self.read_frames(frame_indices, apply_corrections=apply_corrections, xarray=False,
+                                      flatten_channels=False)
+            if projection_type == 'average':
+                image = frames.mean(axis=0, dtype=np.float64).astype('float32').compute()
+            elif projection_type == 'maximum':
+                image = np.maximum(image, frames.max(axis=0).compute())
+        elif projection_type == 'average':
             number_of_frames = len(frame_indices)
-            # if len(frame_indices) > 100:
-                # print(f'\n Making average image of {self.name}')
-            with self:
-                for frame_indices_subset in tqdm.tqdm(frame_indices_subsets, desc='Average image'):
-                    # if len(frame_indices) > 100 and i % 13 == 0:
-                    #     sys.stdout.write(
-                    #         f'\r   Processing frame {frame_index} in {frame_indices[0]}-{frame_indices[-1]}')
-                    frames = self.read_frames(frame_indices_subset, apply_corrections=apply_corrections,
-                                              xarray=False, flatten_channels=False)
+            with tqdm.tqdm(total=len(frame_indices), desc='Average image') as progress_bar:
+                for frame_indices_subset, frames in self.iter_frame_blocks(frame_indices, xarray=False,
+                                                                           apply_corrections=apply_corrections,
+                                                                           flatten_channels=False):
                     image = image + frames.sum(axis=0)
+                    progress_bar.update(len(frame_indices_subset))
                 #TODO: Check whether this is a good way to average, i.e. do the values not get too big.
             image = (image / number_of_frames).astype('float32')
         elif projection_type == 'maximum':
-            # print(f'\n Making maximum projection image of {self.name}')
-            with self:
-                for frame_indices_subset in tqdm.tqdm(frame_indices_subsets, desc='Maximum projection image'):
-                    # if i % 13 == 0:
-                    #     sys.stdout.write(
-                    #         f'\r   Processing frame {frame_index} in {frame_indices[0]}-{frame_indices[-1]}')
-                    frames = self.read_frames(frame_indices_subset, xarray=False, flatten_channels=False)
+            with tqdm.tqdm(total=len(frame_indices), desc='Maximum projection image') as progress_bar:
+                for frame_indices_subset, frames in self.iter_frame_blocks(frame_indices, xarray=False,
+                                                                           apply_corrections=apply_corrections,
+                                                                           flatten_channels=False):
                     image = np.maximum(image, frames.max(axis=0))
-            # sys.stdout.write(f'\r   Processed frames {frame_indices[0]}-{frame_indices[-1]}\n')
+                    progress_bar.update(len(frame_indices_subset))
+
+        if use_cache:
+            cache_filepath.parent.mkdir(parents=True, exist_ok=True)
+            np.save(cache_filepath, image)
+
+        return self._write_and_return_projection_image(image, projection_type, frame_range, illumination_index,
+                                                       apply_corrections, write, return_image, flatten_channels,
+                                                       intensity_range, color_map)
+
+    def iter_projection_images(self, frame_ranges, projection_type='average', apply_corrections=True, illumination=None,
+                               flatten_channels=True):
+        """Construct projection images for multiple, possibly overlapping, frame ranges, e.g. sliding windows.
+
+        The movie is read only once. The frames are divided into segments at the start and end of each frame range.
+        For average images, the running sum is stored at each segment boundary, so that the sum over a frame range is
+        the difference of the running sums at its end and start. For maximum projection images, the maximum of each
+        segment is stored and the maximum over a frame range is the maximum of its segments. Stored images are
+        discarded as soon as no remaining frame range needs them.
 
+        Parameters
+        ----------
+        frame_ranges : list of tuple
+            Frame ranges [start_frame, end_frame) for which projection images are made
+        projection_type : str
+            'average' for average images
+            'maximum' for maximum projection images
+        apply_corrections : bool
+            If True, the movie corrections are applied to the frames
+        illumination : int or str, optional
+            Illumination of which the frames are used
+        flatten_channels : bool
+            If True, the channels are combined in a single image
+
+        Yields
+        ------
+        tuple
+            Frame range
+        numpy.ndarray
+            Projection image of the frame range, in the order of the end frames of the frame ranges
+        """
+        if projection_type not in ['average', 'maximum']:
+            raise ValueError(f'Unknown projection type {projection_type}')
+        frame_ranges = [(frame_range[0], min(frame_range[1], self.number_of_frames)) for frame_range in frame_ranges]
+        if len(frame_ranges) == 0:
+            return
+
+        illumination_indices = self.get_illumination_indices_from_names(illumination)
+        illumination_index = np.intersect1d(illumination_indices, self.illumination_indices_in_movie)[0]
+        frame_indices = self.frame_indices.values
+        frame_indices = frame_indices[self.illumination_index_per_frame.values[frame_indices] == illumination_index]
+
+        # Start and end of each frame range as positions in frame_indices
+        starts = np.searchsorted(frame_indices, [frame_range[0] for frame_range in frame_ranges])
+        ends = np.searchsorted(frame_indices, [frame_range[1] for frame_range in frame_ranges])
+        boundaries = np.unique(np.concatenate([starts, ends]))
+        window_order = np.argsort(ends, kind='stable')
+
+        empty_image = self.separate_channels(np.zeros((self.height, self.width)).astype('float32'))
+        stored_images = {}  # Running sum at or maximum of the segment starting at each boundary
+        running_image = empty_image.astype('float64') if projection_type == 'average' else empty_image.copy()
+        segment_start = boundaries[0]
+        next_window = 0
+
+        def add_to_segment(segment_frames):
+            nonlocal running_image
+            if projection_type == 'average':
+                running_image += segment_frames.sum(axis=0, dtype=np.float64)
+            else:
+                running_image = np.maximum(running_image, segment_frames.max(axis=0))
+
+        def end_segment(boundary):
+            nonlocal running_image, segment_start, next_window
+            if projection_type == 'average':
+                stored_images[boundary] = running_image.copy()
+            else:
+                stored_images[segment_start] = running_image
+                running_image = empty_image.copy()
+                segment_start = boundary
+
+            projections = []
+            while next_window < len(window_order) and ends[window_order[next_window]] == boundary:
+                window = window_order[next_window]
+                start, end = starts[window], ends[window]
+                if projection_type == 'average':
+                    image = ((stored_images[end] - stored_images[start]) / max(end - start, 1)).astype('float32')
+                else:
+                    image = empty_image.copy()
+                    for segment_boundary in boundaries[(boundaries >= start) & (boundaries < end)]:
+                        image = np.maximum(image, stored_images[segment_boundary])
+                projections.append((frame_ranges[window], image))
+                next_window += 1
+
+            if next_window < len(window_order):
+                first_start = starts[window_order[next_window:]].min()
+                for stored_boundary in [b for b in stored_images if b < first_start]:
+                    stored_images.pop(stored_boundary)
+            return projections
+
+        def output(projections):
+            for frame_range, image in projections:
+                yield frame_range, self._write_and_return_projection_image(
+                    image, projection_type, frame_range, illumination_index, apply_corrections, write=False,
+                    return_image=True, flatten_channels=flatten_channels, intensity_range=None, color_map=None)
+
+        yield from output(end_segment(boundaries[0]))
+
+        position = boundaries[0]
+        with tqdm.tqdm(total=boundaries[-1] - boundaries[0], desc='Projection images') as progress_bar:
+            for frame_indices_block, frames in self.iter_frame_blocks(frame_indices[boundaries[0]:boundaries[-1]],
+                                                                       xarray=False, flatten_channels=False,
+                                                                       apply_corrections=apply_corrections):
+                block_start, block_end = position, position + len(frame_indices_block)
+                for boundary in boundaries[(boundaries > block_start) & (boundaries <= block_end)]:
+                    add_to_segment(frames[position - block_start:boundary - block_start])
+                    position = boundary
+                    yield from output(end_segment(boundary))
+                if position < block_end:
+                    add_to_segment(frames[position - block_start:])
+                position = block_end
+                progress_bar.update(len(frame_indices_block))
+
+    def _write_and_return_projection_image(self, image, projection_type, frame_range, illumination_index,
+                                           apply_corrections, write, return_image, flatten_channels, intensity_range,
+                                           color_map):
         if write:
             filename = Movie.image_info_to_filename(self.name, fov_index=self.fov_index, projection_type=projection_type,
                                                     frame_range=frame_range, illumination=illumination_index, apply_corrections=apply_corrections)
@@ -769,6 +1037,26 @@ class Movie:
             else:
                 return image
 
+    @property
+    def projection_cache_path(self):
+        return self.writepath.joinpath('.projection_cache', self.name)
+
+    def projection_cache_filepath(self, projection_type, frame_range, illumination_index, apply_corrections):
+        # The filename is a hash of the movie file identity, the projection settings and the applied corrections,
+        # so that a modified movie or changed corrections result in a different cache file.
+        file_stat = self.filepath.stat()
+        key = [str(self.filepath.absolute()), file_stat.st_size, file_stat.st_mtime_ns, self.fov_index, self.rot90,
+               np.array(self.channel_arrangement).tolist(), projection_type, tuple(frame_range),
+               int(illumination_index), bool(apply_corrections)]
+        if apply_corrections:
+            key.append(self.corrections_hash)
+        key = hashlib.sha1(repr(key).encode()).hexdigest()
+        return self.projection_cache_path.joinpath(key + '.npy')
+
+    def clear_projection_cache(self):
+        for cache_filepath in self.projection_cache_path.glob('*.npy'):
+            cache_filepath.unlink(missing_ok=True)
+
     def make_projection_images(self, projection_type='average', frame_range=(0, 20)):
         # Perhaps put this in make_projection_image as a special type of cmap
         for illumination_index in range(self.number_of_illuminations_in_movie):
@@ -843,7 +1131,7 @@ class Movie:
 
         frame_indices = self.frame_indices[slice(*frame_range)].values
         with self:
-            frames = self.read_frames(frame_indices=frame_indices, apply_corrections=True, xarray=False)
+            frames = self._read_frames_in_memory(frame_indices=frame_indices, apply_corrections=True, xarray=False)
 
         general_background_correction = xr.DataArray(0, dims=('illumination', 'channel'),
                                                       coords={'channel': self.channel_indices,
@@ -895,13 +1183,24 @@ class Movie:
                               spatial_background_correction=None,
                               general_background_correction=None)
 
-        frames = self.read_frames(frame_indices=None, apply_corrections=True, xarray=False)
-
         temporal_background_correction = xr.DataArray(0, dims=('frame', 'channel'),
                                                       coords={'frame': self.frame_indices,
                                                               'channel': self.channel_indices},
                                                       name='temporal_background_correction')
 
+        if not method.startswith('BaSiC'):
+            # A single value per frame is determined, so the frames can be processed in blocks
+            with tqdm.tqdm(total=self.number_of_frames, desc='Temporal background correction') as progress_bar:
+                for frame_indices_block, frames in self.iter_frame_blocks(apply_corrections=True, xarray=False):
+                    for channel in np.array(self.channel_indices):
+                        temporal_background_correction[dict(frame=frame_indices_block, channel=channel)] = \
+                            [determine_single_value_background_correction(frame, method) for frame in frames[:, channel]]
+                    progress_bar.update(len(frame_indices_block))
+            self.save_corrections(temporal_background_correction=temporal_background_correction)
+            return
+
+        frames = self._read_frames_in_memory(frame_indices=None, apply_corrections=True, xarray=False)
+
         # corrections = self.corrections
 
         for illumination, channel in itertools.product(self.illumination_indices_in_movie, np.array(self.channel_indices)):
@@ -945,7 +1244,7 @@ class Movie:
 
         frame_indices = self.frame_indices[slice(*frame_range)].values
         with self:
-            frames = self.read_frames(frame_indices=frame_indices, apply_corrections=True, xarray=False)
+            frames = self._read_frames_in_memory(frame_indices=frame_indices, apply_corrections=True, xarray=False)
 
         spatial_background_correction = xr.DataArray(np.zeros((self.number_of_illuminations,) + frames.shape[1:]),
                                                      dims=('illumination', 'channel', 'y', 'x'),
@@ -986,17 +1285,105 @@ class Movie:
                               #general_background_correction=None)
     @property
     def corrections(self):
-        if hasattr(self, 'fov_index') and self.fov_index is not None:
-            corrections_filepath = self.filepath.with_name(self.name + f'_fov{self.fov_index:03d}' + '_corrections.nc')
+        # The corrections are cached and only reloaded when the corrections file is changed.
+        corrections_filepath = self.corrections_filepath
+        if self.storage.exists(corrections_filepath):
+            modification_time = self.storage.modification_time(corrections_filepath)
         else:
-            corrections_filepath = self.filepath.with_name(self.name + '_corrections.nc')
+            modification_time = None
 
-        if corrections_filepath.exists():
-            corrections = xr.load_dataset(corrections_filepath, engine='h5netcdf')
-        else:
-            corrections = xr.Dataset()
-        corrections = corrections.merge(self._common_corrections, compat='override')
-        return corrections
+        if self._corrections is None or modification_time != self._corrections_modification_time:
+            self.clear_corrections_cache()
+            if modification_time is not None:
+                corrections = self.storage.load(corrections_filepath)
+            else:
+                corrections = xr.Dataset()
+            self._corrections = corrections.merge(self._common_corrections, compat='override')
+            self._corrections_modification_time = modification_time
+        return self._corrections
+
+    @property
+    def _common_corrections(self):
+        return self._common_corrections_dataset
+
+    @_common_corrections.setter
+    def _common_corrections(self, common_corrections):
+        self._common_corrections_dataset = common_corrections
+        self.clear_corrections_cache()
+
+    def clear_corrections_cache(self):
+        self._corrections = None
+        self._corrections_modification_time = None
+        self._corrections_hash = None
+        self._correction_plan = None
+
+    @property
+    def corrections_hash(self):
+        corrections = self.corrections
+        if self._corrections_hash is None:
+            corrections_hash = hashlib.sha1()
+            for name, correction in sorted(corrections.data_vars.items()):
+                corrections_hash.update(name.encode())
+                corrections_hash.update(np.ascontiguousarray(correction.values).tobytes())
+            self._corrections_hash = corrections_hash.hexdigest()
+        return self._corrections_hash
+
+    @property
+    def correction_plan(self):
+        """dict : Corrections as contiguous float32 arrays, combined where possible, for use in apply_corrections.
+
+        Contains 'darkfield', 'inverse_flatfield' and 'background' (spatial and general background combined), indexed by
+        illumination index, and 'inverse_temporal_illumination' and 'temporal_background', indexed by frame index.
+        Corrections that are not present are filled with values that leave the frames unchanged.
+        """
+        corrections = self.corrections
+        if self._correction_plan is None:
+            number_of_illuminations = len(self.illumination_indices)
+            channel_shape = (self.number_of_channels, self.channels[0].height, self.channels[0].width)
+
+            def as_float32(correction, shape):
+                return np.ascontiguousarray(np.broadcast_to(correction, shape), dtype=np.float32)
+
+            def illumination_shape(correction):
+                return (correction.shape[0],) + channel_shape
+
+            correction_plan = {}
+            if 'darkfield_correction' in corrections:
+                darkfield = corrections.darkfield_correction.values
+                correction_plan['darkfield'] = as_float32(darkfield, illumination_shape(darkfield))
+            else:
+                correction_plan['darkfield'] = np.zeros((number_of_illuminations,) + channel_shape, dtype=np.float32)
+
+            if 'flatfield_correction' in corrections:
+                flatfield = corrections.flatfield_correction.values
+                correction_plan['inverse_flatfield'] = as_float32(1 / flatfield, illumination_shape(flatfield))
+            else:
+                correction_plan['inverse_flatfield'] = np.ones((number_of_illuminations,) + channel_shape,
+                                                               dtype=np.float32)
+
+            if 'temporal_illumination_correction' in corrections:
+                correction_plan['inverse_temporal_illumination'] = \
+                    as_float32(1 / corrections.temporal_illumination_correction.values, (self.number_of_frames,))
+            else:
+                correction_plan['inverse_temporal_illumination'] = np.ones(self.number_of_frames, dtype=np.float32)
+
+            if 'temporal_background_correction' in corrections:
+                correction_plan['temporal_background'] = \
+                    as_float32(corrections.temporal_background_correction.values,
+                               (self.number_of_frames, self.number_of_channels))
+            else:
+                correction_plan['temporal_background'] = np.zeros((self.number_of_frames, self.number_of_channels),
+                                                                  dtype=np.float32)
+
+            background = np.zeros((1,) + channel_shape)
+            if 'spatial_background_correction' in corrections:
+                background = background + corrections.spatial_background_correction.values
+            if 'general_background_correction' in corrections:
+                background = background + corrections.general_background_correction.values[:, :, None, None]
+            correction_plan['background'] = as_float32(background, (max(background.shape[0], number_of_illuminations),) + channel_shape)
+
+            self._correction_plan = correction_plan
+        return self._correction_plan
 
     # def load_corrections(self):
     #     corrections_filepath = self.filepath.with_name(self.name + '_corrections.nc')
@@ -1009,18 +1396,20 @@ class Movie:
     @property
     def corrections_filepath(self):
         if hasattr(self, 'fov_index') and self.fov_index is not None:
-            corrections_filepath = self.filepath.with_name(self.name + f'_fov{self.fov_index:03d}' + '_corrections.nc')
+            corrections_filepath = self.filepath.with_name(self.name + f'_fov{self.fov_index:03d}' + '_corrections'
+                                                           + self.storage.extension)
         else:
-            corrections_filepath = self.filepath.with_name(self.name + '_corrections.nc')
+            corrections_filepath = self.filepath.with_name(self.name + '_corrections' + self.storage.extension)
         return corrections_filepath
 
     def reset_corrections(self):
-        self.corrections_filepath.unlink(missing_ok=True)
+        self.storage.remove(self.corrections_filepath)
+        self.clear_corrections_cache()
 
     def save_corrections(self, **kwargs):
         corrections_filepath = self.corrections_filepath
-        if corrections_filepath.exists():
-            corrections = xr.load_dataset(corrections_filepath, engine='h5netcdf')
+        if self.storage.exists(corrections_filepath):
+            corrections = self.storage.load(corrections_filepath)
         else:
             corrections = xr.Dataset()
         for name, correction in kwargs.items():
@@ -1029,7 +1418,8 @@ class Movie:
                 corrections = corrections.drop_vars(name, errors='ignore')
             else:
                 corrections[name] = correction
-        corrections.to_netcdf(corrections_filepath, mode='w', engine='h5netcdf')
+        self.storage.write(corrections, corrections_filepath, mode='w')
+        self.clear_corrections_cache()
 
 #     def apply_corrections(self, frames, frame_indices):
 #
@@ -1039,35 +1429,26 @@ class Movie:
 #                                  self.background_correction.values)
 #
 # # @njit
-    def apply_corrections(self, frames, frame_indices):
-        illumination_indices = self.illumination_index_per_frame[frame_indices]
-        frames = frames.astype(np.float32)
-        corrections = self.corrections
-        for illumination_index in np.unique(illumination_indices):
-            frame_indices_with_illumination = np.array(illumination_indices == illumination_index)
+    def apply_corrections(self, frames, frame_indices, out=None):
+        """Apply the corrections to frames with dimensions (frame, channel, y, x)
 
-            if 'darkfield_correction' in corrections:
-                frames[frame_indices_with_illumination] -= corrections.darkfield_correction.values[None, illumination_index]
-
-            if 'flatfield_correction' in corrections:
-                frames[frame_indices_with_illumination] /= corrections.flatfield_correction.values[None, illumination_index]
-
-            if 'temporal_illumination_correction' in corrections:
-                frames[frame_indices_with_illumination] /= \
-                    corrections.temporal_illumination_correction.values[frame_indices][frame_indices_with_illumination, None, None, None]
-
-            if 'temporal_background_correction' in corrections:
-                frames[frame_indices_with_illumination] -= \
-                    corrections.temporal_background_correction.values[frame_indices][frame_indices_with_illumination, :, None, None]
+        All corrections are applied in a single pass over the frames. The result is written to `out` if given, which
+        should be a float32 array with the same shape as the frames, so that a buffer can be reused between calls.
+        """
+        if out is None:
+            out = np.empty(frames.shape, dtype=np.float32)
 
-            if 'spatial_background_correction' in corrections:
-                frames[frame_indices_with_illumination] -= corrections.spatial_background_correction.values[None,
-                                                           illumination_index, :, :, :]
+        if not self.corrections.data_vars:
+            np.copyto(out, frames)
+            return out
 
-            if 'general_background_correction' in corrections:
-                frames[frame_indices_with_illumination] -= corrections.general_background_correction.values[None, illumination_index, :, None, None]
-
-        return frames
+        correction_plan = self.correction_plan
+        illumination_indices = np.asarray(self.illumination_index_per_frame[frame_indices])
+        apply_corrections_kernel(frames, np.asarray(frame_indices), illumination_indices,
+                                 correction_plan['darkfield'], correction_plan['inverse_flatfield'],
+                                 correction_plan['inverse_temporal_illumination'],
+                                 correction_plan['temporal_background'], correction_plan['background'], out)
+        return out
 
     def show_correction(self, correction_name, save=True, **kwargs):
         correction = self.corrections[correction_name]
@@ -1302,4 +1683,32 @@ def expand_axes(frames, expand_into, from_axes=-1, to_axes=None, new_axes_positi
     # bb = split_image_channels(frames, (2, 2), axes=(1, 2), combine_new_axes=False)
     # print(time.time() - start)
 
-    return frames
\ No newline at end of file
+    return frames
+
+def read_frames_from_memory_map(memory_map, frame_indices):
+    # Contiguous ranges of frames are read with a single copy of a slice. The frames are always copied, so that no
+    # reference to the memory map remains after the movie is closed.
+    frame_indices = np.atleast_1d(frame_indices)
+    if len(frame_indices) > 0 and np.all(np.diff(frame_indices) == 1):
+        return np.array(memory_map[frame_indices[0]:frame_indices[-1] + 1])
+    else:
+        return np.asarray(memory_map[frame_indices])
+
+
+
+@njit
+def apply_corrections_kernel(frames, frame_indices, illumination_indices, darkfield, inverse_flatfield,
+                             inverse_temporal_illumination, temporal_background, background, out):
+    # Fused correction: out = (frames - darkfield) * inverse_flatfield * inverse_temporal_illumination
+    #                         - temporal_background - background
+    for i in range(frames.shape[0]):
+        frame_index = frame_indices[i]
+        illumination_index = illumination_indices[i]
+        for c in range(frames.shape[1]):
+            scale = inverse_temporal_illumination[frame_index]
+            offset = temporal_background[frame_index, c]
+            for y in range(frames.shape[2]):
+                for x in range(frames.shape[3]):
+                    out[i, c, y, x] = (np.float32(frames[i, c, y, x]) - darkfield[illumination_index, c, y, x]) * \
+                                      inverse_flatfield[illumination_index, c, y, x] * scale - offset - \
+                                      background[illumination_index, c, y, x]
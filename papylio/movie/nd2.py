@@ -9,8 +9,10 @@ read_header and read_frame adapted, def __init__ unchanged
 
 from pathlib import Path
 import os, sys
+import struct
 
 import time
+import warnings
 import numpy as np
 import matplotlib.pyplot as plt
 import xarray as xr
@@ -140,18 +142,41 @@ class ND2Movie(Movie):
 
 
     def _read_frame(self, frame_number):
-        with self:
-            if frame_number < self.number_of_frames:
-                im = self.file[frame_number + self.frame_offset]
-            else:
-                im = self.file[self.number_of_frames + self.frame_offset - 1]
-                print(f'pageNb out of range. The last frame (fr#{self.number_of_frames + self.frame_offset - 1}) is loaded instead')
-            # note: im is a Frame, which is pims.frame.Frame, a np. array with additional frame number and metadata
-            return im
+        return self._read_frames([frame_number])[0]
 
     def _read_frames(self, indices):
-        # Can probably be implemented more efficiently
-        return np.stack([self._read_frame(i) for i in indices])
+        # Reads the raw image data directly from the parser, which avoids creating a pims Frame with metadata for
+        # each image. The parser methods are private to nd2reader and assume a single field of view and z-level in the
+        # nd2 loops, otherwise or if they fail the public get_frame_2D is used instead.
+        indices = np.asarray(indices)
+        if np.any(indices >= self.number_of_frames):
+            warnings.warn(f'pageNb out of range. The last frame (fr#{self.number_of_frames + self.frame_offset - 1}) '
+                          f'is loaded instead')
+            indices = np.minimum(indices, self.number_of_frames - 1)
+
+        with self:
+            parser = self.file._parser
+            height = self.file.metadata['height']
+            width = self.file.metadata['width']
+            if 'c' in self.file.iter_axes:
+                number_of_channels = len(self.file.metadata['channels'])
+            else:
+                number_of_channels = 1
+            use_parser = self.file.sizes.get('v', 1) == 1 and self.file.sizes.get('z', 1) == 1
+
+            frames = np.empty((len(indices), height, width), dtype=self.data_type)
+            for i, index in enumerate(indices + self.frame_offset):
+                time_index, channel_index = divmod(int(index), number_of_channels)
+                if use_parser:
+                    try:
+                        image_group_number = parser._calculate_image_group_number(time_index, 0, 0)
+                        _, frames[i] = parser._get_raw_image_data(image_group_number, channel_index, height, width)
+                        continue
+                    except (TypeError, ValueError, struct.error):
+                        # Missing, corrupt or differently sized image data in the nd2 file
+                        use_parser = False
+                frames[i] = self.file.get_frame_2D(c=channel_index, t=time_index)
+        return frames
 
 #
 # def get_fov_from_nd2(nd2_fullpath):
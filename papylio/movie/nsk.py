@@ -1,7 +1,7 @@
 import os
 import numpy as np
 
-from papylio.movie.movie import Movie
+from papylio.movie.movie import Movie, read_frames_from_memory_map
 
 
 class NskMovie(Movie):
@@ -19,7 +19,7 @@ class NskMovie(Movie):
         self.data_type = np.dtype(np.uint16)
 
         # self.read_header()
-        self.create_frame_info()  # Possibly move to Movie later on
+        # self.create_frame_info()  # Possibly move to Movie later on
 
         # self._initialized = True
 
@@ -30,14 +30,16 @@ class NskMovie(Movie):
 
         self.number_of_frames = int((os.path.getsize(self.filepath) - 4) / 2 / self.width / self.height)
 
-    def _read_frame(self, frame_number):
-        with self.filepath.open('rb') as fid:
-            fid.seek(4 + 2 * frame_number * int(self.width * self.height), os.SEEK_SET)
-            image = np.fromfile(fid, dtype=np.uint16, count=self.width*self.height)
-            image = np.reshape(image, (self.width, self.height))
+    def open(self):
+        self.file = np.memmap(self.filepath, dtype=np.uint16, mode='r', offset=4,
+                              shape=(self.number_of_frames, self.width, self.height))
 
-        return image
+    def close(self):
+        del self.file
+
+    def _read_frame(self, frame_number):
+        return self._read_frames([frame_number])[0]
 
     def _read_frames(self, indices):
-        # Can probably be implemented more efficiently
-        return np.stack([self._read_frame(i) for i in indices])
\ No newline at end of file
+        with self:
+            return read_frames_from_memory_map(self.file, indices)
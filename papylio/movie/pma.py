@@ -1,7 +1,7 @@
 import os
 import numpy as np
 
-from papylio.movie.movie import Movie
+from papylio.movie.movie import Movie, read_frames_from_memory_map
 
 
 class PmaMovie(Movie):
@@ -32,10 +32,16 @@ class PmaMovie(Movie):
 
 
     def open(self):
-        pass  # TODO: implement this
+        # For 16 bit movies each frame consists of a block with the most significant bytes followed by a block with
+        # the least significant bytes
+        if self.bitdepth == 8:
+            shape = (self.number_of_frames, self.width, self.height)
+        else:
+            shape = (self.number_of_frames, 2, self.width, self.height)
+        self.file = np.memmap(self.filepath, dtype=np.uint8, mode='r', offset=4, shape=shape)
 
     def close(self):
-        pass  # TODO: implement this
+        del self.file
 
     def _read_header(self):
         statinfo = os.stat(self.filepath)       
@@ -43,7 +49,7 @@ class PmaMovie(Movie):
         with self.filepath.open('rb') as pma_file:
             self.width = np.fromfile(pma_file, np.int16, count=1)[0].astype(int)
             self.height = np.fromfile(pma_file, np.int16, count=1)[0].astype(int)
-            self.number_of_frames = int((statinfo.st_size-4)/(self.width*self.height))
+            self.number_of_frames = int((statinfo.st_size-4)/(self.width*self.height*self.data_type.itemsize))
 
         # TODO: Import log file
         # self.exposure_time = np.genfromtxt(f'{self.absoluteFilePath}.log', max_rows=1)[2]
@@ -52,24 +58,16 @@ class PmaMovie(Movie):
         # self.log_details = ''.join(self.log_details)
 
     def _read_frame(self, frame_number):
-        with self.filepath.open('rb') as pma_file:
-            np.fromfile(pma_file, np.uint16, count=1)
-            np.fromfile(pma_file, np.uint16, count=1)
-        
-            if self.bitdepth == 8:
-                pma_file.seek(4+(frame_number*(self.width*self.height)), os.SEEK_SET)
-                image = np.reshape(np.fromfile(pma_file, np.uint8, count=self.width*self.height), (self.width,self.height))
-            else:
-                pma_file.seek(4+2*frame_number*(self.width*self.height), os.SEEK_SET)
-                msb = np.reshape(np.fromfile(pma_file, np.uint8, count=(self.width*self.height)), (self.width, self.height))
-                lsb = np.reshape(np.fromfile(pma_file, np.uint8, count=(self.width*self.height)), (self.width, self.height))
-                image = 256*msb+lsb
-
-        return image
+        return self._read_frames([frame_number])[0]
 
     def _read_frames(self, indices):
-        # Can probably be implemented more efficiently
-        return np.stack([self._read_frame(i) for i in indices])
+        with self:
+            frames = read_frames_from_memory_map(self.file, indices)
+
+        if self.bitdepth == 16:
+            frames = 256 * frames[:, 0].astype(np.uint16) + frames[:, 1]
+
+        return frames
 
 if __name__ == "__main__":
     movie = PmaMovie(r'.\Example_data\pma\movie.pma')
@@ -163,46 +163,52 @@ class SifxMovie(Movie):
         self.m_offset = self.filesize - self.datasize - 8
     
        
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
     def _read_frame(self, frame_number):
+        return self._read_frames([frame_number])[0]
+
+    def _read_frames(self, indices):
+        # Each frame is stored in a separate spool file, the raw bytes of all frames are read into a single array
+        # and decoded at once.
         if (self.xbin == 2) and (self.ybin == 2):
-             count=self.height*self.width*4
-             #name should follow from A.filelist
-             with self.folderpath.joinpath(self.filelist[frame_number]).open('rb') as fid:
-                 raw=np.uint16(np.fromfile(fid,np.uint8,count))
-             ALL = raw[0::4]+raw[1::4]*256
-            
+            count = self.height * self.width * 4
         else:
-             count=self.height*self.width*3//2
-             #name should follow from A.filelist
-             with self.folderpath.joinpath(self.filelist[frame_number]).open('rb') as fid:
-                  raw=np.uint16(np.fromfile(fid,np.uint8,count))
-             
-             if not hasattr(self, 'ii'):
-                 self.ii = np.array(range(int(self.width/2)*int(self.height/2)))
-                
-             #print([A.height,A.width,A.stacksize,np.shape(raw)])        
-             AA=raw[self.ii*6+0]*16 + (raw[self.ii*6+1]%16)
-             BB=raw[self.ii*6+2]*16 + (raw[self.ii*6+1]//16)
-             CC=raw[self.ii*6+3]*16 + (raw[self.ii*6+4]%16)
-             DD=raw[self.ii*6+5]*16 + (raw[self.ii*6+4]//16) 
-                  
-             ALL=np.uint16(np.zeros(self.height*self.width))
-             ALL[0::4] = AA
-             ALL[1::4] = BB
-             ALL[2::4] = CC
-             ALL[3::4] = DD
-                  
-        im=np.reshape(ALL,(self.height, self.width))
-        im=np.rot90(im)     
-        if 0: # for testing match real data
-            plt.imshow(im)
-            tifffile.imwrite(self.writepath.joinPath(f'{self.name}_fr{frame_number}.tif') , im ,  photometric='minisblack')
-        
-        return im
+            count = self.height * self.width * 3 // 2
 
-    def _read_frames(self, indices):
-        # Can probably be implemented more efficiently
-        return np.stack([self._read_frame(i) for i in indices])
+        raw = np.zeros((len(indices), count), dtype=np.uint8)
+        for i, frame_number in enumerate(indices):
+            with self.folderpath.joinpath(self.filelist[frame_number]).open('rb') as fid:
+                fid.readinto(raw[i])
+
+        if (self.xbin == 2) and (self.ybin == 2):
+            frames = unpack_16_bit_from_32_bit(raw)
+        else:
+            frames = unpack_12_bit(raw)
+
+        frames = frames.reshape((len(indices), self.height, self.width))
+        return np.rot90(frames, axes=(1, 2))
+
+
+def unpack_16_bit_from_32_bit(raw):
+    # Pixels are stored as 4 bytes, of which the lower two bytes are used
+    raw = raw.reshape(raw.shape[0], -1, 4).astype(np.uint16)
+    return raw[..., 0] + raw[..., 1] * 256
+
+
+def unpack_12_bit(raw):
+    # Four 12-bit pixels are packed in six bytes
+    raw = raw.reshape(raw.shape[0], -1, 6).astype(np.uint16)
+    pixels = np.empty(raw.shape[:2] + (4,), dtype=np.uint16)
+    pixels[..., 0] = raw[..., 0] * 16 + raw[..., 1] % 16
+    pixels[..., 1] = raw[..., 2] * 16 + raw[..., 1] // 16
+    pixels[..., 2] = raw[..., 3] * 16 + raw[..., 4] % 16
+    pixels[..., 3] = raw[..., 5] * 16 + raw[..., 4] // 16
+    return pixels.reshape(raw.shape[0], -1)
 
 if __name__ == "__main__":
     movie = SifxMovie(r'.\Example_data\sifx\movie\Spooled files.sifx')
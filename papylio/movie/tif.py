@@ -116,16 +116,12 @@ class TifMovie(Movie):
         return im
 
     def _read_frames(self, frame_indices=None):
-        if not self.use_dask:
-            if len(frame_indices) == 1:
-                with self:
-                    frames = np.stack([self.file.pages[i].asarray() for i in frame_indices])
-            else:
-                frames = tifffile.imread(self.filepath, key=frame_indices)
-
+        # When use_dask is set, this is called per block by Movie.read_frames
+        if len(frame_indices) == 1:
+            with self:
+                frames = np.stack([self.file.pages[i].asarray() for i in frame_indices])
         else:
-            import dask_image.imread
-            frames = dask_image.imread.imread(self.filepath, nframes=100)[frame_indices]
+            frames = tifffile.imread(self.filepath, key=frame_indices)
         return frames
 
 if __name__ == "__main__":
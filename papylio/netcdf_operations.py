@@ -1,3 +1,6 @@
+import os
+import collections
+import concurrent.futures
 import tqdm
 import numpy as np
 import netCDF4
@@ -22,60 +25,271 @@ def get_dimension_sizes(filepaths, dimension, with_selected_only=False, with_seq
     # return [get_dimension_size(filepath, 'molecule', with_sequence_only) for filepath in filepaths]
 
 
-def merge_datasets(files_in, file_out, concat_dim, init_file=None, with_selected_only=False, with_sequence_only=False):
+def merge_datasets(files_in, file_out, concat_dim, init_file=None, with_selected_only=False, with_sequence_only=False,
+                   annotation_files_in=None, block_size=None, n_jobs=None, maximum_block_nbytes=2**26,
+                   maximum_blocks_ahead=8):
+    """Concatenate netCDF datasets along concat_dim into a single netCDF file.
+
+    The variables along concat_dim are copied in blocks of at most block_size elements, so that the memory usage does
+    not depend on the size of the input files. The blocks are read by separate processes, a limited number of blocks
+    ahead, while the blocks are written to the output file in order by the calling process. Hence, at most
+    maximum_blocks_ahead blocks of maximum_block_nbytes are in memory at the same time.
+
+    Parameters
+    ----------
+    files_in : list of str or pathlib.Path
+        Input netCDF files.
+    file_out : str or pathlib.Path
+        Output netCDF file.
+    concat_dim : str
+        Dimension along which the datasets are concatenated.
+    init_file : str or pathlib.Path, optional
+        File used to initialize the dimensions and variables of the output file, by default the first input file.
+    with_selected_only : bool
+        If True, only elements for which the selected variable is True are copied.
+    with_sequence_only : bool
+        If True, only elements with a sequence_tile are copied.
+    annotation_files_in : list, optional
+        For each file in files_in the file with additional variables (e.g. selections), or None.
+    block_size : int, optional
+        Number of elements along concat_dim read at once from an input file, by default the number of elements of which
+        the variables along concat_dim fit in maximum_block_nbytes.
+    n_jobs : int, optional
+        Number of processes reading the input files, by default the number of CPUs, limited to maximum_blocks_ahead.
+        If 1, the blocks are read in the calling process.
+    maximum_block_nbytes : int
+        Maximum number of bytes of a block, used to determine the default block_size.
+    maximum_blocks_ahead : int
+        Maximum number of blocks that are read ahead of writing.
+    """
     # TODO: remove sequencing part, or move to the sequencing plugin
     if init_file is None:
         init_file = files_in[0]
+    annotation_files_in = existing_annotation_files(files_in, annotation_files_in)
+
+    if with_selected_only:
+        selection_name = 'selected'
+    elif with_sequence_only:
+        selection_name = 'sequence_tile'
+    else:
+        selection_name = None
 
-    concat_dim_size = np.sum(get_dimension_sizes(files_in, concat_dim, with_selected_only, with_sequence_only))
+    sizes_in = get_dimension_sizes(files_in, concat_dim)
+    if selection_name is None:
+        concat_dim_size = np.sum(sizes_in)
+    else:
+        concat_dim_size = np.sum(get_dimension_sizes(files_in, concat_dim, with_selected_only, with_sequence_only))
 
     with netCDF4.Dataset(file_out, mode='w') as ds_out:
         with netCDF4.Dataset(init_file) as ds_in:
             init_dataset_like(ds_in, ds_out, concat_dim, concat_dim_size=concat_dim_size)
+        for annotation_file_in in annotation_files_in:
+            if annotation_file_in is not None:
+                with netCDF4.Dataset(annotation_file_in) as ds_in:
+                    init_dataset_like(ds_in, ds_out, concat_dim, concat_dim_size=concat_dim_size)
+
+        if block_size is None:
+            block_size = max(1, maximum_block_nbytes // max(element_nbytes(ds_out, concat_dim), 1))
+        blocks = [(file_in, annotation_file_in, start_index, min(start_index + block_size, size_in))
+                  for file_in, annotation_file_in, size_in in zip(files_in, annotation_files_in, sizes_in)
+                  for start_index in range(0, size_in, block_size)]
 
         start_index_out = 0
-        for file_in in tqdm.tqdm(files_in):
-            with netCDF4.Dataset(file_in) as ds_in:
-                if with_selected_only:
-                    _, start_index_out = append_to_dataset(ds_in, ds_out, concat_dim, selection_in=ds_in['selected'][:].astype(bool),
-                                                           start_index_out=start_index_out)
-                elif with_sequence_only:
-                    # has_sequence = (~(ds_in['sequence_aligned'][:] == b'-').all(axis=1))
-                    has_sequence = ds_in['sequence_tile'][:] > 0
-                    _, start_index_out = append_to_dataset(ds_in, ds_out, concat_dim, selection_in=has_sequence, start_index_out=start_index_out)
-                else:
-                    _, start_index_out = append_to_dataset(ds_in, ds_out, concat_dim, selection_in=None, start_index_out=start_index_out)
-
-
-def reorder_datasets_using_sequence_subset(files_in, folder_out, concat_dim):
+        for block in tqdm.tqdm(read_blocks(blocks, concat_dim, selection_name, n_jobs, maximum_blocks_ahead),
+                               total=len(blocks)):
+            start_index_out = write_block(ds_out, block, concat_dim, start_index_out)
+
+
+def element_nbytes(ds, concat_dim):
+    # Number of bytes of a single element along concat_dim, summed over the variables along concat_dim
+    return sum(np.dtype(variable.dtype).itemsize * int(np.prod(variable.shape[1:]))
+               for variable in ds.variables.values() if concat_dim in variable.dimensions)
+
+
+def existing_annotation_files(files_in, annotation_files_in=None):
+    # Annotation files that do not exist are replaced by None
+    if annotation_files_in is None:
+        return [None] * len(files_in)
+    return [annotation_file_in if annotation_file_in is not None and Path(annotation_file_in).exists() else None
+            for annotation_file_in in annotation_files_in]
+
+
+def read_blocks(blocks, concat_dim, selection_name=None, n_jobs=None, maximum_blocks_ahead=8):
+    # Yields the blocks in order, while at most maximum_blocks_ahead blocks are read ahead.
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    n_jobs = min(n_jobs, maximum_blocks_ahead, len(blocks))
+    if n_jobs <= 1:
+        for block in blocks:
+            yield read_block(*block, concat_dim, selection_name)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+        futures = collections.deque()
+        for block in blocks:
+            futures.append(executor.submit(read_block, *block, concat_dim, selection_name))
+            if len(futures) >= maximum_blocks_ahead:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def read_block(file_in, annotation_file_in, start_index, end_index, concat_dim, selection_name=None):
+    # Variables along concat_dim for elements start_index to end_index; concat_dim should be the first dimension.
+    with netCDF4.Dataset(file_in) as ds_in:
+        if selection_name == 'selected':
+            selection_in = ds_in['selected'][start_index:end_index].astype(bool)
+        elif selection_name == 'sequence_tile':
+            # has_sequence = (~(ds_in['sequence_aligned'][:] == b'-').all(axis=1))
+            selection_in = ds_in['sequence_tile'][start_index:end_index] > 0
+        else:
+            selection_in = slice(None)
+        block = read_variables(ds_in, start_index, end_index, concat_dim, selection_in)
+    if annotation_file_in is not None:
+        with netCDF4.Dataset(annotation_file_in) as ds_in:
+            block.update(read_variables(ds_in, start_index, end_index, concat_dim, selection_in))
+    return block
+
+
+def read_variables(ds_in, start_index, end_index, concat_dim, selection_in):
+    return {name: variable[start_index:end_index][selection_in] for name, variable in ds_in.variables.items()
+            if concat_dim in variable.dimensions}
+
+
+def write_block(ds_out, block, concat_dim, start_index_out):
+    if len(block) == 0 or len(next(iter(block.values()))) == 0:
+        return start_index_out
+    end_index_out = start_index_out + len(next(iter(block.values())))
+    for name, values in block.items():
+        if name == 'file':
+            min_len = min(values.shape[-1], ds_out[name].shape[-1])
+            ds_out[name][start_index_out:end_index_out, :min_len] = values[:, :min_len]
+        else:
+            ds_out[name][start_index_out:end_index_out] = values
+    return end_index_out
+
+
+def reorder_datasets_using_sequence_subset(files_in, folder_out, concat_dim, annotation_files_in=None, block_size=1000,
+                                           n_jobs=None):
+    """Regroup the elements of the input datasets into a separate netCDF file for each sequence subset.
+
+    The input files are scanned once to find the indices of each sequence subset. Subsequently, the file for each
+    sequence subset, named <sequence_subset>.nc, is written in blocks of at most block_size elements.
+
+    Parameters
+    ----------
+    files_in : list of str or pathlib.Path
+        Input netCDF files containing the sequence_subset variable.
+    folder_out : str or pathlib.Path
+        Folder in which the files are written, this folder should not yet exist.
+    concat_dim : str
+        Dimension along which the datasets are concatenated.
+    annotation_files_in : list, optional
+        For each file in files_in the file with additional variables (e.g. selections), or None.
+    block_size : int
+        Number of elements read at once from an input file.
+    n_jobs : int, optional
+        Number of processes writing files for different sequence subsets, by default the number of CPUs.
+    """
     folder_out = Path(folder_out)
     folder_out.mkdir(exist_ok=False)
-    for file_in in tqdm.tqdm(files_in):
-        with netCDF4.Dataset(file_in) as ds_in:
-            # selection = np.squeeze(ds['sequence_subset'][:].view('S8') != b'--------')
-            sequence_subsets = ds_in['sequence_subset'][:]
-            sequence_subsets.set_fill_value(b'-')
-            sequence_subsets = sequence_subsets.filled()
-            selection = (sequence_subsets != b'-').all(axis=1)
-            indices = np.where(selection)[0]
+    annotation_files_in = existing_annotation_files(files_in, annotation_files_in)
+
+    sources_per_sequence_subset = {}
+    for file_in, annotation_file_in in tqdm.tqdm(list(zip(files_in, annotation_files_in))):
+        for sequence_subset, indices in sequence_subset_indices(file_in).items():
+            sources_per_sequence_subset.setdefault(sequence_subset, []).append((file_in, annotation_file_in, indices))
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    Parallel(n_jobs=n_jobs)(delayed(write_selection)(folder_out / (sequence_subset + '.nc'), sources, concat_dim,
+                                                     block_size)
+                            for sequence_subset, sources in sources_per_sequence_subset.items())
+
+
+def sequence_subset_indices(file_in):
+    # Indices of the elements with a complete sequence subset, for each sequence subset
+    with netCDF4.Dataset(file_in) as ds_in:
+        # selection = np.squeeze(ds['sequence_subset'][:].view('S8') != b'--------')
+        sequence_subsets = ds_in['sequence_subset'][:]
+    sequence_subsets.set_fill_value(b'-')
+    return group_by_sequence_subset(sequence_subsets.filled())
+
+
+def group_by_sequence_subset(sequence_subsets):
+    """Indices of the elements with a complete sequence subset, for each sequence subset.
+
+    Parameters
+    ----------
+    sequence_subsets : numpy.ndarray
+        Characters of the sequence subset of each element, with the positions along the second dimension. Missing
+        positions are indicated by '-'.
+
+    Returns
+    -------
+    dict
+        Indices of the elements for each sequence subset.
+    """
+    selection = ((sequence_subsets != b'-') & (sequence_subsets != b'')).all(axis=1)
+    indices = np.where(selection)[0]
+
+    sequence_subsets = sequence_subsets[indices].view(f'S{sequence_subsets.shape[1]}').astype('U').reshape(-1)
+    unique_sequence_subsets, inverse = np.unique(sequence_subsets, return_inverse=True)
+    return {sequence_subset: indices[inverse == i] for i, sequence_subset in enumerate(unique_sequence_subsets)}
+
+
+def write_selection(file_out, sources, concat_dim, block_size=1000):
+    """Write the selected elements of one or more input datasets to a single netCDF file.
+
+    Parameters
+    ----------
+    file_out : str or pathlib.Path
+        Output netCDF file.
+    sources : list of tuple
+        For each input file the filepath, the filepath of the file with additional variables (or None) and the indices
+        along concat_dim of the elements to write.
+    concat_dim : str
+        Dimension along which the datasets are concatenated.
+    block_size : int
+        Number of elements read at once from an input file.
+    """
+    concat_dim_size = np.sum([len(indices) for _, _, indices in sources])
+    with netCDF4.Dataset(file_out, mode='w') as ds_out:
+        with netCDF4.Dataset(sources[0][0]) as ds_in:
+            init_dataset_like(ds_in, ds_out, concat_dim, concat_dim_size=concat_dim_size)
+        for _, annotation_file_in, _ in sources:
+            if annotation_file_in is not None:
+                with netCDF4.Dataset(annotation_file_in) as ds_in:
+                    init_dataset_like(ds_in, ds_out, concat_dim, concat_dim_size=concat_dim_size)
+
+        start_index_out = 0
+        for file_in, annotation_file_in, indices in sources:
+            for start_index in range(0, len(indices), block_size):
+                indices_block = indices[start_index:start_index + block_size]
+                with netCDF4.Dataset(file_in) as ds_in:
+                    block = read_variables_at(ds_in, indices_block, concat_dim)
+                if annotation_file_in is not None:
+                    with netCDF4.Dataset(annotation_file_in) as ds_in:
+                        block.update(read_variables_at(ds_in, indices_block, concat_dim))
+                start_index_out = write_block(ds_out, block, concat_dim, start_index_out)
 
-            sequence_subsets = sequence_subsets.view(f'S{sequence_subsets.shape[1]}').astype('U').squeeze()
 
-            for i in indices:
-                sequence_subset = sequence_subsets[i]
-                with netCDF4.Dataset(folder_out / (sequence_subset + '.nc'), mode='a') as ds_out:
-                    if concat_dim not in ds_out.dimensions.keys():
-                        init_dataset_like(ds_in, ds_out, concat_dim)
-                    append_index_to_dataset(ds_in, ds_out, concat_dim, i)
+def read_variables_at(ds_in, indices, concat_dim):
+    return {name: variable[indices] for name, variable in ds_in.variables.items() if concat_dim in variable.dimensions}
 
 
 def init_dataset_like(ds_in, ds_out, concat_dim, concat_dim_size=None):
-    ds_out.createDimension(concat_dim, concat_dim_size)
+    # Dimensions and variables already present in ds_out are skipped, so that ds_out can be initialized from multiple
+    # datasets.
+    if concat_dim not in ds_out.dimensions:
+        ds_out.createDimension(concat_dim, concat_dim_size)
     for name, dimension in ds_in.dimensions.items():
-        if name != concat_dim:
+        if name != concat_dim and name not in ds_out.dimensions:
             ds_out.createDimension(dimension.name, dimension.size)
 
     for name, variable in ds_in.variables.items():
+        if name in ds_out.variables:
+            continue
         if '_FillValue' in variable.ncattrs():
             fill_value = variable.getncattr('_FillValue')
         else:
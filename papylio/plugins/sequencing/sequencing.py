@@ -588,7 +588,7 @@ class File:
             sequencing_dataset['sequence_coordinates'][single_molecule_indices] = selected_sequencing_data.coordinates
         # sequencing_dataset['dimension'] = [b'x', b'y']
 
-        sequencing_dataset.to_netcdf(self.relativeFilePath.with_suffix('.nc'), engine='netcdf4', mode='a')
+        self._write_dataset(sequencing_dataset, mode='a')
 
     # @property
     # def sequences(self):
@@ -846,7 +846,7 @@ class File:
         sequencing_dataset = sequencing_dataset.reset_index('molecule').rename(molecule_='molecule_in_file')
 
         # Engine netcdf4 has some locking problems.
-        sequencing_dataset.to_netcdf(self.relativeFilePath.with_suffix('.nc'), engine='h5netcdf', mode='a')
+        self._write_dataset(sequencing_dataset, mode='a', engine='h5netcdf')
 
     def use_sequences_as_molecules(self):
         self.molecules = []
@@ -0,0 +1,169 @@
+"""Storage backends for datasets
+
+A storage backend determines the on-disk format of the datasets belonging to a file, i.e. the traces, annotations and
+movie corrections, and of merged datasets. The default backend stores netCDF files. The Zarr backend stores each
+dataset as a directory with a separate array per variable, divided in chunks stored in separate files. Appending
+variables therefore does not require rewriting the dataset, and merged datasets are written chunk by chunk. The Zarr
+backend requires the optional zarr package.
+
+The backend can be set in the configuration file:
+
+    trace_storage:
+        backend: zarr
+"""
+
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+import xarray as xr
+
+
+class NetCDFStorage:
+    name = 'netcdf'
+    extension = '.nc'
+
+    def __init__(self, engine='netcdf4'):
+        self.engine = engine
+
+    def exists(self, filepath):
+        return Path(filepath).is_file()
+
+    def modification_time(self, filepath):
+        return Path(filepath).stat().st_mtime_ns
+
+    def open(self, filepath, **kwargs):
+        return xr.open_dataset(filepath, engine=self.engine, **kwargs)
+
+    def load(self, filepath):
+        return xr.load_dataset(filepath, engine=self.engine)
+
+    def write(self, dataset, filepath, mode='a', encoding=None):
+        if mode == 'a' and not self.exists(filepath):
+            mode = 'w'
+        dataset.to_netcdf(filepath, engine=self.engine, mode=mode, encoding=self.convert_encoding(encoding))
+
+    def convert_encoding(self, encoding):
+        return encoding
+
+    def copy(self, filepath, filepath_out):
+        shutil.copy2(filepath, filepath_out)
+
+    def replace(self, filepath, filepath_out):
+        os.replace(filepath, filepath_out)
+
+    def remove(self, filepath):
+        Path(filepath).unlink(missing_ok=True)
+
+
+class ZarrStorage:
+    name = 'zarr'
+    extension = '.zarr'
+
+    def exists(self, filepath):
+        return Path(filepath).is_dir()
+
+    def modification_time(self, filepath):
+        # The consolidated metadata is rewritten upon each write, the directory itself is not necessarily modified.
+        filepath = Path(filepath)
+        for metadata_filename in ['.zmetadata', 'zarr.json']:
+            if filepath.joinpath(metadata_filename).is_file():
+                return filepath.joinpath(metadata_filename).stat().st_mtime_ns
+        return filepath.stat().st_mtime_ns
+
+    def open(self, filepath, chunks=None, **kwargs):
+        # Without chunks the variables are lazily indexed instead of converted to dask arrays
+        return xr.open_zarr(filepath, chunks=chunks, **kwargs)
+
+    def load(self, filepath):
+        with self.open(filepath) as dataset:
+            return dataset.load()
+
+    def write(self, dataset, filepath, mode='a', encoding=None):
+        if mode == 'a' and self.exists(filepath):
+            # Encoding can only be set for variables that are not yet present in the store
+            with self.open(filepath) as dataset_present:
+                encoding = {name: value for name, value in (encoding or {}).items()
+                            if name not in dataset_present.variables}
+        else:
+            mode = 'w'
+        dataset.to_zarr(filepath, mode=mode, encoding=self.convert_encoding(encoding))
+
+    def convert_encoding(self, encoding):
+        # Translates netCDF encoding, compression is handled by the default compressor of zarr
+        converted_encoding = {}
+        for name, variable_encoding in (encoding or {}).items():
+            converted_encoding[name] = {}
+            if 'chunksizes' in variable_encoding:
+                converted_encoding[name]['chunks'] = variable_encoding['chunksizes']
+            if 'dtype' in variable_encoding:
+                converted_encoding[name]['dtype'] = variable_encoding['dtype']
+        return converted_encoding
+
+    def copy(self, filepath, filepath_out):
+        shutil.copytree(filepath, filepath_out)
+
+    def replace(self, filepath, filepath_out):
+        # A directory cannot be replaced in a single step, so the old directory is moved aside first.
+        filepath_out = Path(filepath_out)
+        filepath_old = filepath_out.with_name(filepath_out.name + f'.{uuid.uuid4().hex}.old')
+        if filepath_out.exists():
+            os.replace(filepath_out, filepath_old)
+        os.replace(filepath, filepath_out)
+        shutil.rmtree(filepath_old, ignore_errors=True)
+
+    def remove(self, filepath):
+        shutil.rmtree(filepath, ignore_errors=True)
+
+
+storage_backends = {'netcdf': NetCDFStorage, 'zarr': ZarrStorage}
+
+
+def get_storage(backend='netcdf', **kwargs):
+    """Storage backend by name
+
+    Parameters
+    ----------
+    backend : str
+        Name of the backend, either 'netcdf' or 'zarr'.
+    kwargs
+        Keyword arguments passed to the backend, e.g. engine for the netcdf backend.
+
+    Returns
+    -------
+    NetCDFStorage or ZarrStorage
+    """
+    if backend is None:
+        backend = 'netcdf'
+    if backend not in storage_backends:
+        raise ValueError(f'Unknown storage backend {backend}, choose from {list(storage_backends.keys())}')
+    if backend == 'zarr':
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError('The zarr storage backend requires the zarr package, install it with pip install zarr')
+    return storage_backends[backend](**kwargs)
+
+
+def write_merged_dataset(datasets, filepath_out, storage, concat_dim='molecule', chunk_size=1000):
+    """Concatenate datasets into a single stored dataset, chunk by chunk.
+
+    Parameters
+    ----------
+    datasets : list of xarray.Dataset
+        Lazily opened datasets, selections along the concat_dim can already be applied.
+    filepath_out : str or pathlib.Path
+        Path of the merged dataset.
+    storage : NetCDFStorage or ZarrStorage
+        Storage backend used for the merged dataset.
+    concat_dim : str
+        Dimension along which the datasets are concatenated.
+    chunk_size : int
+        Size of the chunks along concat_dim, in which the data is read and written.
+    """
+    datasets = [dataset.chunk({concat_dim: chunk_size}) for dataset in datasets]
+    dataset = xr.concat(datasets, dim=concat_dim, data_vars='minimal', coords='minimal', compat='override',
+                        join='outer', combine_attrs='override')
+    dataset = dataset.chunk({concat_dim: chunk_size})
+    storage.write(dataset, filepath_out, mode='w')
@@ -4,6 +4,7 @@ import xarray as xr
 from tqdm import tqdm
 import dask_image.ndfilters
 import scipy.ndimage
+import scipy.sparse
 
 def make_gaussian_mask(size, offsets, sigma=1.291):
     # TODO: Explain calculation in docstring
@@ -22,22 +23,45 @@ def make_gaussian_mask(size, offsets, sigma=1.291):
     masks = masks/norm_factors
     return masks
 
-def extract_traces(movie, coordinates, background=None, mask_size=1.291, neighbourhood_size=11, correct_illumination=False):
-    # go through all images, extract donor and acceptor signal
-    # TODO: Process the movie in chunks
-    # TODO: Make sure the corretions are not reloaded for each chunk,
-    #  for example by loading them once at the with statement or by keeping recent variables in the cache/memmory
-
+def extract_traces(movie, coordinates, background=None, mask_size=1.291, neighbourhood_size=11, correct_illumination=False,
+                   chunk_size=None, maximum_chunk_memory=None, dtype='float32'):
+    """Extract intensity traces from a movie using Gaussian masks around the coordinates.
+
+    The movie is processed in chunks of frames, for each chunk the pixel values in the neighbourhood of all coordinates
+    are gathered and weighted in a single vectorized operation. The peak memory is set by the chunk size and not by
+    the length of the movie.
+
+    Parameters
+    ----------
+    movie : papylio.movie.movie.Movie
+        Movie to extract the traces from.
+    coordinates : xarray.DataArray
+        Coordinates with dimensions ('molecule', 'channel', 'dimension').
+    mask_size : float
+        Standard deviation of the Gaussian mask.
+    neighbourhood_size : int
+        Width of the square neighbourhood around each coordinate.
+    chunk_size : int, optional
+        Number of frames read and processed at once. By default `movie.chunk_size` is used.
+    maximum_chunk_memory : int, optional
+        Memory budget in bytes for a single chunk of frames. If given, the chunk size is derived from this budget
+        (and chunk_size is ignored).
+    dtype : str, optional
+        Data type of the extracted intensities, by default float32.
+
+    Returns
+    -------
+    xarray.Dataset
+        Dataset containing the intensity traces.
+    """
     coordinates['dimension'] = coordinates.dimension.astype('U')
     with movie:
         movie.read_header()
 
-        if movie.number_of_frames > 500:
-            all_frames_in_memory = False
-        else:
-            all_frames_in_memory = True
+        chunk_size = determine_chunk_size(movie, chunk_size, maximum_chunk_memory)
 
-        intensity = xr.DataArray(np.empty((len(coordinates.molecule), len(coordinates.channel), movie.number_of_frames)),
+        intensity = xr.DataArray(np.empty((len(coordinates.molecule), len(coordinates.channel), movie.number_of_frames),
+                                          dtype=dtype),
                                  dims=['molecule', 'channel', 'frame'],
                                  coords=coordinates.drop('dimension').coords, name='intensity')
 
@@ -73,42 +97,22 @@ def extract_traces(movie, coordinates, background=None, mask_size=1.291, neighbo
         # background_per_frame = background.sel(illumination=movie.illumination)
         # background_correction[:] = weighed_background(background_per_frame, twoD_gaussians).transpose((1,2,0))
 
-        if all_frames_in_memory:
-            frames = movie.read_frames(xarray=False, flatten_channels=True)#.astype('uint16')
-
         oneD_indices = (roi_indices.sel(dimension='y')*movie.width+roi_indices.sel(dimension='x')).stack(peak=('molecule','channel')).stack(i=('y','x'))
-        for frame_index in tqdm(range(movie.number_of_frames), desc=movie.name, leave=True):  # self.number_of_frames also works for pm, len(self.movie_file_object.filelist) not
-            # print(frame_number)
-            # if frame_number % 13 == 0:
-            #     sys.stdout.write(f'\r   Frame {frame_number} of {movie.number_of_frames}')
-
-            # image = movie.read_frame(frame_index, xarray=False, flatten_channels=True).astype('uint16')
-            if all_frames_in_memory:
-                image = frames[frame_index]
-            else:
-                image = movie.read_frame(frame_index, xarray=False, flatten_channels=True)#.astype('uint16')
-            frame = xr.DataArray(image, dims=('y','x'))
-
-            # TODO: Proper background subtraction
-
-            # if correct_illumination:
-            #     illumination_correction.add_frame(frame_index, frame)
-            #     # TODO: Determine how illumination correction is dependent on background
-
-            # if 'illumination' in background.dims:
-            #     # TODO: Make this work properly and rename illumination in Movie
-            #     # Do background subtraction on entire frame instead???
-            #     frame_background = background.sel(illumination=movie.illumination.sel(frame=frame_index))
-            #     # frame_background = background[frame_number % number_illumination]
-            # else:
-            #     frame_background = background
-
-            #intensity[:, :, frame_index] = extract_intensity_from_frame(frame, background, roi_indices, twoD_gaussians)
-            # intensity[:, :, frame_index] = extract_intensity_from_frame(frame, frame_background, oneD_indices, twoD_gaussians)
-            intensity[:, :, frame_index] = extract_intensity_from_frame(frame, oneD_indices, twoD_gaussians)
-
-
-        # sys.stdout.write(f'\r   Frame {frame_number+1} of {movie.number_of_frames}\n')
+        weight_matrix = make_weight_matrix(oneD_indices, twoD_gaussians, movie.pixels_per_frame)
+
+        with tqdm(total=movie.number_of_frames, desc=movie.name, leave=True) as progress_bar:
+            for frame_indices_chunk, frames in movie.iter_frame_blocks(block_size=chunk_size, xarray=False,
+                                                                       flatten_channels=True):
+                # TODO: Proper background subtraction
+
+                # if correct_illumination:
+                #     illumination_correction.add_frame(frame_index, frame)
+                #     # TODO: Determine how illumination correction is dependent on background
+
+                intensity.values[:, :, frame_indices_chunk] = \
+                    extract_intensity_from_frames(frames, weight_matrix).reshape(intensity.shape[:2] + (-1,))
+                progress_bar.update(len(frame_indices_chunk))
+
         dataset = intensity.to_dataset()
         # dataset['intensity_raw'] = dataset.intensity.copy()
 
@@ -121,6 +125,18 @@ def extract_traces(movie, coordinates, background=None, mask_size=1.291, neighbo
 
     return dataset
 
+
+def determine_chunk_size(movie, chunk_size=None, maximum_chunk_memory=None):
+    """Number of frames to process at once, based on a fixed number of frames or a memory budget in bytes.
+
+    The memory budget is compared to the size of the corrected (float32) frames.
+    """
+    if maximum_chunk_memory is not None:
+        chunk_size = maximum_chunk_memory // (movie.pixels_per_frame * np.dtype(np.float32).itemsize)
+    elif chunk_size is None:
+        chunk_size = movie.chunk_size
+    return int(max(chunk_size, 1))
+
 # def extract_intensity_from_frame(frame, background, roi_indices, twoD_gaussians):
 #     intensities = frame.sel(x=roi_indices.sel(dimension='x'), y=roi_indices.sel(dimension='y'))
 #     intensities = intensities - background
@@ -143,6 +159,35 @@ def extract_intensity_from_frame(frame, oneD_indices, twoD_gaussians):  # extrac
     intensity_in_frame = weighted_intensities.sum(axis=(2,3))
     return intensity_in_frame
 
+def make_weight_matrix(oneD_indices, twoD_gaussians, number_of_pixels):
+    """Sparse matrix with the mask weights of each peak (molecule and channel) for each pixel in the frame
+
+    Parameters
+    ----------
+    oneD_indices : xarray.DataArray
+        Flattened pixel indices with dimensions ('peak', 'i'), where peak is the stacked molecule and channel dimension.
+    twoD_gaussians : xarray.DataArray
+        Masks with dimensions ('molecule', 'channel', 'y', 'x').
+    number_of_pixels : int
+        Number of pixels in a frame.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Weight matrix with shape (number of peaks, number of pixels). Weights for pixels that occur multiple times
+        within a mask are summed.
+    """
+    number_of_peaks = oneD_indices.shape[0]
+    rows = np.repeat(np.arange(number_of_peaks), oneD_indices.shape[1])
+    weight_matrix = scipy.sparse.csr_matrix((twoD_gaussians.values.ravel(), (rows, oneD_indices.values.ravel())),
+                                            shape=(number_of_peaks, number_of_pixels))
+    weight_matrix.sum_duplicates()
+    return weight_matrix
+
+def extract_intensity_from_frames(frames, weight_matrix):
+    # frames: (frame, y, x) array, returns intensities with dimensions (peak, frame)
+    return weight_matrix @ frames.reshape(len(frames), -1).T
+
 def weighed_background(background, twoD_gaussians):
     weighed_background_intensity = background.values[:, :, :, None, None] * twoD_gaussians.values[None, :, :, :, :]
     return weighed_background_intensity.sum(axis=(3, 4))
@@ -0,0 +1,62 @@
+import pytest
+import numpy as np
+
+
+@pytest.fixture
+def experiment(shared_datadir):
+    from papylio import Experiment
+    return Experiment(shared_datadir / 'BN_TIRF')
+
+
+def test_extract_traces_parallel(experiment):
+    files = experiment.files[1:]
+    files.find_coordinates()
+    files.extract_traces()
+    intensity_serial = [file.intensity.values for file in files]
+
+    # The files are pickled to the worker processes and the datasets opened in this process are closed beforehand
+    files.serial.open_dataset()
+    timings = experiment.extract_traces_parallel(files, workers=2)
+    assert list(timings.index) == [str(file.relativeFilePath) for file in files]
+    assert timings.error.isna().all()
+    for file, intensity in zip(files, intensity_serial):
+        assert np.allclose(file.intensity.values, intensity)
+
+    # Errors in the workers are reported for each file instead of raised
+    with pytest.warns(UserWarning, match='Trace extraction failed'):
+        timings = experiment.extract_traces_parallel(files, workers=2, unknown_setting=True)
+    assert timings.error.str.contains('TypeError').all()
+
+
+def test_find_coordinates_parallel(experiment):
+    files = experiment.files[1:]
+    files.find_coordinates()
+    coordinates_serial = [file.coordinates.values for file in files]
+
+    # The files are pickled to the worker processes, each file uses its own mapping
+    files.serial.open_dataset()
+    timings = experiment.find_coordinates_parallel(files, workers=2)
+    assert list(timings.index) == [str(file.relativeFilePath) for file in files]
+    assert timings.error.isna().all()
+    for file, coordinates in zip(files, coordinates_serial):
+        assert np.allclose(file.coordinates.values, coordinates)
+
+    # Errors in the workers are reported for each file and the coordinates are left unchanged
+    with pytest.warns(UserWarning, match='Finding coordinates failed'):
+        timings = experiment.find_coordinates_parallel(files, workers=2, method='unknown')
+    assert timings.error.str.contains('ValueError').all()
+    for file, coordinates in zip(files, coordinates_serial):
+        assert np.allclose(file.coordinates.values, coordinates)
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_nc_file_paths(tmp_path, backend):
+    from pathlib import Path
+    from papylio import Experiment
+    tmp_path.joinpath('movie.tif').touch()
+    tmp_path.joinpath('movie.nc').touch()
+    tmp_path.joinpath('movie.zarr').mkdir()
+    experiment = Experiment(tmp_path, import_all=False)
+    experiment.configuration['trace_storage'] = {'backend': backend}
+    extension = experiment.files[0].storage.extension
+    assert experiment.nc_file_paths == [Path('movie' + extension)]
@@ -59,6 +59,17 @@ def test_perform_mapping(experiment, shared_datadir):
 def test_find_molecules(file):
     file.find_coordinates()
 
+def test_determine_coordinates(file):
+    def dataset_modification_time():
+        if file.storage.exists(file.dataset_filepath):
+            return file.storage.modification_time(file.dataset_filepath)
+
+    modification_time = dataset_modification_time()
+    coordinates = file.determine_coordinates(file.experiment.configuration['find_coordinates'])
+    assert dataset_modification_time() == modification_time
+    file.find_coordinates()
+    assert (file.coordinates.values == coordinates.values).all()
+
 def test_extract_traces(file):
     file.find_coordinates()
     file.extract_traces()
@@ -67,6 +78,15 @@ def test_extract_traces(file):
                         alpha_correction=0.075,
                         gamma_correction=1.2)
 
+def test_trace_storage(file):
+    import netCDF4
+    file.find_coordinates()
+    file.extract_traces()
+    with netCDF4.Dataset(file.absoluteFilePath.with_suffix('.nc')) as dataset:
+        assert dataset['intensity'].dtype == np.float32
+        assert dataset['intensity'].filters()['zlib']
+        assert dataset['intensity'].chunking()[0] <= file.storage_configuration['chunk_molecules']
+
 def test_property_coordinates(file_output):
     file_output.coordinates
 
@@ -88,6 +108,64 @@ def test_save_dataset_selected(file_output_with_selected):
     indices_selected = np.nonzero(ds.molecule_in_file.values)[0]
     assert (indices_selected == np.array([0,5,33])).all().item()
 
+def test_get_variable(file_output_with_selected):
+    file = file_output_with_selected
+    intensity = file.intensity.sel(molecule=file.selected, frame=slice(2, 8))
+    intensity_read = file.get_variable('intensity', selected=True, frame_range=(2, 8))
+    assert (intensity_read == intensity).all().item()
+    intensity_read = file.get_variable('intensity', selected=True, frame_range=(2, 8), channel=1)
+    assert (intensity_read == intensity.sel(channel=1)).all().item()
+    file.maximum_read_chunk_size = 1
+    for average in ['frame', 'molecule']:
+        intensity_average = file.get_variable('intensity', selected=True, frame_range=(2, 8), average=average)
+        assert np.allclose(intensity_average.squeeze(), intensity.mean(dim=average))
+
+def test_get_variable_returns_copy(file_output):
+    selected = file_output.get_variable('selected')
+    selected[:] = True
+    assert not file_output.get_variable('selected').any().item()
+    intensity = file_output.get_variable('intensity', frame_range=(2, 8))
+    intensity[:] = 0
+    assert (file_output.get_variable('intensity', frame_range=(2, 8)) != 0).any().item()
+
+def test_batch_write(file_output):
+    selection = file_output.selected
+    selection[:] = True
+    with pytest.raises(RuntimeError):
+        with file_output.batch_write():
+            file_output.set_variable(selection, name='selection_batch')
+            assert file_output.selection_batch.all().item()
+            raise RuntimeError
+    assert not hasattr(file_output, 'selection_batch')
+
+    # A batch with only annotations does not touch the .nc file
+    modification_time = file_output.absoluteFilePath.with_suffix('.nc').stat().st_mtime_ns
+    with file_output.batch_write():
+        file_output.set_variable(selection, name='selection_batch')
+        file_output.set_variable(~selection, name='selection_batch_inverse')
+    assert file_output.absoluteFilePath.with_suffix('.nc').stat().st_mtime_ns == modification_time
+
+    with file_output.batch_write():
+        file_output.apply_selections(['selection_batch'])
+    assert file_output.selected.all().item()
+
+    for atomic in [False, True]:
+        with file_output.batch_write(atomic=atomic):
+            file_output.set_variable(file_output.intensity * 2, name='intensity_batch')
+        assert (file_output.intensity_batch == file_output.intensity * 2).all().item()
+
+def test_clear_selections(file_output):
+    selection = file_output.selected
+    selection[:] = True
+    file_output.set_variable(selection, name='selection_test')
+    assert file_output.annotations_filepath.exists()
+    assert file_output.selection_test.all().item()
+
+    modification_time = file_output.absoluteFilePath.with_suffix('.nc').stat().st_mtime_ns
+    file_output.clear_selections()
+    assert not hasattr(file_output, 'selection_test')
+    assert file_output.absoluteFilePath.with_suffix('.nc').stat().st_mtime_ns == modification_time
+
 def test_classify_hmm(file_output):
     selection = file_output.selected
     selection[0:20] = True
@@ -97,4 +175,13 @@ def test_classify_hmm(file_output):
     file_output.classify_hmm(file_output.intensity.sel(channel=0, drop=True))
 
 def test_use_for_darkfield_correction(file):
-    file.use_for_darkfield_correction()
\ No newline at end of file
+    file.use_for_darkfield_correction()
+
+def test_determine_coordinates_more_than_two_channels(file):
+    from papylio.movie.movie import Channel
+    file.movie.channels.append(Channel(file.movie, 'blue', 'b'))
+    file.movie.channel_arrangement = [[[0, 1, 2]]]
+    with pytest.raises(ValueError, match='one or two channels'):
+        file.determine_coordinates(file.experiment.configuration['find_coordinates'])
+    with pytest.raises(ValueError, match='channel 2'):
+        file.transform_coordinates_to_main_channel(np.zeros((1, 2)), 2)
@@ -0,0 +1,23 @@
+import pytest
+import numpy as np
+
+
+@pytest.fixture
+def experiment_output(shared_datadir):
+    from papylio import Experiment
+    return Experiment(shared_datadir / 'BN_TIRF_output_test_file')
+
+
+def test_molecule_index(experiment_output):
+    files_with_dataset = [file for file in experiment_output.files if '.nc' in file.extensions]
+    molecule_index = experiment_output.molecule_index
+    assert len(molecule_index) == np.sum([file.number_of_molecules for file in files_with_dataset])
+    assert molecule_index.filepath.is_file()
+
+    file = files_with_dataset[0]
+    selected = file.selected
+    selected[:] = True
+    file.set_variable(selected)
+    table = experiment_output.molecule_index.query('selected')
+    assert (table['file'] == str(file.relativeFilePath)).all()
+    assert len(table) == file.number_of_molecules
@@ -42,6 +42,32 @@ def test_make_projection_images(movie, shared_datadir):
     movie.make_projection_images(projection_type='average', frame_range=(0,20))
 
 
+@pytest.mark.parametrize('projection_type', ['average', 'maximum'])
+def test_iter_projection_images(movie, projection_type):
+    frame_ranges = [(start_frame, start_frame + 20) for start_frame in range(0, 100, 15)]
+    for frame_range, image in movie.iter_projection_images(frame_ranges, projection_type=projection_type):
+        image_expected = movie.make_projection_image(projection_type=projection_type, frame_range=frame_range,
+                                                     use_cache=False)
+        assert np.allclose(image, image_expected, atol=1e-3)
+
+
+@pytest.mark.parametrize('projection_type', ['average', 'maximum'])
+@pytest.mark.parametrize('apply_corrections', [True, False])
+def test_make_projection_image_dask(movie, projection_type, apply_corrections):
+    pytest.importorskip('dask')
+    image = movie.make_projection_image(projection_type=projection_type, frame_range=(0, 20),
+                                        apply_corrections=apply_corrections, use_cache=False)
+    movie.use_dask = True
+    image_dask = movie.make_projection_image(projection_type=projection_type, frame_range=(0, 20),
+                                             apply_corrections=apply_corrections, use_cache=False)
+    assert np.allclose(image_dask, image, atol=1e-3)
+
+    frames = movie.read_frames(np.arange(5), xarray=False)
+    out = np.empty(frames.shape, dtype=frames.dtype)
+    assert movie.read_frames(np.arange(5), xarray=False, out=out) is out
+    assert (out == frames.compute()).all()
+
+
 def test_determine_background_correction(experiment, shared_datadir):
     movie = experiment.files[1].movie
 
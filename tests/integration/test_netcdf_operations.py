@@ -1,6 +1,6 @@
 import pytest
 import numpy as np
-from papylio.netcdf_operations import merge_datasets, reorder_datasets_using_sequence_subset
+from papylio.netcdf_operations import merge_datasets, reorder_datasets_using_sequence_subset, element_nbytes
 import netCDF4
 
 @pytest.fixture
@@ -24,10 +24,59 @@ def test_merge_datasets_sequence_only(shared_datadir, netcdf_filepaths):
     ds_in1 = netCDF4.Dataset(netcdf_filepaths[1])
     assert (ds_out['intensity'][319:319+318] == ds_in1['intensity'][(ds_in1['sequence'][:]!=b'-').all(axis=1)]).all()
 
+def test_merge_datasets_in_blocks(tmp_path):
+    import xarray as xr
+    filepaths = []
+    for i, size in enumerate([25, 0, 12]):
+        dataset = xr.Dataset({'intensity': (('molecule', 'frame'), np.random.rand(size, 10)),
+                              'selected': ('molecule', np.arange(size) % 3 == 0)})
+        filepaths.append(tmp_path / f'file{i}.nc')
+        dataset.to_netcdf(filepaths[-1], engine='netcdf4')
+
+    intensity_in = [netCDF4.Dataset(p)['intensity'][:] for p in filepaths]
+    intensity_in = np.concatenate([intensity[np.arange(len(intensity)) % 3 == 0] for intensity in intensity_in])
+
+    merge_datasets(filepaths, tmp_path / 'file_out.nc', 'molecule', with_selected_only=True, block_size=4, n_jobs=2)
+    ds_out = netCDF4.Dataset(tmp_path / 'file_out.nc')
+    assert (ds_out['intensity'][:] == intensity_in).all()
+
+    # Blocks of two molecules of 81 bytes each, with at most two blocks read ahead
+    assert element_nbytes(ds_out, 'molecule') == 81
+    merge_datasets(filepaths, tmp_path / 'file_out_budget.nc', 'molecule', with_selected_only=True,
+                   maximum_block_nbytes=200, maximum_blocks_ahead=2)
+    ds_out = netCDF4.Dataset(tmp_path / 'file_out_budget.nc')
+    assert (ds_out['intensity'][:] == intensity_in).all()
+
+
 def test_reorder_datasets_using_sequence_subset(shared_datadir, netcdf_filepaths):
     reorder_datasets_using_sequence_subset(netcdf_filepaths, shared_datadir, 'molecule')
 
 
+def test_reorder_datasets_using_sequence_subset_with_annotations(tmp_path):
+    import xarray as xr
+    sequence_subsets = [np.array([b'AC', b'--', b'GT', b'AC', b'AC']), np.array([b'GT', b'AC', b'A-'])]
+    filepaths, annotation_filepaths = [], []
+    for i, sequence_subset in enumerate(sequence_subsets):
+        size = len(sequence_subset)
+        xr.Dataset({'intensity': (('molecule', 'frame'), np.random.rand(size, 10))}) \
+            .to_netcdf(tmp_path / f'file{i}.nc', engine='netcdf4')
+        with netCDF4.Dataset(tmp_path / f'file{i}.nc', mode='a') as ds:
+            ds.createDimension('subset_position', 2)
+            ds.createVariable('sequence_subset', 'S1', ('molecule', 'subset_position'))[:] = \
+                sequence_subset.view('S1').reshape(size, 2)
+        xr.Dataset({'selection_test': ('molecule', np.arange(size) % 2 == i)}) \
+            .to_netcdf(tmp_path / f'file{i}_annotations.nc', engine='netcdf4')
+        filepaths.append(tmp_path / f'file{i}.nc')
+        annotation_filepaths.append(tmp_path / f'file{i}_annotations.nc')
+
+    reorder_datasets_using_sequence_subset(filepaths, tmp_path / 'out', 'molecule',
+                                           annotation_files_in=annotation_filepaths, block_size=2, n_jobs=1)
+
+    ds_out = netCDF4.Dataset(tmp_path / 'out' / 'AC.nc')
+    intensity_in = [netCDF4.Dataset(filepath)['intensity'][:] for filepath in filepaths]
+    assert (ds_out['intensity'][:] == np.vstack([intensity_in[0][[0, 3, 4]], intensity_in[1][[1]]])).all()
+    assert (ds_out['selection_test'][:] == [True, False, True, True]).all()
+
 
 
 # def test_merge_datasets():
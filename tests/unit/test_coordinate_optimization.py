@@ -0,0 +1,75 @@
+import numpy as np
+from papylio.coordinate_optimization import coordinates_after_gaussian_fit, fit_twoD_gaussians, twoD_gaussian, \
+    merge_nearby_coordinates, combine_coordinate_sets
+
+
+def test_fit_twoD_gaussians():
+    x, y = np.meshgrid(np.arange(9) - 4, np.arange(9) - 4)
+    parameters_true = np.array([[100, 500, 0.3, -0.6, 1.3], [50, 200, -1.2, 0.8, 1.8], [0, 1000, 0, 0, 1]])
+    patches = np.stack([twoD_gaussian((x, y), *p) for p in parameters_true])
+
+    parameters, uncertainties, converged = fit_twoD_gaussians(patches)
+    assert converged.all()
+    np.testing.assert_allclose(parameters, parameters_true, atol=1e-4)
+
+    parameters, uncertainties, converged = fit_twoD_gaussians(patches + np.random.normal(0, 5, patches.shape),
+                                                              sigma=1.5)
+    assert converged.all()
+    assert (parameters[:, 4] == 1.5).all()
+    assert (uncertainties[:, 4] == 0).all() and (uncertainties[:, :4] > 0).all()
+
+
+def test_fit_twoD_gaussians_without_spot():
+    rng = np.random.default_rng(0)
+    hot_pixel_patches = np.full((3, 5, 5), 100.)
+    hot_pixel_patches[:, 2, 2] += [50, 400, 1000]
+    noisy_hot_pixel_patches = rng.normal(100, 5, (10, 5, 5))
+    noisy_hot_pixel_patches[:, 2, 2] += 400
+    noise_patches = rng.normal(100, 5, (10, 3, 3))
+    for patches in [hot_pixel_patches, noisy_hot_pixel_patches, noise_patches, np.full((1, 5, 5), 100.)]:
+        parameters, uncertainties, converged = fit_twoD_gaussians(patches)
+        assert not converged.any()
+
+    # Fits that run out of iterations have not converged
+    x, y = np.meshgrid(np.arange(9) - 4, np.arange(9) - 4)
+    patches = twoD_gaussian((x, y), 100, 500, 0.3, -0.6, 1.3)[None] + rng.normal(0, 5, (1, 9, 9))
+    assert not fit_twoD_gaussians(patches, maximum_iterations=1)[2].any()
+
+
+def test_coordinates_after_gaussian_fit():
+    coordinates_true = np.array([[20.3, 30.6], [50.8, 12.1], [70.5, 70.5]])
+    x, y = np.meshgrid(np.arange(100), np.arange(90))
+    image = np.sum([twoD_gaussian((x, y), 10, 300, *c, 1.4) for c in coordinates_true], axis=0)
+
+    coordinates, parameters, uncertainties = \
+        coordinates_after_gaussian_fit(np.round(coordinates_true), image, gaussian_width=7, return_fit_parameters=True,
+                                       return_uncertainties=True)
+    np.testing.assert_allclose(coordinates, coordinates_true, atol=1e-3)
+    assert parameters.shape == uncertainties.shape == (3, 5)
+
+    coordinates = coordinates_after_gaussian_fit(np.vstack([coordinates_true, [[1, 1]]]), image, gaussian_width=7,
+                                                 sigma=1.4)
+    np.testing.assert_allclose(coordinates, coordinates_true, atol=1e-3)
+
+
+def test_merge_nearby_coordinates():
+    coordinates = np.array([[10, 10], [11, 10], [11.5, 10.5], [30, 30], [50, 50], [51.5, 50], [53, 50], [54.5, 50]])
+    new_coordinates = merge_nearby_coordinates(coordinates, distance_threshold=2)
+    # The chain of points around (52, 50) is a single group, which is removed as it is wider than the threshold
+    new_coordinates_expected = np.array([[32.5 / 3, 30.5 / 3], [30, 30]])
+    assert np.allclose(new_coordinates[np.lexsort(new_coordinates.T[::-1])], new_coordinates_expected)
+
+
+def test_combine_coordinate_sets():
+    coordinate_sets = [np.array([[10, 10], [20, 20], [30, 30]]),
+                       np.array([[10.5, 10], [30, 31], [30, 29.5], [50, 50]]),
+                       np.array([[30, 30.5], [10, 9], [70, 70]])]
+
+    coordinates = combine_coordinate_sets(coordinate_sets, method='and', distance_threshold=1.5)
+    assert np.allclose(coordinates, [[30.5 / 3, 29 / 3], [30, 30]])
+
+    coordinates = combine_coordinate_sets(coordinate_sets, method='or', distance_threshold=1.5)
+    assert np.allclose(coordinates, [[10, 10], [20, 20], [30, 30], [50, 50], [70, 70]])
+
+    assert np.allclose(combine_coordinate_sets(coordinate_sets, method=1), coordinate_sets[1])
+    assert combine_coordinate_sets([coordinate_sets[0], np.zeros((0, 2))], method='and').shape == (0, 2)
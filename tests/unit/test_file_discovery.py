@@ -0,0 +1,62 @@
+import os
+import time
+from papylio.file_discovery import FileManifest
+
+
+def set_modification_time_in_the_past(*folder_paths):
+    # Folders modified shortly before they are listed are always listed again
+    for folder_path in folder_paths:
+        modification_time = time.time_ns() - 60 * 10**9
+        os.utime(folder_path, ns=(modification_time, modification_time))
+
+
+def test_file_manifest(tmp_path):
+    tmp_path.joinpath('folder', '.hidden').mkdir(parents=True)
+    tmp_path.joinpath('store.zarr', 'intensity').mkdir(parents=True)
+    for filepath in ['movie.tif', 'folder/movie.tif', 'folder/.hidden/movie.tif', 'store.zarr/intensity/0']:
+        tmp_path.joinpath(filepath).touch()
+    set_modification_time_in_the_past(tmp_path, tmp_path / 'folder')
+
+    manifest = FileManifest(tmp_path)
+    paths = manifest.paths()
+    assert {path.relative_to(tmp_path).as_posix() for path in paths} == {'movie.tif', 'folder/movie.tif', 'store.zarr'}
+    manifest.save()
+
+    # Reuse the listing of a folder, as long as its modification time is unchanged
+    manifest = FileManifest(tmp_path)
+    manifest.directories['folder']['files'].append('cached.tif')
+    assert tmp_path / 'folder' / 'cached.tif' in manifest.paths()
+
+    tmp_path.joinpath('folder', 'new.tif').touch()
+    folder_stat = tmp_path.joinpath('folder').stat()
+    os.utime(tmp_path / 'folder', ns=(folder_stat.st_atime_ns, folder_stat.st_mtime_ns + 1))
+    paths = manifest.paths()
+    assert tmp_path / 'folder' / 'new.tif' in paths
+    assert tmp_path / 'folder' / 'cached.tif' not in paths
+    assert manifest.is_changed
+
+
+def test_file_manifest_file_added_within_time_resolution(tmp_path):
+    tmp_path.joinpath('folder').mkdir()
+    tmp_path.joinpath('folder', 'movie.tif').touch()
+    manifest = FileManifest(tmp_path)
+    assert tmp_path / 'folder' / 'movie.tif' in manifest.paths()
+    manifest.save()
+
+    # A file added directly after listing may leave the modification time of the folder unchanged
+    folder_stat = tmp_path.joinpath('folder').stat()
+    tmp_path.joinpath('folder', 'new.tif').touch()
+    os.utime(tmp_path / 'folder', ns=(folder_stat.st_atime_ns, folder_stat.st_mtime_ns))
+    manifest = FileManifest(tmp_path)
+    assert tmp_path / 'folder' / 'new.tif' in manifest.paths()
+    manifest.save()
+
+    # Once the folder was listed well after its last modification, the listing is reused
+    set_modification_time_in_the_past(tmp_path, tmp_path / 'folder')
+    manifest = FileManifest(tmp_path)
+    manifest.paths()
+    manifest.save()
+    manifest = FileManifest(tmp_path)
+    manifest.directories['folder']['files'].append('cached.tif')
+    assert tmp_path / 'folder' / 'cached.tif' in manifest.paths()
+    assert not manifest.is_changed
@@ -1,3 +1,9 @@
+import os
+import threading
+import pytest
+import tifffile
+import numpy as np
+import xarray as xr
 from papylio.movie.movie import Movie
 
 
@@ -20,3 +26,323 @@ def test_image_info_to_filename():
     filename = Movie.image_info_to_filename(**image_info)
     filename_expected = 'Abc_ave_fov005_f10-50-2_i0'
     assert filename == filename_expected
+
+
+@pytest.fixture
+def movie(tmp_path):
+    rng = np.random.default_rng(0)
+    tifffile.imwrite(tmp_path / 'movie.tif', rng.integers(100, 1000, (12, 16, 32), dtype=np.uint16))
+    movie = Movie(tmp_path / 'movie.tif')
+    movie.channel_arrangement = [[[0, 1]]]
+    movie.illumination_arrangement = [0, 1, 1]
+    return movie
+
+
+def random_corrections(movie, rng):
+    illumination_shape = (movie.number_of_illuminations, movie.number_of_channels, 16, 16)
+    illumination_dims = ('illumination', 'channel', 'y', 'x')
+    return dict(
+        darkfield_correction=xr.DataArray(rng.uniform(0, 50, illumination_shape), dims=illumination_dims),
+        flatfield_correction=xr.DataArray(rng.uniform(0.5, 1.5, illumination_shape), dims=illumination_dims),
+        temporal_illumination_correction=xr.DataArray(rng.uniform(0.8, 1.2, movie.number_of_frames), dims='frame'),
+        temporal_background_correction=xr.DataArray(rng.uniform(0, 20, (movie.number_of_frames,
+                                                                        movie.number_of_channels)),
+                                                    dims=('frame', 'channel')),
+        spatial_background_correction=xr.DataArray(rng.uniform(0, 20, illumination_shape), dims=illumination_dims),
+        general_background_correction=xr.DataArray(rng.uniform(0, 20, illumination_shape[:2]),
+                                                   dims=('illumination', 'channel'))
+    )
+
+
+def apply_corrections_reference(frames, frame_indices, illumination_indices, corrections):
+    # Corrections applied one after the other, in the order of the original implementation
+    frames = frames.astype(float)
+    if 'darkfield_correction' in corrections:
+        frames = frames - corrections['darkfield_correction'].values[illumination_indices]
+    if 'flatfield_correction' in corrections:
+        frames = frames / corrections['flatfield_correction'].values[illumination_indices]
+    if 'temporal_illumination_correction' in corrections:
+        frames = frames / corrections['temporal_illumination_correction'].values[frame_indices, None, None, None]
+    if 'temporal_background_correction' in corrections:
+        frames = frames - corrections['temporal_background_correction'].values[frame_indices, :, None, None]
+    if 'spatial_background_correction' in corrections:
+        frames = frames - corrections['spatial_background_correction'].values[illumination_indices]
+    if 'general_background_correction' in corrections:
+        frames = frames - corrections['general_background_correction'].values[illumination_indices, :, None, None]
+    return frames
+
+
+@pytest.mark.parametrize('correction_names', [None, ['flatfield_correction', 'temporal_background_correction'],
+                                              ['darkfield_correction', 'general_background_correction'],
+                                              ['temporal_illumination_correction', 'spatial_background_correction']])
+def test_apply_corrections(movie, correction_names):
+    rng = np.random.default_rng(1)
+    corrections = random_corrections(movie, rng)
+    if correction_names is not None:
+        # Corrections that are not present are filled with neutral values in the correction plan
+        corrections = {name: corrections[name] for name in correction_names}
+    movie.save_corrections(**corrections)
+
+    frame_indices = np.array([1, 2, 3, 7, 11])
+    frames = movie.read_frames(frame_indices, apply_corrections=False, xarray=False)
+    illumination_indices = movie.illumination_index_per_frame[frame_indices].values
+    assert set(illumination_indices) == {0, 1}
+
+    frames_expected = apply_corrections_reference(frames, frame_indices, illumination_indices, corrections)
+    frames_corrected = movie.apply_corrections(frames, frame_indices)
+    assert frames_corrected.dtype == np.float32
+    assert np.allclose(frames_corrected, frames_expected, rtol=1e-5, atol=1e-3)
+
+    out = np.empty(frames.shape, dtype=np.float32)
+    assert movie.apply_corrections(frames, frame_indices, out=out) is out
+    assert np.array_equal(out, frames_corrected)
+
+    out = np.empty(frames.shape, dtype=np.float32)
+    assert movie.read_frames(frame_indices, xarray=False, out=out) is out
+    assert np.array_equal(out, frames_corrected)
+
+
+def test_apply_corrections_without_corrections(movie):
+    frame_indices = np.arange(4)
+    frames = movie.read_frames(frame_indices, apply_corrections=False, xarray=False)
+    out = np.empty(frames.shape, dtype=np.float32)
+    assert movie.apply_corrections(frames, frame_indices, out=out) is out
+    assert np.array_equal(out, frames)
+
+
+def test_corrections_cache(movie):
+    rng = np.random.default_rng(2)
+    corrections = random_corrections(movie, rng)
+    empty_hash = movie.corrections_hash
+    assert not movie.corrections.data_vars
+    assert (movie.correction_plan['darkfield'] == 0).all()
+    # Unchanged corrections are not reloaded
+    assert movie.correction_plan is movie.correction_plan
+
+    movie.save_corrections(darkfield_correction=corrections['darkfield_correction'])
+    assert 'darkfield_correction' in movie.corrections
+    assert movie.corrections_hash != empty_hash
+    assert np.allclose(movie.correction_plan['darkfield'], corrections['darkfield_correction'])
+    darkfield_hash = movie.corrections_hash
+
+    # Corrections written by another process are reloaded when the modification time of the file changes
+    modified_corrections = xr.Dataset({'darkfield_correction': corrections['darkfield_correction'] + 1})
+    movie.storage.write(modified_corrections, movie.corrections_filepath, mode='w')
+    stat = movie.corrections_filepath.stat()
+    os.utime(movie.corrections_filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert movie.corrections_hash not in [empty_hash, darkfield_hash]
+    assert np.allclose(movie.correction_plan['darkfield'], corrections['darkfield_correction'] + 1)
+
+    movie.save_corrections(darkfield_correction=None,
+                           temporal_background_correction=corrections['temporal_background_correction'])
+    assert 'darkfield_correction' not in movie.corrections
+    assert (movie.correction_plan['darkfield'] == 0).all()
+    assert np.allclose(movie.correction_plan['temporal_background'], corrections['temporal_background_correction'])
+
+    movie.reset_corrections()
+    assert not movie.corrections_filepath.exists()
+    assert movie.corrections_hash == empty_hash
+    assert (movie.correction_plan['temporal_background'] == 0).all()
+
+    # Replacing the common corrections invalidates the cache as well
+    movie._common_corrections = xr.Dataset({'flatfield_correction': corrections['flatfield_correction']})
+    assert movie.corrections_hash != empty_hash
+    assert np.allclose(movie.correction_plan['inverse_flatfield'], 1 / corrections['flatfield_correction'])
+    movie._common_corrections = xr.Dataset()
+    assert movie.corrections_hash == empty_hash
+    assert (movie.correction_plan['inverse_flatfield'] == 1).all()
+
+
+def test_make_projection_image_cache(movie):
+    def cache_filepaths():
+        return list(movie.projection_cache_path.glob('*.npy'))
+
+    def average_image():
+        frame_indices = np.arange(0, 12, 3)
+        return movie.read_frames(frame_indices, xarray=False).mean(axis=0)
+
+    settings = dict(projection_type='average', frame_range=(0, 12), flatten_channels=False)
+    image = movie.make_projection_image(**settings)
+    assert np.allclose(image, average_image())
+    assert len(cache_filepaths()) == 1
+
+    # A second call takes the image from the cache
+    np.save(cache_filepaths()[0], np.zeros_like(image))
+    assert (movie.make_projection_image(**settings) == 0).all()
+    assert np.allclose(movie.make_projection_image(**settings, use_cache=False), average_image())
+    assert len(cache_filepaths()) == 1
+
+    # Changed corrections result in a cache miss
+    movie.save_corrections(general_background_correction=xr.DataArray(np.full((2, 2), 10.),
+                                                                      dims=('illumination', 'channel')))
+    image = movie.make_projection_image(**settings)
+    assert np.allclose(image, average_image())
+    assert len(cache_filepaths()) == 2
+
+    # A changed movie file results in a cache miss
+    rng = np.random.default_rng(3)
+    tifffile.imwrite(movie.filepath, rng.integers(100, 1000, (12, 16, 32), dtype=np.uint16))
+    stat = movie.filepath.stat()
+    os.utime(movie.filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    movie = Movie(movie.filepath)
+    movie.channel_arrangement = [[[0, 1]]]
+    movie.illumination_arrangement = [0, 1, 1]
+    new_image = movie.make_projection_image(**settings)
+    assert not np.allclose(new_image, image)
+    assert np.allclose(new_image, average_image())
+    assert len(cache_filepaths()) == 3
+
+    movie.clear_projection_cache()
+    assert len(cache_filepaths()) == 0
+
+
+def write_raw_movie(filepath, frames, header=None):
+    with filepath.open('wb') as file:
+        if header is not None:
+            np.array(header, dtype=np.int16).tofile(file)
+        frames.tofile(file)
+
+
+@pytest.mark.parametrize('bitdepth', [8, 16])
+def test_pma_movie(tmp_path, bitdepth):
+    from papylio.movie.pma import PmaMovie
+    rng = np.random.default_rng(4)
+    number_of_frames, width, height = 7, 8, 6
+    if bitdepth == 8:
+        filepath = tmp_path / 'movie.pma'
+        write_raw_movie(filepath, rng.integers(0, 256, (number_of_frames, width, height), dtype=np.uint8),
+                        header=(width, height))
+    else:
+        filepath = tmp_path / 'movie_16.pma'
+        # Each frame consists of a block with the most significant bytes followed by the least significant bytes
+        write_raw_movie(filepath, rng.integers(0, 256, (number_of_frames, 2, width, height), dtype=np.uint8),
+                        header=(width, height))
+
+    # Reference decoding of the file
+    data = np.fromfile(filepath, dtype=np.uint8, offset=4)
+    if bitdepth == 8:
+        frames_expected = data.reshape(number_of_frames, width, height)
+    else:
+        data = data.reshape(number_of_frames, 2, width, height).astype(np.uint16)
+        frames_expected = 256 * data[:, 0] + data[:, 1]
+
+    movie = PmaMovie(filepath)
+    assert movie.bitdepth == bitdepth
+    assert movie.number_of_frames == number_of_frames
+    for indices in [np.arange(number_of_frames), [2, 3, 4], [5, 1, 3], [6]]:
+        frames = movie._read_frames(indices)
+        assert frames.dtype == movie.data_type
+        assert np.array_equal(frames, frames_expected[indices])
+    assert np.array_equal(movie._read_frame(4), frames_expected[4])
+
+    # The memory map is only kept open while the movie is open
+    with movie:
+        memory_map = movie.file
+        frames = movie._read_frames([2, 3, 4])
+        assert movie._with_counter == 1
+    assert 'file' not in vars(movie)
+    assert not np.shares_memory(frames, memory_map)
+
+
+def test_nsk_movie(tmp_path):
+    from papylio.movie.nsk import NskMovie
+    rng = np.random.default_rng(5)
+    # Frames are stored row by row with a width of 8 pixels
+    write_raw_movie(tmp_path / 'movie.nsk', rng.integers(0, 2**16, (5, 6, 8), dtype=np.uint16), header=(8, 6))
+    frames_expected = np.fromfile(tmp_path / 'movie.nsk', dtype=np.uint16, offset=4).reshape(5, 6, 8)
+
+    movie = NskMovie(tmp_path / 'movie.nsk')
+    assert movie.number_of_frames == 5
+    assert np.array_equal(movie._read_frames([1, 2, 3]), frames_expected[1:4])
+    assert np.array_equal(movie._read_frames([4, 0]), frames_expected[[4, 0]])
+    movie._read_frame(0)
+    assert 'file' not in vars(movie)
+
+
+def test_binary_movie(tmp_path):
+    from papylio.movie.binary import BinaryMovie
+    rng = np.random.default_rng(6)
+    write_raw_movie(tmp_path / 'movie.bin', rng.integers(0, 2**16, (200, 250, 250), dtype=np.uint16))
+    frames_expected = np.fromfile(tmp_path / 'movie.bin', dtype=np.uint16).reshape(200, 250, 250)
+
+    movie = BinaryMovie(tmp_path / 'movie.bin')
+    assert np.array_equal(movie._read_frames([10, 11, 12]), frames_expected[10:13])
+    assert np.array_equal(movie._read_frames([199, 0]), frames_expected[[199, 0]])
+    movie._read_frame(0)
+    assert 'file' not in vars(movie)
+
+
+def test_sifx_unpacking():
+    from papylio.movie.sifx import unpack_12_bit, unpack_16_bit_from_32_bit
+    rng = np.random.default_rng(7)
+    height, width = 6, 8
+
+    # Per frame decoding as used before the frames were decoded at once
+    def decode_16_bit_from_32_bit(raw):
+        raw = np.uint16(raw)
+        return raw[0::4] + raw[1::4] * 256
+
+    def decode_12_bit(raw):
+        raw = np.uint16(raw)
+        ii = np.array(range(int(width / 2) * int(height / 2)))
+        frame = np.uint16(np.zeros(height * width))
+        frame[0::4] = raw[ii * 6 + 0] * 16 + (raw[ii * 6 + 1] % 16)
+        frame[1::4] = raw[ii * 6 + 2] * 16 + (raw[ii * 6 + 1] // 16)
+        frame[2::4] = raw[ii * 6 + 3] * 16 + (raw[ii * 6 + 4] % 16)
+        frame[3::4] = raw[ii * 6 + 5] * 16 + (raw[ii * 6 + 4] // 16)
+        return frame
+
+    raw = rng.integers(0, 256, (3, height * width * 4), dtype=np.uint8)
+    frames = unpack_16_bit_from_32_bit(raw)
+    assert frames.dtype == np.uint16
+    assert np.array_equal(frames, [decode_16_bit_from_32_bit(raw_frame) for raw_frame in raw])
+
+    raw = rng.integers(0, 256, (3, height * width * 3 // 2), dtype=np.uint8)
+    frames = unpack_12_bit(raw)
+    assert frames.dtype == np.uint16
+    assert np.array_equal(frames, [decode_12_bit(raw_frame) for raw_frame in raw])
+
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_iter_frame_blocks(movie, prefetch):
+    frame_indices = np.arange(1, 12)
+    frames_expected = movie.read_frames(frame_indices, xarray=False)
+    blocks = list(movie.iter_frame_blocks(frame_indices, block_size=4, prefetch=prefetch, xarray=False))
+    assert np.array_equal(np.concatenate([frame_indices_block for frame_indices_block, _ in blocks]), frame_indices)
+    assert all(len(frame_indices_block) <= 4 for frame_indices_block, _ in blocks)
+    assert np.array_equal(np.concatenate([frames for _, frames in blocks]), frames_expected)
+    assert movie._with_counter == 0
+
+
+def test_iter_frame_blocks_exception(movie, monkeypatch):
+    read_frames_in_memory = movie._read_frames_in_memory
+
+    def read_frames_with_failure(frame_indices, **kwargs):
+        if 6 in frame_indices:
+            raise OSError('Read failed')
+        return read_frames_in_memory(frame_indices, **kwargs)
+
+    monkeypatch.setattr(movie, '_read_frames_in_memory', read_frames_with_failure)
+    blocks = movie.iter_frame_blocks(block_size=3, prefetch=2, xarray=False)
+    frame_indices_block, frames = next(blocks)
+    assert np.array_equal(frame_indices_block, [0, 1, 2])
+    next(blocks)
+    with pytest.raises(OSError, match='Read failed'):
+        next(blocks)
+    assert movie._with_counter == 0
+
+
+def test_iter_frame_blocks_early_close(movie):
+    number_of_threads = threading.active_count()
+    blocks = movie.iter_frame_blocks(block_size=1, prefetch=2, xarray=False)
+    next(blocks)
+    # The reader thread may be reading the next block
+    assert movie._with_counter >= 1
+    blocks.close()
+    assert movie._with_counter == 0
+    assert threading.active_count() == number_of_threads
+
+    for frame_indices_block, frames in movie.iter_frame_blocks(block_size=2, prefetch=2, xarray=False):
+        break
+    assert movie._with_counter == 0
+    assert threading.active_count() == number_of_threads
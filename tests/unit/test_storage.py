@@ -0,0 +1,35 @@
+import pytest
+import numpy as np
+import xarray as xr
+from papylio.storage import get_storage, write_merged_dataset
+
+
+@pytest.fixture(params=['netcdf', 'zarr'])
+def storage(request):
+    if request.param == 'zarr':
+        pytest.importorskip('zarr')
+    return get_storage(request.param)
+
+
+def test_write_and_append(storage, tmp_path):
+    filepath = tmp_path / ('test' + storage.extension)
+    intensity = xr.DataArray(np.random.rand(10, 2, 50).astype('float32'), dims=('molecule', 'channel', 'frame'),
+                             name='intensity')
+    storage.write(intensity.to_dataset(), filepath, mode='w', encoding={'intensity': {'chunksizes': (5, 2, 25)}})
+    storage.write((intensity.sum('channel') > 1).rename('selection').to_dataset(), filepath, mode='a')
+
+    assert storage.exists(filepath)
+    with storage.open(filepath) as dataset:
+        assert set(dataset.data_vars) == {'intensity', 'selection'}
+        assert (dataset['intensity'].values == intensity.values).all()
+
+    storage.remove(filepath)
+    assert not storage.exists(filepath)
+
+
+def test_write_merged_dataset(storage, tmp_path):
+    datasets = [xr.Dataset({'intensity': (('molecule', 'frame'), np.random.rand(n, 20))}) for n in [3, 7]]
+    filepath_out = tmp_path / ('merged' + storage.extension)
+    write_merged_dataset(datasets, filepath_out, storage, concat_dim='molecule', chunk_size=4)
+    merged = storage.load(filepath_out)
+    assert (merged['intensity'].values == np.concatenate([dataset['intensity'].values for dataset in datasets])).all()
@@ -0,0 +1,28 @@
+import numpy as np
+import xarray as xr
+from papylio.trace_extraction import make_gaussian_mask, make_weight_matrix, extract_intensity_from_frame, \
+    extract_intensity_from_frames
+
+
+def test_extract_intensity_from_frames():
+    rng = np.random.default_rng(0)
+    height, width, neighbourhood_size = 40, 60, 7
+    frames = rng.poisson(100, (5, height, width)).astype('float32')
+
+    coordinates = xr.DataArray(rng.uniform(5, 35, (10, 2, 2)), dims=('molecule', 'channel', 'dimension'),
+                               coords={'channel': [0, 1], 'dimension': ['x', 'y']})
+    coordinates[1] = coordinates[0] # Overlapping masks
+    twoD_gaussians = make_gaussian_mask(size=neighbourhood_size, offsets=coordinates % 1, sigma=1.291)
+    roi_indices = (coordinates // 1).astype(int) + \
+                  xr.DataArray(np.mgrid[:neighbourhood_size, :neighbourhood_size] - neighbourhood_size // 2,
+                               dims=('dimension', 'y', 'x'), coords={'dimension': ['y', 'x']})
+    oneD_indices = (roi_indices.sel(dimension='y') * width + roi_indices.sel(dimension='x'))\
+        .stack(peak=('molecule', 'channel')).stack(i=('y', 'x'))
+
+    weight_matrix = make_weight_matrix(oneD_indices, twoD_gaussians, height * width)
+    intensity = extract_intensity_from_frames(frames, weight_matrix).reshape(10, 2, 5)
+
+    intensity_expected = np.stack([extract_intensity_from_frame(xr.DataArray(frame, dims=('y', 'x')),
+                                                                oneD_indices, twoD_gaussians) for frame in frames],
+                                  axis=-1)
+    np.testing.assert_allclose(intensity, intensity_expected, rtol=1e-5)